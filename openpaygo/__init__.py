@@ -1,24 +1,60 @@
+from .metrics_auth import MetricsAuthVerifier
+from .metrics_data_format import CompiledDataFormat, DataFormatRegistry
+from .metrics_pipeline import MetricsPipeline
 from .metrics_request import MetricsRequestHandler
 from .metrics_response import MetricsResponseHandler
 from .metrics_shared import AuthMethod
+from .provisioning import DeviceProvisioner
+from .token_chain_cache import TokenChainCache
+from .token_checkpoint_store import TokenCheckpointStore, TokenCheckpointStoreWriter
+from .token_context import DeviceTokenContext
 from .token_decode import OpenPAYGOTokenDecoder
 from .token_encode import OpenPAYGOTokenEncoder
+from .token_invalid_cache import InvalidTokenCache
+from .token_lookup_index import TokenLookupIndex
+from .token_numpy import NumpyTokenEngine
 from .token_shared import TokenType
+from .token_shared_memory_cache import SharedMemoryChainCache
 
 
 def generate_token(**kwargs):
     return OpenPAYGOTokenEncoder.generate_token(**kwargs)
 
 
+def generate_token_book(**kwargs):
+    return OpenPAYGOTokenEncoder.generate_token_book(**kwargs)
+
+
+def generate_tokens_batch(devices, **kwargs):
+    return OpenPAYGOTokenEncoder.generate_tokens_batch(devices, **kwargs)
+
+
 def decode_token(**kwargs):
     return OpenPAYGOTokenDecoder.decode_token(**kwargs)
 
 
+def decode_tokens(tokens, **kwargs):
+    return OpenPAYGOTokenDecoder.decode_tokens(tokens, **kwargs)
+
+
 __all__ = [
     MetricsRequestHandler,
     MetricsResponseHandler,
+    MetricsPipeline,
     AuthMethod,
+    MetricsAuthVerifier,
+    CompiledDataFormat,
+    DataFormatRegistry,
+    DeviceTokenContext,
+    DeviceProvisioner,
+    InvalidTokenCache,
     OpenPAYGOTokenDecoder,
     OpenPAYGOTokenEncoder,
+    NumpyTokenEngine,
+    SharedMemoryChainCache,
+    TokenChainCache,
+    TokenCheckpointStore,
+    TokenCheckpointStoreWriter,
+    TokenLookupIndex,
     TokenType,
 ]
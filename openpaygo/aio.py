@@ -0,0 +1,153 @@
+import asyncio
+import functools
+import weakref
+
+from .metrics_response import MetricsResponseHandler
+from .token_decode import OpenPAYGOTokenDecoder
+from .token_encode import OpenPAYGOTokenEncoder
+
+
+class AsyncRunner(object):
+    # Runs the token and metrics functions in an executor so that the long chain
+    # walks do not block the event loop. The executor is the default thread pool of
+    # the loop unless one is given (a ProcessPoolExecutor also works, but the caches
+    # given as arguments are then copied to the worker and do not persist). At most
+    # max_concurrency calls are sent to the executor at once, and the identical token
+    # requests in flight at the same time share the same call. Each of them gets its
+    # own copy of the lists and dicts of the result (e.g. the updated counts of
+    # decode_token()), so a caller modifying them does not change the others' ones.
+
+    DEFAULT_MAX_CONCURRENCY = 32
+
+    def __init__(self, executor=None, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        if max_concurrency < 1:
+            raise ValueError("The maximum concurrency must be at least 1.")
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        # The semaphores and futures belong to a loop, so we keep them per loop
+        self._loop_states = weakref.WeakKeyDictionary()
+
+    async def run(self, function, *args, coalesce_key=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        semaphore, in_flight = self._get_loop_state(loop)
+        if coalesce_key is None:
+            return await self._run_in_executor(loop, semaphore, function, args, kwargs)
+        task = in_flight.get(coalesce_key)
+        if task is None:
+            task = loop.create_task(
+                self._run_in_executor(loop, semaphore, function, args, kwargs)
+            )
+            in_flight[coalesce_key] = task
+            task.add_done_callback(lambda _: in_flight.pop(coalesce_key, None))
+        # A caller being cancelled does not cancel the call for the others
+        return self._copy_result(await asyncio.shield(task))
+
+    async def generate_token(self, **kwargs):
+        return await self.run(
+            OpenPAYGOTokenEncoder.generate_token,
+            coalesce_key=self._get_coalesce_key("generate_token", kwargs),
+            **kwargs,
+        )
+
+    async def decode_token(self, **kwargs):
+        return await self.run(
+            OpenPAYGOTokenDecoder.decode_token,
+            coalesce_key=self._get_coalesce_key("decode_token", kwargs),
+            **kwargs,
+        )
+
+    async def metrics_response_handler(self, received_metrics, **kwargs):
+        return await self.run(MetricsResponseHandler, received_metrics, **kwargs)
+
+    async def is_auth_valid(self, metrics_response_handler):
+        return await self.run(metrics_response_handler.is_auth_valid)
+
+    async def get_simple_metrics(self, metrics_response_handler):
+        return await self.run(metrics_response_handler.get_simple_metrics)
+
+    async def get_answer_payload(self, metrics_response_handler):
+        return await self.run(metrics_response_handler.get_answer_payload)
+
+    def _get_loop_state(self, loop):
+        loop_state = self._loop_states.get(loop)
+        if loop_state is None:
+            loop_state = (asyncio.Semaphore(self.max_concurrency), {})
+            self._loop_states[loop] = loop_state
+        return loop_state
+
+    async def _run_in_executor(self, loop, semaphore, function, args, kwargs):
+        async with semaphore:
+            return await loop.run_in_executor(
+                self.executor, functools.partial(function, *args, **kwargs)
+            )
+
+    @classmethod
+    def _copy_result(cls, result):
+        # The token functions return tuples, we copy the lists and dicts in them
+        if isinstance(result, tuple):
+            return tuple(cls._copy_value(value) for value in result)
+        return cls._copy_value(result)
+
+    @classmethod
+    def _copy_value(cls, value):
+        if isinstance(value, (list, dict)):
+            return value.copy()
+        return value
+
+    @classmethod
+    def _get_coalesce_key(cls, name, kwargs):
+        # The lists and dicts (e.g. used_counts) are compared by value, the requests
+        # with arguments that cannot be compared are not coalesced
+        key = (name,) + tuple(
+            sorted(
+                (argument, cls._get_hashable_value(value))
+                for argument, value in kwargs.items()
+            )
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    @classmethod
+    def _get_hashable_value(cls, value):
+        if isinstance(value, list):
+            return tuple(value)
+        if isinstance(value, dict):
+            return frozenset(value.items())
+        return value
+
+
+_default_runner = AsyncRunner()
+
+
+def configure(executor=None, max_concurrency=AsyncRunner.DEFAULT_MAX_CONCURRENCY):
+    # We replace the runner used by the functions below
+    global _default_runner
+    _default_runner = AsyncRunner(executor, max_concurrency)
+    return _default_runner
+
+
+async def agenerate_token(**kwargs):
+    return await _default_runner.generate_token(**kwargs)
+
+
+async def adecode_token(**kwargs):
+    return await _default_runner.decode_token(**kwargs)
+
+
+async def ametrics_response_handler(received_metrics, **kwargs):
+    return await _default_runner.metrics_response_handler(received_metrics, **kwargs)
+
+
+async def ais_auth_valid(metrics_response_handler):
+    return await _default_runner.is_auth_valid(metrics_response_handler)
+
+
+async def aget_simple_metrics(metrics_response_handler):
+    return await _default_runner.get_simple_metrics(metrics_response_handler)
+
+
+async def aget_answer_payload(metrics_response_handler):
+    return await _default_runner.get_answer_payload(metrics_response_handler)
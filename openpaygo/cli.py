@@ -0,0 +1,390 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+
+from .provisioning import DeviceProvisioner
+from .token_context import DeviceTokenContext
+from .token_shared import TokenType
+
+TOKEN_TYPE_NAMES = {
+    TokenType.ADD_TIME: "ADD_TIME",
+    TokenType.SET_TIME: "SET_TIME",
+    TokenType.DISABLE_PAYG: "DISABLE_PAYG",
+    TokenType.COUNTER_SYNC: "COUNTER_SYNC",
+    TokenType.INVALID: "INVALID",
+    TokenType.ALREADY_USED: "ALREADY_USED",
+}
+TOKEN_TYPES_BY_NAME = {
+    name: token_type for token_type, name in TOKEN_TYPE_NAMES.items()
+}
+RESULT_FIELDS = {
+    "generate": ["new_count", "token", "error"],
+    "decode": ["value", "token_type", "new_count", "used_counts", "error"],
+}
+
+
+def main(argv=None):
+    args = _get_parser().parse_args(argv)
+    return args.run(args)
+
+
+def _process_tokens(args):
+    input_format = args.input_format or _guess_format(args.input)
+    output_format = args.output_format or _guess_format(args.output) or input_format
+    input_file = _open_file(args.input, "r", sys.stdin)
+    output_file = None
+    try:
+        # The CSV header is made of the fields of the input rows read before the
+        # first result, rather than of the first result which can be an error
+        input_fields = {}
+        rows = _record_fields(
+            _read_rows(input_file, input_format or "jsonl"), input_fields
+        )
+        results = _report_progress(
+            _process_rows(args.command, rows, args.workers, args.chunk_size),
+            args.report_every,
+        )
+        # We only open (and truncate) the output once the first rows are processed,
+        # so an input that cannot be read at all does not overwrite it
+        first_result = next(results, None)
+        output_file = _open_file(args.output, "w", sys.stdout)
+        if first_result is not None:
+            results = chain([first_result], results)
+        _write_rows(
+            output_file,
+            output_format or "jsonl",
+            results,
+            input_fields,
+            RESULT_FIELDS[args.command],
+        )
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not None and output_file is not sys.stdout:
+            output_file.close()
+
+
+def _provision(args):
+    provisioner = DeviceProvisioner(
+        args.output,
+        file_format=args.format,
+        seed=args.seed,
+        processes=args.workers,
+        chunk_size=args.chunk_size,
+    )
+    stats = provisioner.provision(args.count, resume=args.resume)
+    print(
+        "{} devices written after the first {} in {:.1f}s ({:.0f} devices/sec)".format(
+            stats["written"],
+            stats["resumed_from"],
+            stats["elapsed"],
+            stats["devices_per_sec"],
+        ),
+        file=sys.stderr,
+    )
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog="openpaygo",
+        description="Generate or decode OpenPAYGO tokens, or provision devices.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    tokens_parser = _get_tokens_parser()
+    for command, function_name in [
+        ("generate", "generate_token"),
+        ("decode", "decode_token"),
+    ]:
+        subparser = subparsers.add_parser(
+            command,
+            parents=[tokens_parser],
+            help="{} tokens in bulk".format(command.capitalize()),
+            description=(
+                "{} OpenPAYGO tokens in bulk. Each input row contains the arguments "
+                "of {}(), the output rows contain the input fields followed by the "
+                "results.".format(command.capitalize(), function_name)
+            ),
+        )
+        subparser.set_defaults(run=_process_tokens)
+    provision_parser = subparsers.add_parser(
+        "provision",
+        help="Generate the secret keys and starting codes of a batch of devices",
+        description=(
+            "Generate the secret keys and starting codes of a batch of devices, as "
+            "fixed width binary records or CSV rows."
+        ),
+    )
+    _add_provision_arguments(provision_parser)
+    provision_parser.set_defaults(run=_provision)
+    return parser
+
+
+def _get_tokens_parser():
+    # The arguments shared by the generate and decode commands
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "input", nargs="?", default="-", help="Input file (default: stdin)"
+    )
+    parser.add_argument(
+        "-o", "--output", default="-", help="Output file (default: stdout)"
+    )
+    parser.add_argument(
+        "--input-format",
+        choices=["csv", "jsonl"],
+        help="Format of the input (default: from the file extension, or jsonl)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["csv", "jsonl"],
+        help="Format of the output (default: from the file extension, or the input "
+        "format)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (default: 1, in the current process)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Number of rows sent to a worker at once (default: 1000)",
+    )
+    parser.add_argument(
+        "--report-every",
+        type=int,
+        default=100000,
+        help="Report the progress on stderr every N rows, 0 to only report at the "
+        "end (default: 100000)",
+    )
+    return parser
+
+
+def _add_provision_arguments(parser):
+    parser.add_argument("output", help="Output file")
+    parser.add_argument(
+        "-n", "--count", type=int, required=True, help="Number of devices"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["binary", "csv"],
+        help="Format of the output (default: csv for a .csv file, binary otherwise)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the keys, for reproducible test batches only (default: keys "
+        "from the system CSPRNG)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the records already in the output file and write the others",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (default: 1, in the current process)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DeviceProvisioner.DEFAULT_CHUNK_SIZE,
+        help="Number of devices sent to a worker at once (default: {})".format(
+            DeviceProvisioner.DEFAULT_CHUNK_SIZE
+        ),
+    )
+
+
+def _guess_format(path):
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith(".jsonl") or path.endswith(".ndjson"):
+        return "jsonl"
+    return None
+
+
+def _open_file(path, mode, default):
+    if path == "-":
+        return default
+    return open(path, mode, newline="")
+
+
+def _read_rows(input_file, input_format):
+    if input_format == "csv":
+        yield from csv.DictReader(input_file)
+        return
+    # The invalid lines are yielded as errors, reported in their result row
+    for line_number, line in enumerate(input_file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield ValueError("Invalid JSON on line {}: {}".format(line_number, e))
+            continue
+        if not isinstance(row, dict):
+            yield ValueError("The line {} is not a JSON object.".format(line_number))
+            continue
+        yield row
+
+
+def _record_fields(rows, fields):
+    # We keep the fields of the input rows in order in the fields dict
+    for row in rows:
+        if isinstance(row, dict):
+            for field in row:
+                # The values beyond the CSV header have no field name
+                if field is not None:
+                    fields[field] = None
+        yield row
+
+
+def _write_rows(output_file, output_format, rows, input_fields, result_fields):
+    if output_format == "jsonl":
+        for row in rows:
+            output_file.write(json.dumps(row) + "\n")
+        return
+    writer = None
+    for row in rows:
+        if writer is None:
+            fieldnames = [field for field in input_fields if field not in result_fields]
+            writer = csv.DictWriter(
+                output_file,
+                fieldnames=fieldnames + result_fields,
+                extrasaction="ignore",
+            )
+            writer.writeheader()
+        if isinstance(row.get("used_counts"), (list, dict)):
+            row = dict(row, used_counts=json.dumps(row["used_counts"]))
+        writer.writerow(row)
+
+
+def _process_rows(command, rows, workers, chunk_size):
+    chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _process_chunk(command, chunk)
+        return
+    # We keep a bounded number of chunks in flight and yield them in order, so the
+    # memory used does not depend on the size of the input
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_process_chunk, command, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _process_chunk(command, rows):
+    # The devices appearing several times in a chunk share the same context
+    contexts = {}
+    results = []
+    for row in rows:
+        if isinstance(row, Exception):
+            results.append({"error": "{}: {}".format(type(row).__name__, row)})
+            continue
+        result = dict(row)
+        try:
+            context = _get_context(contexts, row)
+            if command == "generate":
+                result["new_count"], result["token"] = context.generate(
+                    count=int(row["count"]),
+                    value=_parse_number(row.get("value")),
+                    token_type=_parse_token_type(row.get("token_type")),
+                )
+            else:
+                value, token_type, new_count, used_counts = context.decode(
+                    token=str(row["token"]).replace(" ", ""),
+                    count=int(row["count"]),
+                    used_counts=_parse_used_counts(row.get("used_counts")),
+                )
+                result["value"] = value
+                result["token_type"] = TOKEN_TYPE_NAMES[token_type]
+                result["new_count"] = new_count
+                result["used_counts"] = used_counts
+        except (KeyError, TypeError, ValueError) as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        results.append(result)
+    return results
+
+
+def _get_context(contexts, row):
+    context_key = (
+        row["secret_key"],
+        _parse_number(row.get("starting_code")),
+        _parse_number(row.get("value_divider")) or 1,
+        _parse_bool(row.get("restricted_digit_set")),
+        _parse_bool(row.get("extended_token")),
+    )
+    context = contexts.get(context_key)
+    if context is None:
+        context = DeviceTokenContext(*context_key)
+        contexts[context_key] = context
+    return context
+
+
+def _parse_number(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = float(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ["1", "true", "yes"]
+    return bool(value)
+
+
+def _parse_token_type(value):
+    if value is None or value == "":
+        return TokenType.ADD_TIME
+    if isinstance(value, str) and not value.isdigit():
+        return TOKEN_TYPES_BY_NAME[value.upper()]
+    return int(value)
+
+
+def _parse_used_counts(value):
+    if isinstance(value, str):
+        return json.loads(value) if value else None
+    return value
+
+
+def _report_progress(rows, report_every):
+    start_time = time.perf_counter()
+    row_count = 0
+    for row in rows:
+        yield row
+        row_count += 1
+        if report_every and row_count % report_every == 0:
+            _print_rate(row_count, start_time)
+    if not report_every or row_count % report_every:
+        _print_rate(row_count, start_time)
+
+
+def _print_rate(row_count, start_time):
+    elapsed = time.perf_counter() - start_time
+    rate = row_count / elapsed if elapsed > 0 else 0
+    print(
+        "{} rows in {:.1f}s ({:.0f} rows/sec)".format(row_count, elapsed, rate),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
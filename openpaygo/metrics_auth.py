@@ -0,0 +1,121 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from .metrics_response import MetricsResponseHandler
+from .metrics_shared import OpenPAYGOMetricsShared, load_siphash_key_from_hex
+from .token_numpy import NumpyTokenEngine, np
+
+# Below this number of requests hashed together, NumPy is slower than hashing them
+# one by one
+NUMPY_MIN_MESSAGES = 16
+
+
+class MetricsAuthVerifier(object):
+    # Verifies the auth of many requests, given as (payload, secret_key,
+    # last_request_count, last_request_timestamp) tuples, with the same result as
+    # MetricsResponseHandler.is_auth_valid() (False if the request cannot be
+    # verified at all). The signatures of the requests of a chunk are computed
+    # together, one hashing step at a time, with the NumpyTokenEngine when
+    # available, and the chunks can be spread on several processes.
+
+    DEFAULT_CHUNK_SIZE = 256
+
+    def __init__(self, processes=1, chunk_size=DEFAULT_CHUNK_SIZE, use_numpy=None):
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1.")
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.use_numpy = use_numpy
+
+    def verify(self, requests):
+        return list(self.iter_verify(requests))
+
+    def iter_verify(self, requests):
+        requests = iter(requests)
+        chunks = iter(lambda: list(islice(requests, self.chunk_size)), [])
+        if self.processes <= 1:
+            for chunk in chunks:
+                yield from self.verify_chunk(chunk, self.use_numpy)
+            return
+        # We keep a bounded number of chunks in flight and yield them in order
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(
+                    executor.submit(self.verify_chunk, chunk, self.use_numpy)
+                )
+                if len(pending) >= self.processes * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    @classmethod
+    def verify_chunk(cls, requests, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = NumpyTokenEngine.is_available()
+        results = [False] * len(requests)
+        # Each request being verified is [index, handler, auth_string, signature
+        # steps, key, next string to hash]
+        verifications = []
+        for index, request in enumerate(requests):
+            payload, secret_key, *last_values = request
+            last_request_count, last_request_timestamp = (
+                list(last_values) + [None] * 2
+            )[:2]
+            try:
+                handler = MetricsResponseHandler(
+                    payload,
+                    secret_key=secret_key,
+                    last_request_count=last_request_count,
+                    last_request_timestamp=last_request_timestamp,
+                )
+                auth_string = handler.request_dict.get("auth", None)
+                if not auth_string or not secret_key:
+                    continue
+                key = load_siphash_key_from_hex(secret_key)
+                signature_steps = OpenPAYGOMetricsShared.get_request_signature_steps(
+                    handler.request_dict, auth_string[:2]
+                )
+                input_string = next(signature_steps)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                continue
+            verifications.append(
+                [index, handler, auth_string, signature_steps, key, input_string]
+            )
+        while verifications:
+            hashes = cls._hash_strings(
+                [verification[4] for verification in verifications],
+                [verification[5] for verification in verifications],
+                use_numpy,
+            )
+            remaining_verifications = []
+            for verification, hash in zip(verifications, hashes):
+                index, handler, auth_string, signature_steps = verification[:4]
+                try:
+                    verification[5] = signature_steps.send("{:x}".format(hash))
+                except StopIteration as signature:
+                    results[index] = (
+                        auth_string == auth_string[:2] + signature.value
+                        and handler._is_request_new()
+                    )
+                    continue
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    continue
+                remaining_verifications.append(verification)
+            verifications = remaining_verifications
+        return results
+
+    @classmethod
+    def _hash_strings(cls, keys, input_strings, use_numpy):
+        messages = [input_string.encode("utf-8") for input_string in input_strings]
+        if not use_numpy or len(messages) < NUMPY_MIN_MESSAGES:
+            return [key.hash(message) for key, message in zip(keys, messages)]
+        key_array = np.frombuffer(
+            b"".join(key.key for key in keys), dtype="<u8"
+        ).reshape(-1, 2)
+        return NumpyTokenEngine.hash_messages(
+            key_array[:, 0].astype(np.uint64),
+            key_array[:, 1].astype(np.uint64),
+            messages,
+        ).tolist()
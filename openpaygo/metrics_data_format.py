@@ -0,0 +1,228 @@
+import threading
+from collections import OrderedDict
+
+from .metrics_shared import OpenPAYGOMetricsShared
+
+
+class CompiledDataFormat(object):
+    # A data format with the tables used to expand and condense the data computed
+    # once, so that the handlers do not interpret the data format dict for each
+    # request. It can be used wherever a data format dict is accepted.
+
+    def __init__(self, data_format):
+        self.data_format = data_format
+        self.id = data_format.get("id")
+        self.data_order = tuple(data_format.get("data_order") or ())
+        self.historical_data_order = tuple(
+            data_format.get("historical_data_order") or ()
+        )
+        self.historical_data_interval = data_format.get("historical_data_interval")
+        self.has_data_order = bool(self.data_order)
+        self.has_historical_data_order = bool(self.historical_data_order)
+        self.has_historical_data_interval = bool(self.historical_data_interval)
+        self.data_indexes = {
+            name: index for index, name in reversed(list(enumerate(self.data_order)))
+        }
+        self.historical_data_indexes = {
+            name: index
+            for index, name in reversed(list(enumerate(self.historical_data_order)))
+        }
+        # The expanded data uses the simple variable names
+        revert_keys = {
+            value: key
+            for key, value in OpenPAYGOMetricsShared.CONDENSED_KEY_NAMES.items()
+        }
+        self.simple_data_order = tuple(
+            revert_keys.get(name, name) for name in self.data_order
+        )
+        # The sparse time steps use the index of the variables as keys
+        self.historical_data_names_by_key = {
+            str(index): name for index, name in enumerate(self.historical_data_order)
+        }
+
+    @classmethod
+    def compile(cls, data_format):
+        if data_format is None or isinstance(data_format, cls):
+            return data_format
+        return cls(data_format)
+
+    def get(self, key, default=None):
+        return self.data_format.get(key, default)
+
+    def expand_data(self, data):
+        if not self.has_data_order:
+            raise ValueError("Data Format does not contain data_order")
+        # The values beyond the data format are ignored
+        return dict(
+            zip(
+                self.simple_data_order,
+                data + [None] * (len(self.data_order) - len(data)),
+            )
+        )
+
+    def expand_historical_time_step(self, time_step):
+        if isinstance(time_step, list):
+            if not self.has_historical_data_order:
+                raise ValueError("Data Format does not contain historical_data_order")
+            return dict(zip(self.historical_data_order, time_step))
+        if isinstance(time_step, dict):
+            names_by_key = self.historical_data_names_by_key
+            time_step_data = {}
+            for key, value in time_step.items():
+                name = names_by_key.get(key)
+                if name is None and key.isdigit():
+                    # Keys like "01" are not in the table
+                    index = int(key)
+                    if index < len(self.historical_data_order):
+                        name = self.historical_data_order[index]
+                time_step_data[key if name is None else name] = value
+            return time_step_data
+        raise ValueError("Invalid historical data step type: " + str(time_step))
+
+    def condense_data(self, data):
+        if data and not self.has_data_order:
+            raise ValueError("Data Format does not contain data_order")
+        additional_data = {
+            key: value for key, value in data.items() if key not in self.data_indexes
+        }
+        if additional_data:
+            raise ValueError(
+                "Additional variables not present in the data format: "
+                + str(additional_data)
+            )
+        return OpenPAYGOMetricsShared.remove_trailing_empty_elements(
+            [data.get(name) for name in self.data_order]
+        )
+
+    def condense_historical_time_step(self, time_step):
+        additional_data = {
+            key: value
+            for key, value in time_step.items()
+            if key not in self.historical_data_indexes
+        }
+        if additional_data:
+            raise ValueError(
+                "Additional variables not present in the historical data format: "
+                + str(additional_data)
+            )
+        return OpenPAYGOMetricsShared.remove_trailing_empty_elements(
+            [time_step.get(name) for name in self.historical_data_order]
+        )
+
+
+class DataFormatRegistry(object):
+    # Keeps the most recently used compiled data formats by ID. The data formats
+    # missing are loaded with the loader callback (e.g. from a database), which
+    # returns the data format dict or None if it does not exist. Like the
+    # TokenChainCache, the formats and counters are spread on stripes with their own
+    # lock and their share of max_formats, so that the handlers of different threads
+    # rarely wait for each other.
+
+    DEFAULT_MAX_FORMATS = 1024
+    DEFAULT_STRIPES = 16
+
+    def __init__(
+        self, loader=None, max_formats=DEFAULT_MAX_FORMATS, stripes=DEFAULT_STRIPES
+    ):
+        if max_formats < 1:
+            raise ValueError("The registry must be able to hold at least 1 format.")
+        self.loader = loader
+        self.max_formats = max_formats
+        stripes = max(1, min(stripes, max_formats))
+        self._stripes = [
+            _DataFormatStripe(max_formats // stripes + (i < max_formats % stripes))
+            for i in range(stripes)
+        ]
+
+    def __len__(self):
+        return sum(len(stripe.formats) for stripe in self._stripes)
+
+    def __contains__(self, data_format_id):
+        return data_format_id in self._get_stripe(data_format_id).formats
+
+    @property
+    def hits(self):
+        return self._sum_counter("hits")
+
+    @property
+    def misses(self):
+        return self._sum_counter("misses")
+
+    def get(self, data_format_id):
+        stripe = self._get_stripe(data_format_id)
+        with stripe.lock:
+            compiled_format = stripe.formats.get(data_format_id)
+            if compiled_format is not None:
+                stripe.formats.move_to_end(data_format_id)
+                stripe.hits += 1
+                return compiled_format
+            stripe.misses += 1
+        if self.loader is None:
+            return None
+        # We do not hold the lock while loading, a format loaded by two threads at
+        # the same time is simply added twice
+        data_format = self.loader(data_format_id)
+        if data_format is None:
+            return None
+        return self._add(data_format_id, CompiledDataFormat.compile(data_format))
+
+    def add(self, data_format):
+        compiled_format = CompiledDataFormat.compile(data_format)
+        if compiled_format.id is None:
+            raise ValueError("The data format must have an ID to be registered.")
+        return self._add(compiled_format.id, compiled_format)
+
+    def remove(self, data_format_id):
+        stripe = self._get_stripe(data_format_id)
+        with stripe.lock:
+            stripe.formats.pop(data_format_id, None)
+
+    def clear(self):
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.formats.clear()
+
+    def get_stats(self):
+        formats = hits = misses = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                formats += len(stripe.formats)
+                hits += stripe.hits
+                misses += stripe.misses
+        lookups = hits + misses
+        return {
+            "formats": formats,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def _add(self, data_format_id, compiled_format):
+        stripe = self._get_stripe(data_format_id)
+        with stripe.lock:
+            stripe.formats[data_format_id] = compiled_format
+            stripe.formats.move_to_end(data_format_id)
+            if len(stripe.formats) > stripe.max_formats:
+                stripe.formats.popitem(last=False)
+        return compiled_format
+
+    def _sum_counter(self, name):
+        total = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                total += getattr(stripe, name)
+        return total
+
+    def _get_stripe(self, data_format_id):
+        return self._stripes[hash(data_format_id) % len(self._stripes)]
+
+
+class _DataFormatStripe(object):
+    __slots__ = ("lock", "formats", "max_formats", "hits", "misses")
+
+    def __init__(self, max_formats):
+        self.lock = threading.Lock()
+        self.formats = OrderedDict()
+        self.max_formats = max_formats
+        self.hits = 0
+        self.misses = 0
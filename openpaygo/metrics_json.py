@@ -0,0 +1,131 @@
+import json
+import re
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class StdlibJSONBackend(object):
+    # The reference backend, the compact output of the json module (with non ASCII
+    # characters escaped) is what the signatures are computed on
+    name = "json"
+    # json.dumps() creates a new encoder for each call with non default separators
+    _encoder = json.JSONEncoder(separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, data):
+        return json.loads(data)
+
+    @classmethod
+    def dumps(cls, data):
+        return cls._encoder.encode(data)
+
+
+class OrjsonJSONBackend(object):
+    # Uses orjson when it gives the same result as the json module, and falls back
+    # to it otherwise, so the output is always the same. orjson does not escape
+    # non ASCII characters (nor DEL), writes small floats without exponent (and
+    # large ones with a different exponent), writes NaN and Infinity as null,
+    # parses the integers of more than 64 bits as floats, and rejects some inputs
+    # accepted by the json module (e.g. NaN, UTF-16 or lone surrogates).
+    name = "orjson"
+    # The subclasses of the JSON types, dates and dataclasses are rejected by the
+    # json module, so we let them raise to fall back to it
+    _DUMPS_OPTIONS = (
+        (
+            orjson.OPT_PASSTHROUGH_SUBCLASS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+        )
+        if orjson is not None
+        else 0
+    )
+    # The patterns start with a literal so that they are searched quickly
+    _EXPONENT_PATTERN = re.compile(rb"e(?<=[0-9]e)")
+    _SMALL_FLOAT_PATTERN = re.compile(rb"(?<![0-9])0\.0000")
+    # The integers of 19 digits or more may not fit in 64 bits, we find them by
+    # looking for 19 zeros once the digits are replaced by zeros
+    _DIGITS_TO_ZEROS = bytes.maketrans(b"0123456789", b"0" * 10)
+    _LONG_INTEGER = b"0" * 19
+
+    @classmethod
+    def is_available(cls):
+        return orjson is not None
+
+    @classmethod
+    def loads(cls, data):
+        if isinstance(data, str):
+            data_bytes = data.encode("utf-8", "surrogatepass")
+        else:
+            data_bytes = bytes(data)
+        if cls._LONG_INTEGER in data_bytes.translate(cls._DIGITS_TO_ZEROS):
+            return StdlibJSONBackend.loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # We get the same result or error as with the json module
+            return StdlibJSONBackend.loads(data)
+
+    @classmethod
+    def dumps(cls, data):
+        try:
+            serialized = orjson.dumps(data, option=cls._DUMPS_OPTIONS)
+        except orjson.JSONEncodeError:
+            return StdlibJSONBackend.dumps(data)
+        if cls._needs_fallback(serialized):
+            return StdlibJSONBackend.dumps(data)
+        return serialized.decode("ascii")
+
+    @classmethod
+    def _needs_fallback(cls, serialized):
+        # A null may also be a NaN or an Infinity, so we do not check which one
+        return (
+            not serialized.isascii()
+            or b"\x7f" in serialized
+            or b"null" in serialized
+            or cls._EXPONENT_PATTERN.search(serialized) is not None
+            or (
+                b"0.0000" in serialized
+                and cls._SMALL_FLOAT_PATTERN.search(serialized) is not None
+            )
+        )
+
+
+JSON_BACKENDS = {
+    StdlibJSONBackend.name: StdlibJSONBackend,
+    OrjsonJSONBackend.name: OrjsonJSONBackend,
+}
+_json_backend = OrjsonJSONBackend if orjson is not None else StdlibJSONBackend
+
+
+def get_json_backend():
+    return _json_backend
+
+
+def set_json_backend(backend=None):
+    # The backend is given by name ("json" or "orjson"), or any object with the
+    # same loads() and dumps() methods. By default, the fastest one available.
+    global _json_backend
+    if backend is None:
+        backend = OrjsonJSONBackend.name if orjson is not None else "json"
+    if isinstance(backend, str):
+        if backend not in JSON_BACKENDS:
+            raise ValueError("Unknown JSON backend: {}".format(backend))
+        if backend == OrjsonJSONBackend.name and orjson is None:
+            raise ImportError(
+                "orjson is required for the orjson JSON backend, you can install it "
+                "with `pip install openpaygo[orjson]`."
+            )
+        backend = JSON_BACKENDS[backend]
+    _json_backend = backend
+    return backend
+
+
+def loads(data):
+    return _json_backend.loads(data)
+
+
+def dumps(data):
+    return _json_backend.dumps(data)
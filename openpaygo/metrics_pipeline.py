@@ -0,0 +1,171 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+from .metrics_response import MetricsResponseHandler
+
+PIPELINE_STAGES = ["read", "parse", "resolve", "verify", "expand"]
+
+
+class MetricsPipeline(object):
+    # Processes a stream of OpenPAYGO Metrics payloads (e.g. a newline delimited JSON
+    # archive), yielding one result per payload. The resolver is called with the
+    # serial number and data format ID of each request, and returns the arguments of
+    # set_device_parameters() as a dict (or None if the device is unknown). The
+    # payloads are processed by chunks, either in the current process or on a
+    # process pool (the resolver must then be picklable, e.g. a module level
+    # function), with a bounded number of chunks in flight.
+
+    DEFAULT_CHUNK_SIZE = 500
+
+    def __init__(
+        self,
+        resolver=None,
+        processes=1,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        ordered=True,
+        verify_auth=True,
+    ):
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1.")
+        self.resolver = resolver
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.verify_auth = verify_auth
+        self._reset_stats()
+
+    def process(self, source):
+        # The source is the path of a file or an iterable of payloads (str or bytes),
+        # the empty lines are skipped. Each result is a dict with the index of the
+        # payload, its serial number, whether its auth is valid (None if it is not
+        # verified), its simple metrics (None if the auth is invalid) and an error
+        # message if it could not be processed.
+        self._reset_stats()
+        self._start_time = time.perf_counter()
+        if isinstance(source, (str, bytes, os.PathLike)):
+            with open(source, "rb") as source_file:
+                yield from self._process_chunks(self._read_chunks(source_file))
+        else:
+            yield from self._process_chunks(self._read_chunks(source))
+
+    def get_stats(self):
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0.0
+        stats = dict(self._stats)
+        stats["elapsed"] = elapsed
+        stats["payloads_per_sec"] = stats["payloads"] / elapsed if elapsed else 0.0
+        # The time of the stages running in the workers is summed over them
+        stats["stages"] = {
+            stage: {
+                "seconds": seconds,
+                "per_sec": stats["payloads"] / seconds if seconds else 0.0,
+            }
+            for stage, seconds in self._stage_seconds.items()
+        }
+        return stats
+
+    def _reset_stats(self):
+        self._start_time = None
+        self._stats = {"payloads": 0, "valid": 0, "invalid": 0, "errors": 0}
+        self._stage_seconds = {stage: 0.0 for stage in PIPELINE_STAGES}
+
+    def _read_chunks(self, lines):
+        payloads = (line for line in lines if line.strip())
+        first_index = 0
+        while True:
+            start_time = time.perf_counter()
+            chunk = list(islice(payloads, self.chunk_size))
+            self._stage_seconds["read"] += time.perf_counter() - start_time
+            if not chunk:
+                return
+            yield first_index, chunk
+            first_index += len(chunk)
+
+    def _process_chunks(self, chunks):
+        arguments = (self.resolver, self.verify_auth)
+        if self.processes <= 1:
+            for first_index, chunk in chunks:
+                yield from self._add_chunk_results(
+                    _process_metrics_chunk(*arguments, first_index, chunk)
+                )
+            return
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            pending = deque()
+            for first_index, chunk in chunks:
+                pending.append(
+                    executor.submit(
+                        _process_metrics_chunk, *arguments, first_index, chunk
+                    )
+                )
+                if len(pending) >= self.processes * 2:
+                    for future in self._pop_done_futures(pending):
+                        yield from self._add_chunk_results(future.result())
+            while pending:
+                for future in self._pop_done_futures(pending):
+                    yield from self._add_chunk_results(future.result())
+
+    def _pop_done_futures(self, pending):
+        # We wait for the oldest chunk, or for any chunk if the order does not matter
+        if self.ordered:
+            return [pending.popleft()]
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+        return done
+
+    def _add_chunk_results(self, chunk_results):
+        results, stage_seconds = chunk_results
+        for stage, seconds in stage_seconds.items():
+            self._stage_seconds[stage] += seconds
+        for result in results:
+            self._stats["payloads"] += 1
+            if result["error"]:
+                self._stats["errors"] += 1
+            elif result["auth_valid"] is False:
+                self._stats["invalid"] += 1
+            else:
+                self._stats["valid"] += 1
+            yield result
+
+
+def _process_metrics_chunk(resolver, verify_auth, first_index, payloads):
+    # Returns the results of the payloads and the time spent in each stage
+    stage_seconds = {stage: 0.0 for stage in PIPELINE_STAGES[1:]}
+    results = []
+    for index, payload in enumerate(payloads, first_index):
+        result = {
+            "index": index,
+            "serial_number": None,
+            "auth_valid": None,
+            "metrics": None,
+            "error": None,
+        }
+        stage = "parse"
+        start_time = time.perf_counter()
+        try:
+            handler = MetricsResponseHandler(payload)
+            result["serial_number"] = handler.get_device_serial()
+            if resolver is not None:
+                stage_seconds[stage] += time.perf_counter() - start_time
+                stage, start_time = "resolve", time.perf_counter()
+                device_parameters = resolver(
+                    handler.get_device_serial(), handler.get_data_format_id()
+                )
+                if device_parameters is None:
+                    raise ValueError("Unknown device.")
+                handler.set_device_parameters(**device_parameters)
+            if verify_auth:
+                stage_seconds[stage] += time.perf_counter() - start_time
+                stage, start_time = "verify", time.perf_counter()
+                result["auth_valid"] = handler.is_auth_valid()
+            if result["auth_valid"] is not False:
+                stage_seconds[stage] += time.perf_counter() - start_time
+                stage, start_time = "expand", time.perf_counter()
+                result["metrics"] = handler.get_simple_metrics()
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        stage_seconds[stage] += time.perf_counter() - start_time
+        results.append(result)
+    return results, stage_seconds
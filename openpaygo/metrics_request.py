@@ -1,5 +1,6 @@
 import copy
 
+from .metrics_data_format import CompiledDataFormat
 from .metrics_shared import OpenPAYGOMetricsShared
 
 
@@ -12,12 +13,17 @@ class MetricsRequestHandler(object):
         self.request_dict = {
             "serial_number": serial_number,
         }
+        # The data format dict is kept as given, the compiled form is only used
+        # internally to condense the data
+        self._compiled_format = CompiledDataFormat.compile(data_format or None)
+        if isinstance(data_format, CompiledDataFormat):
+            data_format = data_format.data_format
         self.data_format = data_format
         if self.data_format:
-            if self.data_format.get("id"):
-                self.request_dict["data_format_id"] = data_format.get("id")
+            if self._compiled_format.id:
+                self.request_dict["data_format_id"] = self._compiled_format.id
             else:
-                self.request_dict["data_format"] = data_format
+                self.request_dict["data_format"] = self.data_format
         self.data = {}
         self.historical_data = {}
 
@@ -31,7 +37,11 @@ class MetricsRequestHandler(object):
         self.data = data
 
     def set_historical_data(self, historical_data):
-        if not self.data_format.get("historical_data_interval"):
+        # An empty data format has no historical_data_interval either
+        if (
+            self._compiled_format is None
+            or not self._compiled_format.has_historical_data_interval
+        ):
             for time_step in historical_data:
                 if not time_step.get("timestamp"):
                     raise ValueError(
@@ -64,45 +74,16 @@ class MetricsRequestHandler(object):
     def get_condensed_request_dict(self):
         if not self.data_format:
             raise ValueError("No Data Format provided for condensed request")
-        data_order = self.data_format.get("data_order")
-        if self.data and not data_order:
-            raise ValueError("Data Format does not contain data_order")
-        historical_data_order = self.data_format.get("historical_data_order")
-        if self.historical_data and not historical_data_order:
+        if self.historical_data and not self._compiled_format.has_historical_data_order:
             raise ValueError("Data Format does not contain historical_data_order")
         condensed_request = copy.deepcopy(self.request_dict)
-        condensed_request["data"] = []
-        condensed_request["historical_data"] = []
         # We add the data
-        data_copy = copy.deepcopy(self.data)
-        for var in data_order:
-            condensed_request["data"].append(
-                data_copy.pop(var) if var in data_copy else None
-            )
-        if len(data_copy) > 0:
-            raise ValueError(
-                "Additional variables not present in the data format: " + str(data_copy)
-            )
-        condensed_request["data"] = (
-            OpenPAYGOMetricsShared.remove_trailing_empty_elements(
-                condensed_request["data"]
-            )
-        )
+        condensed_request["data"] = self._compiled_format.condense_data(self.data)
         # We add the historical data
-        historical_data_copy = copy.deepcopy(self.historical_data)
-        for time_step in historical_data_copy:
-            time_step_data = []
-            for var in historical_data_order:
-                time_step_data.append(time_step.pop(var) if var in time_step else None)
-            if len(time_step) > 0:
-                raise ValueError(
-                    "Additional variables not present in the historical data format: "
-                    + str(time_step)
-                )
-            time_step_data = OpenPAYGOMetricsShared.remove_trailing_empty_elements(
-                time_step_data
-            )
-            condensed_request["historical_data"].append(time_step_data)
+        condensed_request["historical_data"] = [
+            self._compiled_format.condense_historical_time_step(time_step)
+            for time_step in self.historical_data
+        ]
         # We prepare the auth
         if self.auth_method:
             condensed_request["auth"] = (
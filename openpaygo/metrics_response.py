@@ -1,7 +1,9 @@
 import copy
-import json
 from datetime import datetime, timedelta
+from types import MappingProxyType
 
+from . import metrics_json
+from .metrics_data_format import CompiledDataFormat
 from .metrics_shared import OpenPAYGOMetricsShared
 
 
@@ -13,9 +15,11 @@ class MetricsResponseHandler(object):
         secret_key=None,
         last_request_count=None,
         last_request_timestamp=None,
+        data_format_registry=None,
     ):
         self.received_metrics = received_metrics
-        self.request_dict = json.loads(received_metrics)
+        # The payload can be given as str or bytes
+        self.request_dict = metrics_json.loads(received_metrics)
         # We convert the base variable names to simple
         self.request_dict = OpenPAYGOMetricsShared.convert_dict_keys_to_simple(
             self.request_dict
@@ -33,6 +37,17 @@ class MetricsResponseHandler(object):
         self.last_request_timestamp = last_request_timestamp
         if not self.data_format and self.request_dict.get("data_format"):
             self.data_format = self.request_dict.get("data_format")
+        if (
+            not self.data_format
+            and data_format_registry is not None
+            and self.get_data_format_id() is not None
+        ):
+            self.data_format = data_format_registry.get(self.get_data_format_id())
+        self._set_data_format(self.data_format)
+        # The data is expanded at most once, when first needed
+        self._simple_data = None
+        self._simple_metrics = None
+        self._simple_metrics_view = None
 
     def get_device_serial(self):
         return self.request_dict.get("serial_number")
@@ -43,6 +58,14 @@ class MetricsResponseHandler(object):
     def data_format_available(self):
         return self.data_format is not None
 
+    def _set_data_format(self, data_format):
+        # The data format dict is kept as given, the compiled form is only used
+        # internally to expand the data
+        self._compiled_format = CompiledDataFormat.compile(data_format or None)
+        if isinstance(data_format, CompiledDataFormat):
+            data_format = data_format.data_format
+        self.data_format = data_format
+
     def set_device_parameters(
         self,
         secret_key=None,
@@ -53,7 +76,11 @@ class MetricsResponseHandler(object):
         if secret_key:
             self.secret_key = secret_key
         if data_format:
-            self.data_format = data_format
+            self._set_data_format(data_format)
+            # The data expanded with the previous data format is not valid anymore
+            self._simple_data = None
+            self._simple_metrics = None
+            self._simple_metrics_view = None
         if last_request_count:
             self.last_request_count = last_request_count
         if last_request_timestamp:
@@ -70,38 +97,40 @@ class MetricsResponseHandler(object):
             self.request_dict, self.auth_method, self.secret_key
         )
         if auth_string == new_signature:
-            request_count = self.get_request_count()
-            if (
-                request_count
-                and self.last_request_count
-                and request_count <= self.last_request_count
-            ):
-                return False
-            timestamp = self.get_request_timestamp()
-            if (
-                timestamp
-                and self.last_request_timestamp
-                and timestamp <= self.last_request_timestamp
-            ):
-                return False
-            # Either the request count or timestamp is required
-            if request_count or timestamp:
-                return True
+            return self._is_request_new()
         return False
 
-    def get_simple_metrics(self):
-        # We start the process by making a copy of the dict to work with
-        simple_dict = copy.deepcopy(self.request_dict)
-        simple_dict.pop("auth") if "auth" in simple_dict else None  # We remove the auth
-        # We process the data and replace it
-        simple_dict["data"] = self._get_simple_data()
-        # We process the historical data
-        simple_dict["historical_data"] = self._get_simple_historical_data()
-        # We fill in the timestamps for each time step
-        simple_dict["historical_data"] = self._fill_timestamp_in_historical_data(
-            simple_dict["historical_data"]
-        )
-        return simple_dict
+    def _is_request_new(self):
+        request_count = self.get_request_count()
+        if (
+            request_count
+            and self.last_request_count
+            and request_count <= self.last_request_count
+        ):
+            return False
+        timestamp = self.get_request_timestamp()
+        if (
+            timestamp
+            and self.last_request_timestamp
+            and timestamp <= self.last_request_timestamp
+        ):
+            return False
+        # Either the request count or timestamp is required
+        if request_count or timestamp:
+            return True
+        return False
+
+    def get_simple_metrics(self, read_only=False):
+        # The metrics are expanded once, by default the caller gets a copy that it can
+        # modify. With read_only, it gets a read only view of them instead (with
+        # mappings and tuples instead of dicts and lists), built once and shared.
+        if read_only:
+            if self._simple_metrics_view is None:
+                self._simple_metrics_view = self._get_read_only_view(
+                    self._get_simple_metrics()
+                )
+            return self._simple_metrics_view
+        return self._copy_json_value(self._get_simple_metrics())
 
     def get_data_timestamp(self):
         return self.request_dict.get("data_collection_timestamp", self.timestamp)
@@ -182,60 +211,43 @@ class MetricsResponseHandler(object):
             )
         return OpenPAYGOMetricsShared.convert_dict_keys_to_condensed(condensed_answer)
 
+    def _get_simple_metrics(self):
+        if self._simple_metrics is None:
+            simple_dict = {
+                key: value for key, value in self.request_dict.items() if key != "auth"
+            }
+            simple_dict["data"] = self._get_simple_data()
+            # We fill in the timestamps for each time step
+            simple_dict["historical_data"] = self._fill_timestamp_in_historical_data(
+                self._get_simple_historical_data()
+            )
+            self._simple_metrics = simple_dict
+        return self._simple_metrics
+
     def _get_simple_data(self):
-        data = copy.deepcopy(self.request_dict.get("data"))
+        # The expanded data is shared, it must not be modified
+        if self._simple_data is None:
+            self._simple_data = self._expand_simple_data()
+        return self._simple_data
+
+    def _expand_simple_data(self):
+        data = self.request_dict.get("data")
         # If no data or not condensed in list, we just return it
         if not data:
             return {}
         if not isinstance(data, list):
             return data
-        data_order = self.data_format.get("data_order")
-        if not data_order:
-            raise ValueError("Data Format does not contain data_order")
-        clean_data = {}
-        data_len = len(data)
-        for idx, var in enumerate(data_order):
-            clean_data[var] = data[idx] if idx < data_len else None
-        data = data[data_len:]
-        if len(data) > 0:
-            raise ValueError(
-                "Additional variables not present in the data format: " + str(data)
-            )
-        return OpenPAYGOMetricsShared.convert_dict_keys_to_simple(clean_data)
+        return self._compiled_format.expand_data(data)
 
     def _get_simple_historical_data(self):
-        historical_data = copy.deepcopy(self.request_dict.get("historical_data"))
+        # We build new time steps, so the request is not modified
+        historical_data = self.request_dict.get("historical_data")
         if not historical_data:
             return []
-        historical_data_order = self.data_format.get("historical_data_order")
-        clean_historical_data = []
-        for time_step in historical_data:
-            time_step_data = {}
-            if isinstance(time_step, list):
-                if not historical_data_order:
-                    raise ValueError(
-                        "Data Format does not contain historical_data_order"
-                    )
-                timse_step_len = len(time_step)
-                for idx, var in enumerate(historical_data_order):
-                    if idx < timse_step_len:
-                        time_step_data[var] = time_step[idx]
-                time_step = time_step[timse_step_len:]
-                if len(time_step) > 0:
-                    raise ValueError(
-                        "Additional variables not present in the historical data format"
-                        ": " + str(time_step)
-                    )
-            elif isinstance(time_step, dict):
-                for key in time_step:
-                    if key.isdigit() and int(key) < len(historical_data_order):
-                        time_step_data[historical_data_order[int(key)]] = time_step[key]
-                    else:
-                        time_step_data[key] = time_step[key]
-            else:
-                raise ValueError("Invalid historical data step type: " + str(time_step))
-            clean_historical_data.append(time_step_data)
-        return clean_historical_data
+        return [
+            self._compiled_format.expand_historical_time_step(time_step)
+            for time_step in historical_data
+        ]
 
     def _fill_timestamp_in_historical_data(self, historical_data):
         last_timestamp = datetime.fromtimestamp(self.get_data_timestamp())
@@ -251,7 +263,41 @@ class MetricsResponseHandler(object):
             else:
                 if idx != 0:
                     last_timestamp = last_timestamp + timedelta(
-                        seconds=int(self.data_format.get("historical_data_interval"))
+                        seconds=int(self._compiled_format.historical_data_interval)
                     )
                 historical_data[idx]["timestamp"] = int(last_timestamp.timestamp())
         return historical_data
+
+    @classmethod
+    def _copy_json_value(cls, value):
+        # Faster than copy.deepcopy() for the values parsed from JSON, the dicts and
+        # lists only containing scalars (most of them) are copied at once
+        if isinstance(value, dict):
+            value_types = set(map(type, value.values()))
+            if dict in value_types or list in value_types:
+                return {key: cls._copy_json_value(item) for key, item in value.items()}
+            return dict(value)
+        if isinstance(value, list):
+            value_types = set(map(type, value))
+            if dict in value_types or list in value_types:
+                return [cls._copy_json_value(item) for item in value]
+            return list(value)
+        return value
+
+    @classmethod
+    def _get_read_only_view(cls, value):
+        # The dicts only containing scalars are not modified after being expanded, so
+        # the view can wrap them without copying
+        if isinstance(value, dict):
+            value_types = set(map(type, value.values()))
+            if dict in value_types or list in value_types:
+                value = {
+                    key: cls._get_read_only_view(item) for key, item in value.items()
+                }
+            return MappingProxyType(value)
+        if isinstance(value, list):
+            value_types = set(map(type, value))
+            if dict in value_types or list in value_types:
+                return tuple(cls._get_read_only_view(item) for item in value)
+            return tuple(value)
+        return value
@@ -1,7 +1,8 @@
 import codecs
-import json
+from functools import lru_cache
 
-import siphash
+from . import metrics_json
+from .siphash_key import get_siphash_key
 
 
 class AuthMethod(object):
@@ -64,7 +65,8 @@ class OpenPAYGOMetricsShared(object):
 
     @classmethod
     def convert_to_metrics_json(cls, data):
-        return json.dumps(data, separators=(",", ":"))
+        # The result is the same with every JSON backend, the signatures depend on it
+        return metrics_json.dumps(data)
 
     @classmethod
     def generate_response_signature_from_data(
@@ -89,19 +91,32 @@ class OpenPAYGOMetricsShared(object):
 
     @classmethod
     def generate_request_signature_from_data(cls, data, auth_method, secret_key):
+        signature_steps = cls.get_request_signature_steps(data, auth_method)
+        try:
+            input_string = next(signature_steps)
+            while True:
+                input_string = signature_steps.send(
+                    cls.generate_hash_string(input_string, secret_key)
+                )
+        except StopIteration as signature:
+            return auth_method + signature.value
+
+    @classmethod
+    def get_request_signature_steps(cls, data, auth_method):
+        # Yields the strings to hash one after the other, receiving their hash
+        # string, and returns the signature (without the auth method). This lets
+        # the signatures of many requests be computed step by step together.
         if auth_method == AuthMethod.SIMPLE_AUTH:
-            signature = cls.generate_hash_string(data.get("serial_number"), secret_key)
+            signature = yield data.get("serial_number")
         elif auth_method == AuthMethod.TIMESTAMP_AUTH:
             if not data.get("timestamp", None):
                 raise ValueError("Timestamp is required for Timestamp Auth")
-            signature = cls.generate_hash_string(
-                data.get("serial_number") + str(data.get("timestamp")), secret_key
-            )
+            signature = yield data.get("serial_number") + str(data.get("timestamp"))
         elif auth_method == AuthMethod.COUNTER_AUTH:
             if not data.get("request_count", None):
                 raise ValueError("Request Count is required for Counter Auth")
-            signature = cls.generate_hash_string(
-                data.get("serial_number") + str(data.get("request_count")), secret_key
+            signature = yield (
+                data.get("serial_number") + str(data.get("request_count"))
             )
         elif auth_method == AuthMethod.DATA_AUTH:
             payload = data.get("serial_number")
@@ -113,34 +128,27 @@ class OpenPAYGOMetricsShared(object):
                 payload += cls.convert_to_metrics_json(data.get("data", []))
             if data.get("historical_data"):
                 payload += cls.convert_to_metrics_json(data.get("historical_data", []))
-            signature = cls.generate_hash_string(payload, secret_key)
+            signature = yield payload
         elif auth_method == AuthMethod.RECURSIVE_DATA_AUTH:
             payload = data.get("serial_number")
-            payload = cls.generate_hash_string(payload, secret_key)
+            payload = yield payload
             if data.get("timestamp"):
-                payload = cls.generate_hash_string(
-                    payload + str(data.get("timestamp")), secret_key
-                )
+                payload = yield payload + str(data.get("timestamp"))
             if data.get("request_count"):
-                payload = cls.generate_hash_string(
-                    payload + str(data.get("request_count")), secret_key
-                )
-            payload = cls.generate_hash_string(
-                payload + cls.convert_to_metrics_json(data.get("data", [])), secret_key
-            )
+                payload = yield payload + str(data.get("request_count"))
+            payload = yield payload + cls.convert_to_metrics_json(data.get("data", []))
             for time_step_data in data.get("historical_data", []):
-                payload = cls.generate_hash_string(
-                    payload + cls.convert_to_metrics_json(time_step_data), secret_key
-                )
+                payload = yield payload + cls.convert_to_metrics_json(time_step_data)
             signature = payload
         else:
             raise ValueError("Invalid Authentication Method")
-        return auth_method + signature
+        return signature
 
     @classmethod
     def generate_hash_string(cls, input_string, secret_key):
-        key = cls.load_secret_key_from_hex(secret_key)
-        hash = siphash.SipHash_2_4(key, codecs.encode(input_string, "utf-8")).hash()
+        hash = load_siphash_key_from_hex(secret_key).hash(
+            codecs.encode(input_string, "utf-8")
+        )
         hash_string = "{:x}".format(hash)
         return hash_string
 
@@ -153,3 +161,9 @@ class OpenPAYGOMetricsShared(object):
                 "The secret key provided is not correctly formatted, it should be 32 "
                 "hexadecimal characters. "
             )
+
+
+@lru_cache(maxsize=4096)
+def load_siphash_key_from_hex(secret_key):
+    # The signatures hash many strings with the same key, so we only decode it once
+    return get_siphash_key(OpenPAYGOMetricsShared.load_secret_key_from_hex(secret_key))
@@ -0,0 +1,212 @@
+import csv
+import os
+import random
+import secrets
+import struct
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .token_numpy import NumpyTokenEngine
+from .token_shared import OpenPAYGOTokenShared
+
+# Each binary record holds the index of the device in the batch, its secret key and
+# its starting code
+PROVISIONING_RECORD_STRUCT = struct.Struct("<Q16sL")
+PROVISIONING_CSV_FIELDS = ["index", "secret_key", "starting_code"]
+SECRET_KEY_SIZE = 16
+
+
+class DeviceProvisioner(object):
+    # Generates the secret keys and starting codes of a batch of devices and writes
+    # them to a file, one record per device in the order of their index. The keys
+    # come from the RNG given (any object with a randbytes() method) or from a
+    # random.Random seeded with the seed given, otherwise from the system CSPRNG. A
+    # seeded Mersenne Twister is reproducible but predictable, so it should only be
+    # used for test batches. The starting codes are computed by chunks, with the
+    # NumpyTokenEngine when available, and spread on several processes if needed.
+
+    DEFAULT_CHUNK_SIZE = 65536
+
+    def __init__(
+        self,
+        path,
+        file_format=None,
+        seed=None,
+        rng=None,
+        processes=1,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+    ):
+        if rng is not None and seed is not None:
+            raise ValueError("Either the RNG or the seed can be provided, not both.")
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1.")
+        self.path = path
+        self.file_format = file_format or self._guess_format(path)
+        if self.file_format not in ("binary", "csv"):
+            raise ValueError("The file format must be binary or csv.")
+        if rng is None:
+            if seed is None:
+                rng = secrets.SystemRandom()
+            else:
+                rng = random.Random(seed)
+        self.rng = rng
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+    def provision(self, device_count, resume=False, progress=None):
+        # Writes the records of the devices up to device_count. When resuming, the
+        # records already in the file are kept (a partially written last record is
+        # dropped) and the RNG is advanced past their keys, so a seeded batch ends
+        # up identical to one written at once. The progress callback is called with
+        # the stats after each chunk written.
+        start_time = time.perf_counter()
+        written_count = self._prepare_file(resume)
+        self._skip_keys(written_count)
+        stats = {
+            "device_count": device_count,
+            "resumed_from": written_count,
+            "written": 0,
+            "elapsed": 0.0,
+            "devices_per_sec": 0.0,
+        }
+        mode = "ab" if self.file_format == "binary" else "a"
+        with open(self.path, mode, **self._get_open_kwargs()) as output_file:
+            if self.file_format == "csv" and not output_file.tell():
+                csv.writer(output_file).writerow(PROVISIONING_CSV_FIELDS)
+            for first_index, keys, starting_codes in self._generate_chunks(
+                written_count, device_count
+            ):
+                self._write_records(output_file, first_index, keys, starting_codes)
+                output_file.flush()
+                stats["written"] += len(keys)
+                stats["elapsed"] = time.perf_counter() - start_time
+                if stats["elapsed"] > 0:
+                    stats["devices_per_sec"] = stats["written"] / stats["elapsed"]
+                if progress is not None:
+                    progress(dict(stats))
+        stats["elapsed"] = time.perf_counter() - start_time
+        if stats["elapsed"] > 0:
+            stats["devices_per_sec"] = stats["written"] / stats["elapsed"]
+        return stats
+
+    @classmethod
+    def read_records(cls, path, file_format=None):
+        # Yields the (index, secret_key, starting_code) of each complete record, with
+        # the secret key in hexadecimal
+        file_format = file_format or cls._guess_format(path)
+        if file_format == "csv":
+            with open(path, newline="") as input_file:
+                for row in csv.DictReader(input_file):
+                    yield (
+                        int(row["index"]),
+                        row["secret_key"],
+                        int(row["starting_code"]),
+                    )
+            return
+        with open(path, "rb") as input_file:
+            while True:
+                record = input_file.read(PROVISIONING_RECORD_STRUCT.size)
+                if len(record) < PROVISIONING_RECORD_STRUCT.size:
+                    return
+                index, key, starting_code = PROVISIONING_RECORD_STRUCT.unpack(record)
+                yield index, key.hex(), starting_code
+
+    @classmethod
+    def generate_starting_codes(cls, keys):
+        # The keys are 16 bytes each, the starting codes are the same as the ones of
+        # OpenPAYGOTokenShared.generate_starting_code()
+        if NumpyTokenEngine.is_available():
+            return NumpyTokenEngine.generate_starting_codes(
+                *NumpyTokenEngine.load_keys(keys)
+            ).tolist()
+        return [OpenPAYGOTokenShared.generate_starting_code(key) for key in keys]
+
+    def _generate_chunks(self, first_index, device_count):
+        chunks = self._generate_key_chunks(first_index, device_count)
+        if self.processes <= 1:
+            for chunk_index, keys in chunks:
+                yield chunk_index, keys, self.generate_starting_codes(keys)
+            return
+        # We keep a bounded number of chunks in flight and write them in order
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            pending = deque()
+            for chunk_index, keys in chunks:
+                pending.append(
+                    (
+                        chunk_index,
+                        keys,
+                        executor.submit(self.generate_starting_codes, keys),
+                    )
+                )
+                if len(pending) >= self.processes * 2:
+                    chunk_index, keys, future = pending.popleft()
+                    yield chunk_index, keys, future.result()
+            while pending:
+                chunk_index, keys, future = pending.popleft()
+                yield chunk_index, keys, future.result()
+
+    def _generate_key_chunks(self, first_index, device_count):
+        for chunk_index in range(first_index, device_count, self.chunk_size):
+            key_count = min(self.chunk_size, device_count - chunk_index)
+            key_bytes = self.rng.randbytes(key_count * SECRET_KEY_SIZE)
+            key_chunk = [
+                key_bytes[i : i + SECRET_KEY_SIZE]
+                for i in range(0, len(key_bytes), SECRET_KEY_SIZE)
+            ]
+            yield chunk_index, key_chunk
+
+    def _skip_keys(self, key_count):
+        for chunk_index in range(0, key_count, self.chunk_size):
+            self.rng.randbytes(
+                min(self.chunk_size, key_count - chunk_index) * SECRET_KEY_SIZE
+            )
+
+    def _prepare_file(self, resume):
+        # Returns the number of complete records kept in the file
+        if not resume or not os.path.exists(self.path):
+            open(self.path, "wb").close()
+            return 0
+        if self.file_format == "binary":
+            record_count = os.path.getsize(self.path) // PROVISIONING_RECORD_STRUCT.size
+            with open(self.path, "r+b") as output_file:
+                output_file.truncate(record_count * PROVISIONING_RECORD_STRUCT.size)
+            return record_count
+        # We keep the lines up to the last complete one
+        with open(self.path, "rb") as output_file:
+            data = output_file.read()
+        complete_size = data.rfind(b"\n") + 1
+        with open(self.path, "r+b") as output_file:
+            output_file.truncate(complete_size)
+        return max(data[:complete_size].count(b"\n") - 1, 0)
+
+    def _write_records(self, output_file, first_index, keys, starting_codes):
+        if self.file_format == "binary":
+            output_file.write(
+                b"".join(
+                    PROVISIONING_RECORD_STRUCT.pack(index, key, starting_code)
+                    for index, key, starting_code in zip(
+                        range(first_index, first_index + len(keys)),
+                        keys,
+                        starting_codes,
+                    )
+                )
+            )
+            return
+        csv.writer(output_file).writerows(
+            (index, key.hex(), starting_code)
+            for index, key, starting_code in zip(
+                range(first_index, first_index + len(keys)), keys, starting_codes
+            )
+        )
+
+    def _get_open_kwargs(self):
+        if self.file_format == "csv":
+            return {"newline": ""}
+        return {}
+
+    @classmethod
+    def _guess_format(cls, path):
+        if str(path).endswith(".csv"):
+            return "csv"
+        return "binary"
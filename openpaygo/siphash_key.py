@@ -0,0 +1,173 @@
+import struct
+from functools import lru_cache
+
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+_KEY_STRUCT = struct.Struct("<QQ")
+_BLOCK_STRUCT = struct.Struct("<Q")
+_FINALIZATION_ROUNDS = ((0, 0, 0), (0, 0, 0))
+
+
+class SipHashKey(object):
+    # SipHash-2-4 with the initial state derived from the key computed only once.
+    # hash_u64() is specialised for the 8 bytes messages of the token chains (given
+    # as the little endian integer of the message) and skips any padding or
+    # buffering, hash() handles messages of any length. The 64 bits arithmetic of
+    # the rounds dominates in CPython, so hash_u64() is less than 2x faster than
+    # the siphash package (about 1.3 to 1.8x, see utils/benchmark_siphash.py). It
+    # removes that dependency but does not make the chain walks fast, the bulk work
+    # should go through the NumpyTokenEngine instead.
+    __slots__ = ("key", "v0", "v1", "v2", "v3", "first_e_rotated", "first_i")
+
+    def __init__(self, key):
+        if len(key) != 16:
+            raise ValueError("The secret key must be 16 bytes long.")
+        k0, k1 = _KEY_STRUCT.unpack(key)
+        self.key = key
+        self.v0 = k0 ^ 0x736F6D6570736575
+        self.v1 = k1 ^ 0x646F72616E646F6D
+        self.v2 = k0 ^ 0x6C7967656E657261
+        self.v3 = k1 ^ 0x7465646279746573
+        e = (self.v0 + self.v1) & _MASK_64
+        self.first_e_rotated = (e << 32) | (e >> 32)
+        self.first_i = (((self.v1 << 13) | (self.v1 >> 51)) & _MASK_64) ^ e
+
+    def hash_u64(self, message):
+        # The 2 rounds of each block and the 4 finalization rounds are unrolled (with
+        # the mask written as a constant rather than a global), and the first half
+        # round, which only depends on the key, is precomputed
+        d = self.v3 ^ message
+        i = self.first_i
+        f = self.v2 + d
+        j = (((d << 16) | (d >> 48)) ^ f) & 0xFFFFFFFFFFFFFFFF
+        h = (f + i) & 0xFFFFFFFFFFFFFFFF
+        k = self.first_e_rotated + j
+        m = (((i & 0x7FFFFFFFFFFF) << 17) | (i >> 47)) ^ h
+        o = (((j << 21) | (j >> 43)) ^ k) & 0xFFFFFFFFFFFFFFFF
+        p = (k + m) & 0xFFFFFFFFFFFFFFFF
+        q = (((m & 0x7FFFFFFFFFFFF) << 13) | (m >> 51)) ^ p
+        r = ((h << 32) | (h >> 32)) + o
+        s = (((o << 16) | (o >> 48)) ^ r) & 0xFFFFFFFFFFFFFFFF
+        t = (r + q) & 0xFFFFFFFFFFFFFFFF
+        a = (((p << 32) | (p >> 32)) + s) & 0xFFFFFFFFFFFFFFFF
+        b = (((q & 0x7FFFFFFFFFFF) << 17) | (q >> 47)) ^ t
+        c = ((t & 0xFFFFFFFF) << 32) | (t >> 32)
+        d = (((s & 0x7FFFFFFFFFF) << 21) | (s >> 43)) ^ a
+        a ^= message
+        d ^= 0x0800000000000000
+        e = (a + b) & 0xFFFFFFFFFFFFFFFF
+        i = (((b & 0x7FFFFFFFFFFFF) << 13) | (b >> 51)) ^ e
+        f = c + d
+        j = (((d << 16) | (d >> 48)) ^ f) & 0xFFFFFFFFFFFFFFFF
+        h = (f + i) & 0xFFFFFFFFFFFFFFFF
+        k = ((e << 32) | (e >> 32)) + j
+        m = (((i & 0x7FFFFFFFFFFF) << 17) | (i >> 47)) ^ h
+        o = (((j << 21) | (j >> 43)) ^ k) & 0xFFFFFFFFFFFFFFFF
+        p = (k + m) & 0xFFFFFFFFFFFFFFFF
+        q = (((m & 0x7FFFFFFFFFFFF) << 13) | (m >> 51)) ^ p
+        r = ((h << 32) | (h >> 32)) + o
+        s = (((o << 16) | (o >> 48)) ^ r) & 0xFFFFFFFFFFFFFFFF
+        t = (r + q) & 0xFFFFFFFFFFFFFFFF
+        a = (((p << 32) | (p >> 32)) + s) & 0xFFFFFFFFFFFFFFFF
+        b = (((q & 0x7FFFFFFFFFFF) << 17) | (q >> 47)) ^ t
+        c = ((t & 0xFFFFFFFF) << 32) | (t >> 32)
+        d = (((s & 0x7FFFFFFFFFF) << 21) | (s >> 43)) ^ a
+        a ^= 0x0800000000000000
+        c ^= 0xFF
+        e = (a + b) & 0xFFFFFFFFFFFFFFFF
+        i = (((b & 0x7FFFFFFFFFFFF) << 13) | (b >> 51)) ^ e
+        f = c + d
+        j = (((d << 16) | (d >> 48)) ^ f) & 0xFFFFFFFFFFFFFFFF
+        h = (f + i) & 0xFFFFFFFFFFFFFFFF
+        k = ((e << 32) | (e >> 32)) + j
+        m = (((i & 0x7FFFFFFFFFFF) << 17) | (i >> 47)) ^ h
+        o = (((j << 21) | (j >> 43)) ^ k) & 0xFFFFFFFFFFFFFFFF
+        p = (k + m) & 0xFFFFFFFFFFFFFFFF
+        q = (((m & 0x7FFFFFFFFFFFF) << 13) | (m >> 51)) ^ p
+        r = ((h << 32) | (h >> 32)) + o
+        s = (((o << 16) | (o >> 48)) ^ r) & 0xFFFFFFFFFFFFFFFF
+        t = (r + q) & 0xFFFFFFFFFFFFFFFF
+        a = (((p << 32) | (p >> 32)) + s) & 0xFFFFFFFFFFFFFFFF
+        b = (((q & 0x7FFFFFFFFFFF) << 17) | (q >> 47)) ^ t
+        c = ((t & 0xFFFFFFFF) << 32) | (t >> 32)
+        d = (((s & 0x7FFFFFFFFFF) << 21) | (s >> 43)) ^ a
+        e = (a + b) & 0xFFFFFFFFFFFFFFFF
+        i = (((b & 0x7FFFFFFFFFFFF) << 13) | (b >> 51)) ^ e
+        f = c + d
+        j = (((d << 16) | (d >> 48)) ^ f) & 0xFFFFFFFFFFFFFFFF
+        h = (f + i) & 0xFFFFFFFFFFFFFFFF
+        k = ((e << 32) | (e >> 32)) + j
+        m = (((i & 0x7FFFFFFFFFFF) << 17) | (i >> 47)) ^ h
+        o = (((j << 21) | (j >> 43)) ^ k) & 0xFFFFFFFFFFFFFFFF
+        p = (k + m) & 0xFFFFFFFFFFFFFFFF
+        q = (((m & 0x7FFFFFFFFFFFF) << 13) | (m >> 51)) ^ p
+        r = ((h << 32) | (h >> 32)) + o
+        s = (((o << 16) | (o >> 48)) ^ r) & 0xFFFFFFFFFFFFFFFF
+        t = (r + q) & 0xFFFFFFFFFFFFFFFF
+        # v0 is XORed into v3 in the last half round, so it cancels out
+        return (
+            (((s & 0x7FFFFFFFFFF) << 21) | (s >> 43))
+            ^ (((q & 0x7FFFFFFFFFFF) << 17) | (q >> 47))
+            ^ t
+            ^ ((t & 0xFFFFFFFF) << 32)
+            ^ (t >> 32)
+        )
+
+    def hash(self, data):
+        length = len(data)
+        tail_start = length - (length % 8)
+        last_block = ((length & 0xFF) << 56) | int.from_bytes(
+            data[tail_start:], "little"
+        )
+        schedule = [
+            (block, block, 0)
+            for (block,) in _BLOCK_STRUCT.iter_unpack(data[:tail_start])
+        ]
+        schedule.append((last_block, last_block, 0xFF))
+        return self._hash_blocks(tuple(schedule) + _FINALIZATION_ROUNDS)
+
+    def _hash_blocks(self, schedule):
+        # Each step of the schedule is 2 SipRounds, with the block XORed into v3
+        # before and into v0 after, and the finalization constant XORed into v2.
+        # Intermediate values are only masked to 64 bits where it is needed.
+        a = self.v0
+        b = self.v1
+        c = self.v2
+        d = self.v3
+        for before, after, final in schedule:
+            d ^= before
+            e = (a + b) & _MASK_64
+            i = (((b & 0x7FFFFFFFFFFFF) << 13) | (b >> 51)) ^ e
+            f = c + d
+            j = (((d << 16) | (d >> 48)) ^ f) & _MASK_64
+            h = (f + i) & _MASK_64
+            k = ((e << 32) | (e >> 32)) + j
+            m = (((i & 0x7FFFFFFFFFFF) << 17) | (i >> 47)) ^ h
+            o = (((j << 21) | (j >> 43)) ^ k) & _MASK_64
+            p = (k + m) & _MASK_64
+            q = (((m & 0x7FFFFFFFFFFFF) << 13) | (m >> 51)) ^ p
+            r = ((h << 32) | (h >> 32)) + o
+            s = (((o << 16) | (o >> 48)) ^ r) & _MASK_64
+            t = (r + q) & _MASK_64
+            a = (((p << 32) | (p >> 32)) + s) & _MASK_64
+            b = (((q & 0x7FFFFFFFFFFF) << 17) | (q >> 47)) ^ t
+            c = ((t & 0xFFFFFFFF) << 32) | (t >> 32)
+            d = (((s & 0x7FFFFFFFFFF) << 21) | (s >> 43)) ^ a
+            a ^= after
+            c ^= final
+        return a ^ b ^ c ^ d
+
+
+@lru_cache(maxsize=4096)
+def get_siphash_key(key):
+    # We keep the state of the most recently used keys, so that walking a chain only
+    # derives it once per device
+    return SipHashKey(key)
+
+
+def load_siphash_key(key):
+    # The chain walks derive the SipHashKey once and pass it instead of the secret
+    # key, so that they do not go through the shared cache (and its lock) at each
+    # step
+    if isinstance(key, SipHashKey):
+        return key
+    return get_siphash_key(key)
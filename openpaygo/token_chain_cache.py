@@ -0,0 +1,172 @@
+import threading
+from collections import OrderedDict
+
+from .siphash_key import get_siphash_key
+from .token_shared import OpenPAYGOTokenShared
+from .token_shared_extended import OpenPAYGOTokenSharedExtended
+
+
+class TokenChainCache(object):
+    # A chain is identified by the secret key, the starting code with the token base
+    # already put in it and whether it is an extended token chain. We store the code
+    # reached every checkpoint_interval counts, so that resuming a chain at any count
+    # costs at most checkpoint_interval hashes. The least recently used chains are
+    # dropped once we hold more than max_chains. A TokenCheckpointStore can be given
+    # to also use the checkpoints stored on disk (they are then kept in memory too),
+    # and a TokenCheckpointStoreWriter to store the checkpoints computed that are not
+    # in memory or in the store yet. The chains are spread on stripes, each with its
+    # own lock and its share of max_chains, so that threads working on different
+    # chains rarely wait for each other (with or without the GIL).
+
+    DEFAULT_CHECKPOINT_INTERVAL = 64
+    DEFAULT_MAX_CHAINS = 4096
+    DEFAULT_STRIPES = 16
+
+    def __init__(
+        self,
+        checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+        max_chains=DEFAULT_MAX_CHAINS,
+        checkpoint_store=None,
+        checkpoint_writer=None,
+        stripes=DEFAULT_STRIPES,
+    ):
+        if checkpoint_interval < 1:
+            raise ValueError("The checkpoint interval must be at least 1.")
+        if max_chains < 1:
+            raise ValueError("The cache must be able to hold at least 1 chain.")
+        self.checkpoint_interval = checkpoint_interval
+        self.max_chains = max_chains
+        if (
+            checkpoint_store is not None
+            and checkpoint_store.checkpoint_interval != checkpoint_interval
+        ):
+            raise ValueError(
+                "The checkpoint store must use the same checkpoint interval."
+            )
+        if (
+            checkpoint_writer is not None
+            and checkpoint_writer.checkpoint_interval != checkpoint_interval
+        ):
+            raise ValueError(
+                "The checkpoint writer must use the same checkpoint interval."
+            )
+        self.checkpoint_store = checkpoint_store
+        self.checkpoint_writer = checkpoint_writer
+        stripes = max(1, min(stripes, max_chains))
+        self._stripes = [
+            (
+                threading.Lock(),
+                OrderedDict(),
+                max_chains // stripes + (i < max_chains % stripes),
+            )
+            for i in range(stripes)
+        ]
+
+    def __len__(self):
+        return sum(len(chains) for _, chains, _ in self._stripes)
+
+    def clear(self):
+        for lock, chains, _ in self._stripes:
+            with lock:
+                chains.clear()
+
+    def get_code(self, start_code, key, count, extended_token=False):
+        code = None
+        for code in self.iter_codes(start_code, key, count, count + 1, extended_token):
+            pass
+        return code
+
+    def iter_codes(
+        self, start_code, key, first_count, last_count, extended_token=False
+    ):
+        # We yield the codes of the chain from first_count (included) to last_count
+        # (excluded), starting from the closest checkpoint we know of
+        if first_count >= last_count:
+            return
+        if extended_token:
+            generate_next_token = OpenPAYGOTokenSharedExtended.generate_next_token
+        else:
+            generate_next_token = OpenPAYGOTokenShared.generate_next_token
+        chain_key = (key, start_code, extended_token)
+        checkpoint = self._get_checkpoint(chain_key, first_count)
+        if checkpoint:
+            count, code = checkpoint
+        else:
+            count, code = 0, start_code
+        interval = self.checkpoint_interval
+        siphash_key = get_siphash_key(key)
+        while True:
+            if count >= first_count:
+                yield code
+            count += 1
+            if count >= last_count:
+                return
+            code = generate_next_token(code, siphash_key)
+            if count % interval == 0:
+                self._add_checkpoint(chain_key, count, code)
+
+    def _get_checkpoint(self, chain_key, count):
+        checkpoint = None
+        lock, chains, _ = self._get_stripe(chain_key)
+        with lock:
+            checkpoints = chains.get(chain_key)
+            if checkpoints:
+                chains.move_to_end(chain_key)
+                # The checkpoint at index i is the code for the count
+                # (i + 1) * interval, or None if we do not have it
+                index = min(count // self.checkpoint_interval, len(checkpoints))
+                while index and checkpoints[index - 1] is None:
+                    index -= 1
+                if index:
+                    checkpoint = (
+                        index * self.checkpoint_interval,
+                        checkpoints[index - 1],
+                    )
+        if self.checkpoint_store is not None:
+            # The store can have a closer checkpoint, for example in a new process
+            stored_checkpoint = self.checkpoint_store.get_checkpoint(chain_key, count)
+            if stored_checkpoint and (
+                not checkpoint or stored_checkpoint[0] > checkpoint[0]
+            ):
+                checkpoint = stored_checkpoint
+                self._set_checkpoint(chain_key, *stored_checkpoint)
+        return checkpoint
+
+    def _add_checkpoint(self, chain_key, count, code):
+        # A chain walked again from a checkpoint passes by the same checkpoints, we
+        # only write them to the store once
+        if (
+            self._set_checkpoint(chain_key, count, code)
+            and self.checkpoint_writer is not None
+            and not self._is_checkpoint_stored(chain_key, count)
+        ):
+            self.checkpoint_writer.add_checkpoint(chain_key, count, code)
+
+    def _set_checkpoint(self, chain_key, count, code):
+        # Returns whether the checkpoint was not in memory yet
+        index = count // self.checkpoint_interval
+        lock, chains, max_chains = self._get_stripe(chain_key)
+        with lock:
+            checkpoints = chains.get(chain_key)
+            if checkpoints is None:
+                checkpoints = []
+                chains[chain_key] = checkpoints
+                if len(chains) > max_chains:
+                    chains.popitem(last=False)
+            if index > len(checkpoints):
+                checkpoints.extend([None] * (index - len(checkpoints)))
+            elif checkpoints[index - 1] is not None:
+                return False
+            checkpoints[index - 1] = code
+            return True
+
+    def _is_checkpoint_stored(self, chain_key, count):
+        if self.checkpoint_store is None:
+            return False
+        stored_checkpoint = self.checkpoint_store.get_checkpoint(chain_key, count)
+        return stored_checkpoint is not None and stored_checkpoint[0] == count
+
+    def _get_stripe(self, chain_key):
+        # The start code includes the token base, so the chains of a device are
+        # spread on the stripes
+        return self._stripes[chain_key[1] % len(self._stripes)]
@@ -0,0 +1,241 @@
+import hashlib
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+STORE_MAGIC = b"OPGCHKP1"
+STORE_HEADER_STRUCT = struct.Struct(">8sLQ")
+# Each record holds the chain ID, the index of the checkpoint (its count divided by
+# the checkpoint interval) and the code. They are big endian, so that the records
+# sorted by their bytes are sorted by chain and index.
+STORE_RECORD_STRUCT = struct.Struct(">16sLQ")
+CHAIN_ID_SIZE = 16
+RECORD_PREFIX_SIZE = CHAIN_ID_SIZE + 4
+
+
+def get_chain_id(chain_key):
+    # The chains are identified by a hash of the secret key, the starting code with
+    # the token base already put in it and whether it is an extended token chain
+    key, start_code, extended_token = chain_key
+    return hashlib.blake2b(
+        key + start_code.to_bytes(8, "big") + bytes([bool(extended_token)]),
+        digest_size=CHAIN_ID_SIZE,
+    ).digest()
+
+
+class TokenCheckpointStore(object):
+    # Read only access to a file of chain checkpoints, memory mapped so that all the
+    # processes reading it share the same pages. The file starts with the records
+    # sorted by the last compaction, which are binary searched, followed by the
+    # records appended since then, which are loaded in memory.
+
+    def __init__(self, path):
+        self.path = path
+        self._mapping = None
+        self.refresh()
+
+    def __len__(self):
+        _, sorted_count, appended = self._mapping
+        return sorted_count + sum(map(len, appended.values()))
+
+    def refresh(self):
+        # We map the file again to see what was appended or compacted since it was
+        # opened. The new mapping replaces the old one at once, so that the threads
+        # reading at the same time keep using the old one until they are done
+        with open(self.path, "rb") as store_file:
+            store_mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, checkpoint_interval, sorted_count = STORE_HEADER_STRUCT.unpack_from(
+            store_mmap, 0
+        )
+        if magic != STORE_MAGIC:
+            store_mmap.close()
+            raise ValueError("The file is not a chain checkpoint store.")
+        appended = {}
+        record_count = (
+            len(store_mmap) - STORE_HEADER_STRUCT.size
+        ) // STORE_RECORD_STRUCT.size
+        for record_index in range(sorted_count, record_count):
+            chain_id, index, code = STORE_RECORD_STRUCT.unpack_from(
+                store_mmap, self._get_record_offset(record_index)
+            )
+            appended.setdefault(chain_id, {})[index] = code
+        self.checkpoint_interval = checkpoint_interval
+        self._mapping = (store_mmap, sorted_count, appended)
+
+    def close(self):
+        if self._mapping is not None:
+            store_mmap = self._mapping[0]
+            self._mapping = None
+            store_mmap.close()
+
+    def get_checkpoint(self, chain_key, count):
+        # Returns the (count, code) of the closest checkpoint at or below count, or
+        # None if the chain has none
+        store_mmap, sorted_count, appended = self._mapping
+        chain_id = get_chain_id(chain_key)
+        max_index = count // self.checkpoint_interval
+        best_index = self._find_sorted_index(
+            store_mmap, sorted_count, chain_id, max_index
+        )
+        best_code = None
+        if best_index:
+            best_index, best_code = best_index
+        else:
+            best_index = 0
+        for index, code in appended.get(chain_id, {}).items():
+            if best_index < index <= max_index:
+                best_index, best_code = index, code
+        if not best_index:
+            return None
+        return best_index * self.checkpoint_interval, best_code
+
+    @classmethod
+    def _find_sorted_index(cls, store_mmap, sorted_count, chain_id, max_index):
+        # We look for the last sorted record at or below (chain_id, max_index)
+        target = chain_id + max_index.to_bytes(4, "big")
+        low = 0
+        high = sorted_count
+        while low < high:
+            middle = (low + high) // 2
+            offset = cls._get_record_offset(middle)
+            if store_mmap[offset : offset + RECORD_PREFIX_SIZE] <= target:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        record_chain_id, index, code = STORE_RECORD_STRUCT.unpack_from(
+            store_mmap, cls._get_record_offset(low - 1)
+        )
+        if record_chain_id != chain_id or index == 0:
+            return None
+        return index, code
+
+    @classmethod
+    def _get_record_offset(cls, record_index):
+        return STORE_HEADER_STRUCT.size + record_index * STORE_RECORD_STRUCT.size
+
+
+class TokenCheckpointStoreWriter(object):
+    # Appends checkpoints at the end of the store file, and compacts it by sorting
+    # the records (without duplicates) into a new file replacing the old one. Each
+    # record is appended with a single unbuffered write, so several processes can
+    # append to the same store. The appends hold a shared lock on the file and the
+    # compaction an exclusive one, and a writer whose file was replaced by the
+    # compaction of another one opens the new file before appending, so no record
+    # is lost. Without fcntl (on Windows), the records appended by other processes
+    # during a compaction can still be lost.
+
+    DEFAULT_CHECKPOINT_INTERVAL = 64
+
+    def __init__(self, path, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        if checkpoint_interval < 1:
+            raise ValueError("The checkpoint interval must be at least 1.")
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, "wb") as store_file:
+                store_file.write(
+                    STORE_HEADER_STRUCT.pack(STORE_MAGIC, checkpoint_interval, 0)
+                )
+        with open(path, "rb") as store_file:
+            magic, self.checkpoint_interval, _ = STORE_HEADER_STRUCT.unpack(
+                store_file.read(STORE_HEADER_STRUCT.size)
+            )
+        if magic != STORE_MAGIC:
+            raise ValueError("The file is not a chain checkpoint store.")
+        if self.checkpoint_interval != checkpoint_interval:
+            raise ValueError(
+                "The store uses a checkpoint interval of {}.".format(
+                    self.checkpoint_interval
+                )
+            )
+        self._file = open(path, "ab", buffering=0)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def add_checkpoint(self, chain_key, count, code):
+        if count <= 0 or count % self.checkpoint_interval:
+            raise ValueError("The count must be a multiple of the checkpoint interval.")
+        record = STORE_RECORD_STRUCT.pack(
+            get_chain_id(chain_key), count // self.checkpoint_interval, code
+        )
+        while True:
+            self._lock_file(self._file, exclusive=False)
+            try:
+                if self._is_current_file(self._file):
+                    self._file.write(record)
+                    return
+            finally:
+                self._unlock_file(self._file)
+            # The store was compacted by another writer
+            self._file.close()
+            self._file = open(self.path, "ab", buffering=0)
+
+    def compact(self):
+        store_file = self._open_locked_file()
+        try:
+            self._compact(store_file)
+        finally:
+            # The lock is released with the file, once the new one replaced it
+            store_file.close()
+        self.close()
+        self._file = open(self.path, "ab", buffering=0)
+
+    def _compact(self, store_file):
+        data = store_file.read()
+        records = {}
+        for chain_id, index, code in STORE_RECORD_STRUCT.iter_unpack(
+            data[
+                STORE_HEADER_STRUCT.size : len(data)
+                - (len(data) - STORE_HEADER_STRUCT.size) % STORE_RECORD_STRUCT.size
+            ]
+        ):
+            records[(chain_id, index)] = code
+        temporary_path = "{}.tmp".format(self.path)
+        with open(temporary_path, "wb") as store_file:
+            store_file.write(
+                STORE_HEADER_STRUCT.pack(
+                    STORE_MAGIC, self.checkpoint_interval, len(records)
+                )
+            )
+            for (chain_id, index), code in sorted(records.items()):
+                store_file.write(STORE_RECORD_STRUCT.pack(chain_id, index, code))
+        # The readers keep the old file until they refresh
+        os.replace(temporary_path, self.path)
+
+    def _open_locked_file(self):
+        # We lock the current store file, which can be replaced while we wait
+        while True:
+            store_file = open(self.path, "rb")
+            self._lock_file(store_file, exclusive=True)
+            if self._is_current_file(store_file):
+                return store_file
+            store_file.close()
+
+    def _is_current_file(self, store_file):
+        file_stat = os.fstat(store_file.fileno())
+        path_stat = os.stat(self.path)
+        return (file_stat.st_dev, file_stat.st_ino) == (
+            path_stat.st_dev,
+            path_stat.st_ino,
+        )
+
+    @classmethod
+    def _lock_file(cls, store_file, exclusive):
+        if fcntl is not None:
+            fcntl.flock(
+                store_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            )
+
+    @classmethod
+    def _unlock_file(cls, store_file):
+        if fcntl is not None:
+            fcntl.flock(store_file.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,69 @@
+from .token_chain_cache import TokenChainCache
+from .token_decode import OpenPAYGOTokenDecoder
+from .token_encode import OpenPAYGOTokenEncoder
+from .token_shared import OpenPAYGOTokenShared, TokenType
+
+
+class DeviceTokenContext(object):
+    # Holds everything about a device that generate_token() and decode_token() would
+    # otherwise recompute on every call (decoded key, starting code) together with
+    # its configuration and the chain cache, so it can be created once per device and
+    # reused for a burst of tokens.
+    __slots__ = (
+        "key",
+        "starting_code",
+        "value_divider",
+        "restricted_digit_set",
+        "extended_token",
+        "chain_cache",
+        "invalid_token_cache",
+    )
+
+    def __init__(
+        self,
+        secret_key,
+        starting_code=None,
+        value_divider=1,
+        restricted_digit_set=False,
+        extended_token=False,
+        chain_cache=None,
+        invalid_token_cache=None,
+    ):
+        self.key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
+        if not starting_code:
+            # We generate the starting code from the key if not provided
+            starting_code = OpenPAYGOTokenShared.generate_starting_code(self.key)
+        self.starting_code = starting_code
+        self.value_divider = value_divider
+        self.restricted_digit_set = restricted_digit_set
+        self.extended_token = extended_token
+        if chain_cache is None:
+            chain_cache = TokenChainCache()
+        self.chain_cache = chain_cache
+        self.invalid_token_cache = invalid_token_cache
+
+    def generate(self, count, value=None, token_type=TokenType.ADD_TIME):
+        return OpenPAYGOTokenEncoder._generate_token_from_key(
+            self.key,
+            self.starting_code,
+            count,
+            value,
+            token_type,
+            self.value_divider,
+            self.restricted_digit_set,
+            self.extended_token,
+            self.chain_cache,
+        )
+
+    def decode(self, token, count, used_counts=None):
+        return OpenPAYGOTokenDecoder._decode_token_from_key(
+            token,
+            self.key,
+            self.starting_code,
+            count,
+            used_counts,
+            self.value_divider,
+            self.restricted_digit_set,
+            self.chain_cache,
+            self.invalid_token_cache,
+        )
@@ -1,11 +1,22 @@
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+from .siphash_key import get_siphash_key
+from .token_numpy import NumpyTokenEngine, np
 from .token_shared import OpenPAYGOTokenShared, TokenType
 from .token_shared_extended import OpenPAYGOTokenSharedExtended
 
+USED_COUNTS_MASK_STRUCT = struct.Struct(">IH")
+
 
 class OpenPAYGOTokenDecoder(object):
     MAX_TOKEN_JUMP = 64
     MAX_TOKEN_JUMP_COUNTER_SYNC = 100
     MAX_UNUSED_OLDER_TOKENS = 8 * 2
+    # Walking the chains with NumPy costs about as much per step as hashing a dozen
+    # codes one by one, so it is only used with enough token bases
+    NUMPY_MIN_TOKEN_BASES = 16
+    NUMPY_BLOCK_SIZE = 1024
 
     @classmethod
     def decode_token(
@@ -17,26 +28,46 @@ class OpenPAYGOTokenDecoder(object):
         starting_code=None,
         value_divider=1,
         restricted_digit_set=False,
+        chain_cache=None,
+        invalid_token_cache=None,
     ):
         secret_key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
         if not starting_code:
             # We generate the starting code from the key if not provided
             starting_code = OpenPAYGOTokenShared.generate_starting_code(secret_key)
-        if not restricted_digit_set:
-            if len(token) <= 9:
-                extended_token = False
-            elif len(token) <= 12:
-                extended_token = True
-            else:
-                raise ValueError("Token is too long")
-        elif restricted_digit_set:
-            if len(token) <= 15:
-                extended_token = False
-            elif len(token) <= 20:
-                extended_token = True
-            else:
-                raise ValueError("Token is too long")
+        return cls._decode_token_from_key(
+            token,
+            secret_key,
+            starting_code,
+            count,
+            used_counts,
+            value_divider,
+            restricted_digit_set,
+            chain_cache,
+            invalid_token_cache,
+        )
+
+    @classmethod
+    def _decode_token_from_key(
+        cls,
+        token,
+        key,
+        starting_code,
+        count,
+        used_counts,
+        value_divider,
+        restricted_digit_set,
+        chain_cache,
+        invalid_token_cache=None,
+    ):
+        extended_token = cls._is_extended_token(token, restricted_digit_set)
         token = int(token)
+        if invalid_token_cache is not None:
+            # An invalid token does not depend on the used counts, only on the
+            # counts that can be reached
+            invalid_entry = (key, starting_code, token, restricted_digit_set, count)
+            if invalid_token_cache.contains(invalid_entry):
+                return None, TokenType.INVALID, None, None
         if not extended_token:
             (
                 value,
@@ -46,10 +77,11 @@ class OpenPAYGOTokenDecoder(object):
             ) = cls.get_activation_value_count_and_type_from_token(
                 token,
                 starting_code,
-                secret_key,
+                key,
                 count,
                 restricted_digit_set,
                 used_counts,
+                chain_cache,
             )
         else:
             (
@@ -60,15 +92,340 @@ class OpenPAYGOTokenDecoder(object):
             ) = cls.get_activation_value_count_from_extended_token(
                 token,
                 starting_code,
-                secret_key,
+                key,
                 count,
                 restricted_digit_set,
                 used_counts,
+                chain_cache,
             )
+        if token_type == TokenType.INVALID and invalid_token_cache is not None:
+            if cls._is_token_impossible(
+                token, starting_code, restricted_digit_set, extended_token
+            ):
+                invalid_token_cache.add_prescreen_rejection(invalid_entry)
+            else:
+                invalid_token_cache.add(invalid_entry)
         if value and value_divider:
             value = value / value_divider
         return value, token_type, count, updated_counts
 
+    @classmethod
+    def _is_extended_token(cls, token, restricted_digit_set):
+        if not restricted_digit_set:
+            if len(token) <= 9:
+                return False
+            elif len(token) <= 12:
+                return True
+            else:
+                raise ValueError("Token is too long")
+        elif restricted_digit_set:
+            if len(token) <= 15:
+                return False
+            elif len(token) <= 20:
+                return True
+            else:
+                raise ValueError("Token is too long")
+
+    @classmethod
+    def decode_tokens(
+        cls,
+        tokens,
+        secret_key,
+        count,
+        used_counts=None,
+        starting_code=None,
+        value_divider=1,
+        restricted_digit_set=False,
+        chain_cache=None,
+    ):
+        # We decode the tokens in order, as if decode_token() was called for each of
+        # them with the count and used counts updated after each valid token. The
+        # tokens with the same token base share the same walk of their chain, which
+        # is only extended as far as needed. Returns the list of results of each
+        # token, the updated count and the updated used counts.
+        secret_key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
+        if not starting_code:
+            # We generate the starting code from the key if not provided
+            starting_code = OpenPAYGOTokenShared.generate_starting_code(secret_key)
+        tokens = list(tokens)
+        # The count can only move forward by the largest jump for each token
+        max_chain_count = count + cls.MAX_TOKEN_JUMP_COUNTER_SYNC * (len(tokens) + 1)
+        chain_walks = {}
+        results = []
+        for token in tokens:
+            extended_token = cls._is_extended_token(token, restricted_digit_set)
+            value, token_type, token_count, updated_counts = cls._decode_token_walked(
+                int(token),
+                secret_key,
+                starting_code,
+                count,
+                used_counts,
+                restricted_digit_set,
+                extended_token,
+                chain_cache,
+                chain_walks,
+                max_chain_count,
+            )
+            if token_type not in [TokenType.ALREADY_USED, TokenType.INVALID]:
+                if (
+                    token_count > count
+                    or value == OpenPAYGOTokenShared.COUNTER_SYNC_VALUE
+                ):
+                    count = token_count
+                used_counts = updated_counts
+            if value and value_divider:
+                value = value / value_divider
+            results.append((value, token_type, token_count, updated_counts))
+        return results, count, used_counts
+
+    @classmethod
+    def find_token_counts(
+        cls,
+        tokens,
+        secret_key,
+        max_count=100000,
+        starting_code=None,
+        value_divider=1,
+        restricted_digit_set=False,
+        processes=None,
+        use_numpy=None,
+    ):
+        # We look for the tokens in the chain from the count 0 to max_count, without
+        # knowing the count of the device. The tokens with the same token base are
+        # matched during a single walk of their chain, the chains of the different
+        # bases can be walked in lockstep with NumPy and spread on several processes.
+        # Returns for each token the list of (count, token_type, value) where it
+        # appears in the chain.
+        secret_key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
+        if not starting_code:
+            # We generate the starting code from the key if not provided
+            starting_code = OpenPAYGOTokenShared.generate_starting_code(secret_key)
+        tokens = list(tokens)
+        if use_numpy is None:
+            use_numpy = NumpyTokenEngine.is_available()
+        extended_tokens = [
+            cls._is_extended_token(token, restricted_digit_set) for token in tokens
+        ]
+        codes = [int(token) for token in tokens]
+        if restricted_digit_set:
+            codes = cls._convert_from_4_digit_tokens(codes, extended_tokens, use_numpy)
+        token_indexes = {}
+        for index, (extended_token, code) in enumerate(zip(extended_tokens, codes)):
+            shared = cls._get_shared(extended_token)
+            chain_tokens = token_indexes.setdefault(
+                (extended_token, shared.get_token_base(code)), {}
+            )
+            chain_tokens.setdefault(code, []).append(index)
+        chains = [
+            (extended_token, token_base, set(chain_tokens))
+            for (extended_token, token_base), chain_tokens in token_indexes.items()
+        ]
+        if processes and processes > 1 and len(chains) > 1:
+            chunks = [chains[i::processes] for i in range(processes)]
+            chunks = [chunk for chunk in chunks if chunk]
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                chunks_matches = list(
+                    executor.map(
+                        cls._find_chains_token_counts,
+                        [secret_key] * len(chunks),
+                        [starting_code] * len(chunks),
+                        chunks,
+                        [max_count] * len(chunks),
+                        [use_numpy] * len(chunks),
+                    )
+                )
+        else:
+            chunks_matches = [
+                cls._find_chains_token_counts(
+                    secret_key, starting_code, chains, max_count, use_numpy
+                )
+            ]
+        results = [[] for _ in range(len(tokens))]
+        for matches in chunks_matches:
+            for extended_token, token_base, code, count in matches:
+                shared = cls._get_shared(extended_token)
+                if extended_token:
+                    value = cls._decode_base_extended(
+                        shared.get_token_base(starting_code), token_base
+                    )
+                    this_type = TokenType.SET_TIME if count % 2 else TokenType.ADD_TIME
+                else:
+                    value = cls._decode_base(
+                        shared.get_token_base(starting_code), token_base
+                    )
+                    this_type = cls._get_token_type(count, value)
+                if value and value_divider:
+                    value = value / value_divider
+                for index in token_indexes[(extended_token, token_base)][code]:
+                    results[index].append((count, this_type, value))
+        for token_results in results:
+            token_results.sort()
+        return results
+
+    @classmethod
+    def _convert_from_4_digit_tokens(cls, codes, extended_tokens, use_numpy):
+        # The restricted tokens of each kind are converted together with NumPy
+        if not use_numpy:
+            return [
+                cls._get_shared(extended_token).convert_from_4_digit_token(code)
+                for code, extended_token in zip(codes, extended_tokens)
+            ]
+        codes = list(codes)
+        for extended_token in [False, True]:
+            indexes = [
+                index
+                for index, this_extended_token in enumerate(extended_tokens)
+                if this_extended_token == extended_token
+            ]
+            if not indexes:
+                continue
+            converted_codes = NumpyTokenEngine.convert_from_4_digit_tokens(
+                [codes[index] for index in indexes], extended_token
+            ).tolist()
+            for index, code in zip(indexes, converted_codes):
+                codes[index] = code
+        return codes
+
+    @classmethod
+    def _find_chains_token_counts(
+        cls, key, starting_code, chains, max_count, use_numpy
+    ):
+        # Returns the (extended_token, token_base, token, count) of all the tokens
+        # found in the chains
+        matches = []
+        for extended_token in [False, True]:
+            these_chains = [chain for chain in chains if chain[0] == extended_token]
+            if not these_chains:
+                continue
+            if use_numpy and len(these_chains) >= cls.NUMPY_MIN_TOKEN_BASES:
+                matches += cls._find_token_counts_numpy(
+                    key, starting_code, these_chains, max_count, extended_token
+                )
+                continue
+            shared = cls._get_shared(extended_token)
+            for _, token_base, chain_tokens in these_chains:
+                current_code = shared.put_base_in_token(starting_code, token_base)
+                for count, chain_code in enumerate(
+                    cls._walk_chain(current_code, key, 0, max_count + 1, extended_token)
+                ):
+                    masked_token = shared.put_base_in_token(chain_code, token_base)
+                    if masked_token in chain_tokens:
+                        matches.append(
+                            (extended_token, token_base, masked_token, count)
+                        )
+        return matches
+
+    @classmethod
+    def _find_token_counts_numpy(
+        cls, key, starting_code, chains, max_count, extended_token
+    ):
+        # We walk the chains of all the bases in lockstep, and look for the tokens in
+        # blocks of steps at once
+        if extended_token:
+            offset = OpenPAYGOTokenSharedExtended.TOKEN_VALUE_OFFSET_EXTENDED
+            generate_next_tokens = NumpyTokenEngine.generate_next_extended_tokens
+        else:
+            offset = OpenPAYGOTokenShared.TOKEN_VALUE_OFFSET
+            generate_next_tokens = NumpyTokenEngine.generate_next_tokens
+        offset = np.uint64(offset)
+        k0, k1 = NumpyTokenEngine.load_keys([key] * len(chains))
+        token_bases = np.array([chain[1] for chain in chains], dtype=np.uint64)
+        codes = np.uint64(starting_code) - np.uint64(starting_code) % offset
+        codes = codes + token_bases
+        all_tokens = np.array(
+            sorted(set().union(*[chain[2] for chain in chains])), dtype=np.uint64
+        )
+        matches = []
+        for block_start in range(0, max_count + 1, cls.NUMPY_BLOCK_SIZE):
+            steps = min(cls.NUMPY_BLOCK_SIZE, max_count + 1 - block_start)
+            masked_tokens = np.empty((steps, len(chains)), dtype=np.uint64)
+            for step in range(steps):
+                masked_tokens[step] = codes - codes % offset + token_bases
+                codes = generate_next_tokens(codes, k0, k1)
+            for step, chain_index in zip(
+                *np.nonzero(np.isin(masked_tokens, all_tokens))
+            ):
+                masked_token = int(masked_tokens[step, chain_index])
+                _, token_base, chain_tokens = chains[chain_index]
+                if masked_token in chain_tokens:
+                    matches.append(
+                        (
+                            extended_token,
+                            token_base,
+                            masked_token,
+                            block_start + int(step),
+                        )
+                    )
+        return matches
+
+    @classmethod
+    def _get_shared(cls, extended_token):
+        if extended_token:
+            return OpenPAYGOTokenSharedExtended
+        return OpenPAYGOTokenShared
+
+    @classmethod
+    def _decode_token_walked(
+        cls,
+        token,
+        key,
+        starting_code,
+        last_count,
+        used_counts,
+        restricted_digit_set,
+        extended_token,
+        chain_cache,
+        chain_walks,
+        max_chain_count,
+    ):
+        # Same as the get_activation_* methods, using the chain walks of the token
+        # bases kept in chain_walks
+        if extended_token:
+            shared = OpenPAYGOTokenSharedExtended
+            decode_base = cls._decode_base_extended
+        else:
+            shared = OpenPAYGOTokenShared
+            decode_base = cls._decode_base
+        if restricted_digit_set:
+            token = shared.convert_from_4_digit_token(token)
+        token_base = shared.get_token_base(token)
+        value = decode_base(shared.get_token_base(starting_code), token_base)
+        if cls._is_value_impossible(token, value, extended_token):
+            return None, TokenType.INVALID, None, None
+        if not extended_token and value == OpenPAYGOTokenShared.COUNTER_SYNC_VALUE:
+            max_count_try = last_count + cls.MAX_TOKEN_JUMP_COUNTER_SYNC + 1
+        else:
+            max_count_try = last_count + cls.MAX_TOKEN_JUMP + 1
+        chain_walk = chain_walks.get((token_base, extended_token))
+        if chain_walk is None:
+            codes = cls._iter_chain_codes(
+                shared.put_base_in_token(starting_code, token_base),
+                key,
+                0,
+                max_chain_count,
+                extended_token,
+                chain_cache,
+            )
+            chain_walk = _TokenBaseChainWalk(
+                codes, shared.put_base_in_token, token_base
+            )
+            chain_walks[(token_base, extended_token)] = chain_walk
+        valid_older_token = False
+        for count in chain_walk.get_counts(token, max_count_try):
+            if extended_token:
+                this_type = TokenType.SET_TIME if count % 2 else TokenType.ADD_TIME
+            else:
+                this_type = cls._get_token_type(count, value)
+            if cls._count_is_valid(count, last_count, value, this_type, used_counts):
+                updated_counts = cls.update_used_counts(
+                    used_counts, value, count, this_type
+                )
+                return value, this_type, count, updated_counts
+            valid_older_token = True
+        if valid_older_token:
+            return None, TokenType.ALREADY_USED, None, None
+        return None, TokenType.INVALID, None, None
+
     @classmethod
     def get_activation_value_count_and_type_from_token(
         cls,
@@ -78,6 +435,7 @@ class OpenPAYGOTokenDecoder(object):
         last_count,
         restricted_digit_set=False,
         used_counts=None,
+        chain_cache=None,
     ):
         if restricted_digit_set:
             token = OpenPAYGOTokenShared.convert_from_4_digit_token(token)
@@ -94,6 +452,8 @@ class OpenPAYGOTokenDecoder(object):
         value = cls._decode_base(
             starting_code_base, token_base
         )  # If there is a match we get the value from the token
+        if cls._is_value_impossible(token, value, False):
+            return None, TokenType.INVALID, None, None
         # We try all combination up until last_count + TOKEN_JUMP, or to the larger jump
         # if syncing counter.
         # We could start directly the loop at the last count if we kept the token value
@@ -102,19 +462,16 @@ class OpenPAYGOTokenDecoder(object):
             max_count_try = last_count + cls.MAX_TOKEN_JUMP_COUNTER_SYNC + 1
         else:
             max_count_try = last_count + cls.MAX_TOKEN_JUMP + 1
-        for count in range(0, max_count_try):
+        # With a chain cache, we only walk the counts that could still be accepted
+        first_count = cls._get_first_count_to_try(last_count, value, chain_cache)
+        codes = cls._iter_chain_codes(
+            current_code, key, first_count, max_count_try, False, chain_cache
+        )
+        for count, chain_code in zip(range(first_count, max_count_try), codes):
             masked_token = OpenPAYGOTokenShared.put_base_in_token(
-                current_code, token_base
+                chain_code, token_base
             )
-            if count % 2:
-                if value == OpenPAYGOTokenShared.COUNTER_SYNC_VALUE:
-                    this_type = TokenType.COUNTER_SYNC
-                elif value == OpenPAYGOTokenShared.PAYG_DISABLE_VALUE:
-                    this_type = TokenType.DISABLE_PAYG
-                else:
-                    this_type = TokenType.SET_TIME
-            else:
-                this_type = TokenType.ADD_TIME
+            this_type = cls._get_token_type(count, value)
             if masked_token == token:
                 if cls._count_is_valid(
                     count, last_count, value, this_type, used_counts
@@ -125,13 +482,217 @@ class OpenPAYGOTokenDecoder(object):
                     return value, this_type, count, updated_counts
                 else:
                     valid_older_token = True
-            current_code = OpenPAYGOTokenShared.generate_next_token(
-                current_code, key
-            )  # If not we go to the next token
+        if not valid_older_token and first_count > 0:
+            # The older counts can only tell us if the token was already used
+            valid_older_token = cls._is_token_in_chain(
+                token, token_base, current_code, key, first_count, False, chain_cache
+            )
         if valid_older_token:
             return None, TokenType.ALREADY_USED, None, None
         return None, TokenType.INVALID, None, None
 
+    @classmethod
+    def _get_token_type(cls, count, value):
+        if count % 2:
+            if value == OpenPAYGOTokenShared.COUNTER_SYNC_VALUE:
+                return TokenType.COUNTER_SYNC
+            elif value == OpenPAYGOTokenShared.PAYG_DISABLE_VALUE:
+                return TokenType.DISABLE_PAYG
+            return TokenType.SET_TIME
+        return TokenType.ADD_TIME
+
+    @classmethod
+    def suggest_token_corrections(
+        cls,
+        token,
+        secret_key,
+        count,
+        used_counts=None,
+        starting_code=None,
+        value_divider=1,
+        restricted_digit_set=False,
+        chain_cache=None,
+    ):
+        # We try every single digit substitution and every transposition of 2
+        # adjacent digits of a standard token. The candidates with the same token base
+        # share the same chain, so we walk the chain of each base only once and match
+        # all of its candidates at each step. Returns the list of (token, value,
+        # token_type, count) of the candidates that would be accepted, followed by
+        # the ones already used, with the closest counts first.
+        secret_key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
+        if not starting_code:
+            # We generate the starting code from the key if not provided
+            starting_code = OpenPAYGOTokenShared.generate_starting_code(secret_key)
+        candidates_by_base = {}
+        for candidate in cls._get_token_corrections(token, restricted_digit_set):
+            code = int(candidate)
+            if restricted_digit_set:
+                code = OpenPAYGOTokenShared.convert_from_4_digit_token(code)
+            token_base = OpenPAYGOTokenShared.get_token_base(code)
+            candidates_by_base.setdefault(token_base, {})[code] = candidate
+        starting_code_base = OpenPAYGOTokenShared.get_token_base(starting_code)
+        corrections = []
+        for token_base, candidates in candidates_by_base.items():
+            value = cls._decode_base(starting_code_base, token_base)
+            for code in list(candidates):
+                if cls._is_value_impossible(code, value, False):
+                    del candidates[code]
+            if not candidates:
+                continue
+            if value == OpenPAYGOTokenShared.COUNTER_SYNC_VALUE:
+                max_count_try = count + cls.MAX_TOKEN_JUMP_COUNTER_SYNC + 1
+            else:
+                max_count_try = count + cls.MAX_TOKEN_JUMP + 1
+            current_code = OpenPAYGOTokenShared.put_base_in_token(
+                starting_code, token_base
+            )
+            codes = cls._iter_chain_codes(
+                current_code, secret_key, 0, max_count_try, False, chain_cache
+            )
+            matches = {}
+            for this_count, chain_code in zip(range(max_count_try), codes):
+                masked_token = OpenPAYGOTokenShared.put_base_in_token(
+                    chain_code, token_base
+                )
+                if masked_token not in candidates:
+                    continue
+                this_type = cls._get_token_type(this_count, value)
+                if matches.get(masked_token, (None,))[0] not in [
+                    None,
+                    TokenType.ALREADY_USED,
+                ]:
+                    continue
+                if cls._count_is_valid(
+                    this_count, count, value, this_type, used_counts
+                ):
+                    matches[masked_token] = (this_type, this_count)
+                else:
+                    matches[masked_token] = (TokenType.ALREADY_USED, None)
+            for code, (this_type, this_count) in matches.items():
+                if this_type == TokenType.ALREADY_USED:
+                    corrections.append((candidates[code], None, this_type, None))
+                    continue
+                this_value = value
+                if value and value_divider:
+                    this_value = value / value_divider
+                corrections.append(
+                    (candidates[code], this_value, this_type, this_count)
+                )
+        corrections.sort(
+            key=lambda correction: (
+                correction[2] == TokenType.ALREADY_USED,
+                abs((correction[3] or 0) - count - 1),
+                correction[0],
+            )
+        )
+        return corrections
+
+    @classmethod
+    def _get_token_corrections(cls, token, restricted_digit_set):
+        token = str(token)
+        if len(token) != (15 if restricted_digit_set else 9) or not token.isdigit():
+            raise ValueError(
+                "Corrections can only be suggested for the 9 digits tokens (or 15 "
+                "digits with the restricted digit set)."
+            )
+        digits = "1234" if restricted_digit_set else "0123456789"
+        corrections = set()
+        for i, digit in enumerate(token):
+            for other_digit in digits:
+                if other_digit != digit:
+                    corrections.add(token[:i] + other_digit + token[i + 1 :])
+            if i + 1 < len(token) and token[i + 1] != digit:
+                corrections.add(token[:i] + token[i + 1] + digit + token[i + 2 :])
+        return sorted(corrections)
+
+    @classmethod
+    def _is_token_impossible(
+        cls, token, starting_code, restricted_digit_set, extended_token
+    ):
+        if extended_token:
+            shared = OpenPAYGOTokenSharedExtended
+            decode_base = cls._decode_base_extended
+        else:
+            shared = OpenPAYGOTokenShared
+            decode_base = cls._decode_base
+        if restricted_digit_set:
+            token = shared.convert_from_4_digit_token(token)
+        value = decode_base(
+            shared.get_token_base(starting_code), shared.get_token_base(token)
+        )
+        return cls._is_value_impossible(token, value, extended_token)
+
+    @classmethod
+    def _is_value_impossible(cls, token, value, extended_token):
+        # No token of the chain can be larger than the largest code (which can happen
+        # with the restricted digit set), and the standard tokens never carry the
+        # values between the largest activation value and the special values
+        if extended_token:
+            return token > 999999999999
+        if token > 999999999:
+            return True
+        return (
+            OpenPAYGOTokenShared.MAX_ACTIVATION_VALUE
+            < value
+            < OpenPAYGOTokenShared.PAYG_DISABLE_VALUE
+        )
+
+    @classmethod
+    def _get_first_count_to_try(cls, last_count, value, chain_cache):
+        if chain_cache is None:
+            return 0
+        # Tokens below this count can never be accepted by _count_is_valid()
+        if value == OpenPAYGOTokenShared.COUNTER_SYNC_VALUE:
+            first_count = last_count - cls.MAX_TOKEN_JUMP + 1
+        elif cls.MAX_UNUSED_OLDER_TOKENS > 0:
+            first_count = last_count - cls.MAX_UNUSED_OLDER_TOKENS + 1
+        else:
+            first_count = last_count + 1
+        return max(first_count, 0)
+
+    @classmethod
+    def _iter_chain_codes(
+        cls, start_code, key, first_count, last_count, extended_token, chain_cache
+    ):
+        if chain_cache is not None:
+            return chain_cache.iter_codes(
+                start_code, key, first_count, last_count, extended_token
+            )
+        return cls._walk_chain(start_code, key, first_count, last_count, extended_token)
+
+    @classmethod
+    def _walk_chain(cls, start_code, key, first_count, last_count, extended_token):
+        if extended_token:
+            generate_next_token = OpenPAYGOTokenSharedExtended.generate_next_token
+        else:
+            generate_next_token = OpenPAYGOTokenShared.generate_next_token
+        siphash_key = get_siphash_key(key)
+        current_code = start_code
+        for count in range(0, last_count):
+            if count >= first_count:
+                yield current_code
+            current_code = generate_next_token(
+                current_code, siphash_key
+            )  # We go to the next token
+
+    @classmethod
+    def _is_token_in_chain(
+        cls, token, token_base, start_code, key, last_count, extended_token, chain_cache
+    ):
+        # Telling an already used token from an invalid one needs all the older
+        # codes, so this walk starts from zero even with a chain cache (the invalid
+        # token cache avoids repeating it for the same token)
+        if extended_token:
+            put_base_in_token = OpenPAYGOTokenSharedExtended.put_base_in_token
+        else:
+            put_base_in_token = OpenPAYGOTokenShared.put_base_in_token
+        for chain_code in cls._iter_chain_codes(
+            start_code, key, 0, last_count, extended_token, chain_cache
+        ):
+            if put_base_in_token(chain_code, token_base) == token:
+                return True
+        return False
+
     @classmethod
     def _count_is_valid(cls, count, last_count, value, type, used_counts):
 
@@ -142,14 +703,31 @@ class OpenPAYGOTokenDecoder(object):
             return True
         elif cls.MAX_UNUSED_OLDER_TOKENS > 0:
             if count > last_count - cls.MAX_UNUSED_OLDER_TOKENS:
-                if count not in used_counts and type == TokenType.ADD_TIME:
+                if (
+                    not cls._is_count_used(used_counts, count)
+                    and type == TokenType.ADD_TIME
+                ):
                     return True
         return False
 
+    @classmethod
+    def _is_count_used(cls, used_counts, count):
+        if not isinstance(used_counts, dict):
+            return count in used_counts
+        highest_count, mask = used_counts["highest_count"], used_counts["mask"]
+        if count == highest_count:
+            return True
+        offset = highest_count - 1 - count
+        return 0 <= offset < cls.MAX_UNUSED_OLDER_TOKENS and bool(mask >> offset & 1)
+
     @classmethod
     def update_used_counts(cls, past_used_counts, value, new_count, type):
         if not past_used_counts:
             return None
+        if isinstance(past_used_counts, dict):
+            return cls._update_used_counts_mask(
+                past_used_counts, value, new_count, type
+            )
         highest_count = max(past_used_counts) if past_used_counts else 0
         if new_count > highest_count:
             highest_count = new_count
@@ -172,6 +750,72 @@ class OpenPAYGOTokenDecoder(object):
                     used_counts.append(count)
         return used_counts
 
+    @classmethod
+    def _update_used_counts_mask(cls, past_used_counts, value, new_count, type):
+        # Same as update_used_counts() for the {"highest_count", "mask"} form, where
+        # the bit i of the mask is set if the count highest_count - 1 - i was used
+        past_highest_count = past_used_counts["highest_count"]
+        past_mask = past_used_counts["mask"]
+        highest_count = max(past_highest_count, new_count)
+        full_mask = (1 << cls.MAX_UNUSED_OLDER_TOKENS) - 1
+        if (
+            type != TokenType.ADD_TIME
+            or value == OpenPAYGOTokenShared.COUNTER_SYNC_VALUE
+            or value == OpenPAYGOTokenShared.PAYG_DISABLE_VALUE
+        ):
+            return cls._get_used_counts_mask(highest_count, full_mask)
+        # We move the past mask (with the past highest count as its lowest bit) to be
+        # relative to the new highest count, and mark the new count as used
+        shift = highest_count - past_highest_count
+        mask = ((((past_mask << 1) | 1) << shift) >> 1) & full_mask
+        offset = highest_count - 1 - new_count
+        if 0 <= offset < cls.MAX_UNUSED_OLDER_TOKENS:
+            mask |= 1 << offset
+        return cls._get_used_counts_mask(highest_count, mask)
+
+    @classmethod
+    def used_counts_to_mask(cls, used_counts):
+        if not used_counts:
+            return None
+        highest_count = max(used_counts)
+        mask = 0
+        for count in used_counts:
+            offset = highest_count - 1 - count
+            if 0 <= offset < cls.MAX_UNUSED_OLDER_TOKENS:
+                mask |= 1 << offset
+        return cls._get_used_counts_mask(highest_count, mask)
+
+    @classmethod
+    def used_counts_from_mask(cls, used_counts_mask):
+        if not used_counts_mask:
+            return None
+        highest_count = used_counts_mask["highest_count"]
+        mask = used_counts_mask["mask"]
+        used_counts = [
+            highest_count - 1 - offset
+            for offset in reversed(range(cls.MAX_UNUSED_OLDER_TOKENS))
+            if mask >> offset & 1
+        ]
+        used_counts.append(highest_count)
+        return used_counts
+
+    @classmethod
+    def pack_used_counts_mask(cls, used_counts_mask):
+        # We store the highest count on 4 bytes and the mask on 2 bytes
+        return USED_COUNTS_MASK_STRUCT.pack(
+            used_counts_mask["highest_count"], used_counts_mask["mask"]
+        )
+
+    @classmethod
+    def unpack_used_counts_mask(cls, data):
+        return cls._get_used_counts_mask(*USED_COUNTS_MASK_STRUCT.unpack(data))
+
+    @classmethod
+    def _get_used_counts_mask(cls, highest_count, mask):
+        # We use a dict rather than a tuple, so that the compact form is not mistaken
+        # for a list of counts once stored as JSON
+        return {"highest_count": highest_count, "mask": mask}
+
     @classmethod
     def _decode_base(cls, starting_code_base, token_base):
         decoded_value = token_base - starting_code_base
@@ -189,9 +833,11 @@ class OpenPAYGOTokenDecoder(object):
         last_count,
         restricted_digit_set=False,
         used_counts=None,
+        chain_cache=None,
     ):
         if restricted_digit_set:
             token = OpenPAYGOTokenSharedExtended.convert_from_4_digit_token(token)
+        valid_older_token = False
         token_base = OpenPAYGOTokenSharedExtended.get_token_base(
             token
         )  # We get the base of the token
@@ -204,10 +850,16 @@ class OpenPAYGOTokenDecoder(object):
         value = cls._decode_base_extended(
             starting_code_base, token_base
         )  # If there is a match we get the value from the token
+        if cls._is_value_impossible(token, value, True):
+            return None, TokenType.INVALID, None, None
         max_count_try = last_count + cls.MAX_TOKEN_JUMP + 1
-        for count in range(0, max_count_try):
+        first_count = cls._get_first_count_to_try(last_count, value, chain_cache)
+        codes = cls._iter_chain_codes(
+            current_code, key, first_count, max_count_try, True, chain_cache
+        )
+        for count, chain_code in zip(range(first_count, max_count_try), codes):
             masked_token = OpenPAYGOTokenSharedExtended.put_base_in_token(
-                current_code, token_base
+                chain_code, token_base
             )
             if count % 2:
                 this_type = TokenType.SET_TIME
@@ -223,9 +875,10 @@ class OpenPAYGOTokenDecoder(object):
                     return value, this_type, count, updated_counts
                 else:
                     valid_older_token = True
-            current_code = OpenPAYGOTokenSharedExtended.generate_next_token(
-                current_code, key
-            )  # If not we go to the next token
+        if not valid_older_token and first_count > 0:
+            valid_older_token = cls._is_token_in_chain(
+                token, token_base, current_code, key, first_count, True, chain_cache
+            )
         if valid_older_token:
             return None, TokenType.ALREADY_USED, None, None
         return None, TokenType.INVALID, None, None
@@ -237,3 +890,25 @@ class OpenPAYGOTokenDecoder(object):
             return decoded_value + 1000000
         else:
             return decoded_value
+
+
+class _TokenBaseChainWalk(object):
+    # The counts at which each token appears in the chain of a token base, the chain
+    # is only walked as far as it was needed so far
+    __slots__ = ("codes", "put_base_in_token", "token_base", "walked", "token_counts")
+
+    def __init__(self, codes, put_base_in_token, token_base):
+        self.codes = codes
+        self.put_base_in_token = put_base_in_token
+        self.token_base = token_base
+        self.walked = 0
+        self.token_counts = {}
+
+    def get_counts(self, token, max_count):
+        while self.walked < max_count:
+            masked_token = self.put_base_in_token(next(self.codes), self.token_base)
+            self.token_counts.setdefault(masked_token, []).append(self.walked)
+            self.walked += 1
+        return [
+            count for count in self.token_counts.get(token, []) if count < max_count
+        ]
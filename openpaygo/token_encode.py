@@ -1,8 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from .siphash_key import get_siphash_key
+from .token_chain_cache import TokenChainCache
 from .token_shared import OpenPAYGOTokenShared, TokenType
 from .token_shared_extended import OpenPAYGOTokenSharedExtended
 
 
 class OpenPAYGOTokenEncoder(object):
+    NUMPY_MIN_DEVICES = 16
+
     @classmethod
     def generate_token(
         cls,
@@ -14,11 +20,217 @@ class OpenPAYGOTokenEncoder(object):
         value_divider=1,
         restricted_digit_set=False,
         extended_token=False,
+        chain_cache=None,
     ):
         secret_key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
         if not starting_code:
             # We generate the starting code from the key if not provided
             starting_code = OpenPAYGOTokenShared.generate_starting_code(secret_key)
+        return cls._generate_token_from_key(
+            secret_key,
+            starting_code,
+            count,
+            value,
+            token_type,
+            value_divider,
+            restricted_digit_set,
+            extended_token,
+            chain_cache,
+        )
+
+    @classmethod
+    def generate_tokens_batch(
+        cls, devices, processes=None, chunk_size=1000, chain_cache=None, use_numpy=None
+    ):
+        # Each device is a dict with the same arguments as generate_token(), the
+        # results are returned in the same order as the devices. The chain cache is
+        # used as is in the current process, it cannot be shared with the workers
+        # (the checkpoints added in them would be lost).
+        devices = list(devices)
+        if not processes or processes == 1:
+            return cls._generate_tokens_chunk(devices, chain_cache, use_numpy)
+        if chain_cache is not None:
+            raise ValueError(
+                "The chain cache can only be used when generating the tokens in "
+                "the current process."
+            )
+        # We shard by secret key, so that all the tokens of a device are generated in
+        # the same worker and share their chain walks
+        devices_by_key = {}
+        for index, device in enumerate(devices):
+            devices_by_key.setdefault(device["secret_key"], []).append((index, device))
+        chunks = [[]]
+        for key_devices in devices_by_key.values():
+            if len(chunks[-1]) >= chunk_size:
+                chunks.append([])
+            chunks[-1].extend(key_devices)
+        results = [None] * sum(len(chunk) for chunk in chunks)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunks_results = executor.map(
+                cls._generate_tokens_chunk,
+                [[device for _, device in chunk] for chunk in chunks],
+                [None] * len(chunks),
+                [use_numpy] * len(chunks),
+            )
+            for chunk, chunk_results in zip(chunks, chunks_results):
+                for (index, _), result in zip(chunk, chunk_results):
+                    results[index] = result
+        return results
+
+    @classmethod
+    def _generate_tokens_chunk(cls, devices, chain_cache=None, use_numpy=None):
+        # We only decode each key and generate each starting code once per chunk, and
+        # the tokens of the same device share their chain walks. The devices with a
+        # single token in the chunk have nothing to share, so unless the caller gave
+        # a chain cache to keep, they are walked in lockstep with NumPy when it is
+        # available, and without a chain cache otherwise.
+        results = [None] * len(devices)
+        remaining_devices = list(enumerate(devices))
+        shared_keys = None
+        if chain_cache is None:
+            key_counts = {}
+            for device in devices:
+                secret_key = device["secret_key"]
+                key_counts[secret_key] = key_counts.get(secret_key, 0) + 1
+            shared_keys = {
+                key for key, key_count in key_counts.items() if key_count > 1
+            }
+            if use_numpy is None:
+                use_numpy = cls._get_numpy_engine().is_available()
+            single_devices = [
+                (index, device)
+                for index, device in remaining_devices
+                if device["secret_key"] not in shared_keys
+            ]
+            if use_numpy and len(single_devices) >= cls.NUMPY_MIN_DEVICES:
+                cls._generate_tokens_numpy(single_devices, results)
+                remaining_devices = [
+                    (index, device)
+                    for index, device in remaining_devices
+                    if device["secret_key"] in shared_keys
+                ]
+            if shared_keys:
+                chain_cache = TokenChainCache()
+        loaded_keys = {}
+        generated_starting_codes = {}
+        for index, device in remaining_devices:
+            secret_key = device["secret_key"]
+            key = loaded_keys.get(secret_key)
+            if key is None:
+                key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
+                loaded_keys[secret_key] = key
+            starting_code = device.get("starting_code")
+            if not starting_code:
+                starting_code = generated_starting_codes.get(secret_key)
+                if starting_code is None:
+                    starting_code = OpenPAYGOTokenShared.generate_starting_code(key)
+                    generated_starting_codes[secret_key] = starting_code
+            results[index] = cls._generate_token_from_key(
+                key,
+                starting_code,
+                device["count"],
+                device.get("value"),
+                device.get("token_type", TokenType.ADD_TIME),
+                device.get("value_divider", 1),
+                device.get("restricted_digit_set", False),
+                device.get("extended_token", False),
+                (
+                    chain_cache
+                    if shared_keys is None or secret_key in shared_keys
+                    else None
+                ),
+            )
+        return results
+
+    @classmethod
+    def _generate_tokens_numpy(cls, indexed_devices, results):
+        # NumpyTokenEngine.generate_tokens() takes the same value divider and token
+        # format for all the devices, so we group them by those
+        numpy_engine = cls._get_numpy_engine()
+        groups = {}
+        for index, device in indexed_devices:
+            group_key = (
+                device.get("value_divider", 1),
+                bool(device.get("restricted_digit_set", False)),
+                bool(device.get("extended_token", False)),
+            )
+            groups.setdefault(group_key, []).append((index, device))
+        for (
+            value_divider,
+            restricted_digit_set,
+            extended_token,
+        ), group in groups.items():
+            secret_keys = [
+                OpenPAYGOTokenShared.load_secret_key_from_hex(device["secret_key"])
+                for _, device in group
+            ]
+            starting_codes = [device.get("starting_code") for _, device in group]
+            missing = [i for i, code in enumerate(starting_codes) if not code]
+            if missing:
+                generated_starting_codes = numpy_engine.generate_starting_codes(
+                    *numpy_engine.load_keys([secret_keys[i] for i in missing])
+                ).tolist()
+                for i, starting_code in zip(missing, generated_starting_codes):
+                    starting_codes[i] = starting_code
+            group_results = numpy_engine.generate_tokens(
+                secret_keys,
+                [device["count"] for _, device in group],
+                values=[device.get("value") for _, device in group],
+                token_types=[
+                    device.get("token_type", TokenType.ADD_TIME) for _, device in group
+                ],
+                starting_codes=starting_codes,
+                value_divider=value_divider,
+                restricted_digit_set=restricted_digit_set,
+                extended_token=extended_token,
+            )
+            for (index, _), result in zip(group, group_results):
+                results[index] = result
+
+    @classmethod
+    def _get_numpy_engine(cls):
+        # We import it here as the token_numpy module imports this one
+        from .token_numpy import NumpyTokenEngine
+
+        return NumpyTokenEngine
+
+    @classmethod
+    def _generate_token_from_key(
+        cls,
+        key,
+        starting_code,
+        count,
+        value,
+        token_type,
+        value_divider,
+        restricted_digit_set,
+        extended_token,
+        chain_cache,
+    ):
+        value = cls._get_token_value(value, token_type, value_divider, extended_token)
+        if extended_token:
+            return cls.generate_extended_token(
+                starting_code,
+                key,
+                value,
+                count,
+                token_type,
+                restricted_digit_set,
+                chain_cache,
+            )
+        else:
+            return cls.generate_standard_token(
+                starting_code,
+                key,
+                value,
+                count,
+                token_type,
+                restricted_digit_set,
+                chain_cache,
+            )
+
+    @classmethod
+    def _get_token_value(cls, value, token_type, value_divider, extended_token):
         if token_type in [TokenType.ADD_TIME, TokenType.SET_TIME]:
             value = int(round(value * value_divider, 0))
             if not extended_token:
@@ -36,24 +248,7 @@ class OpenPAYGOTokenEncoder(object):
                 value = OpenPAYGOTokenShared.COUNTER_SYNC_VALUE
             else:
                 raise ValueError("The token type provided is not supported.")
-        if extended_token:
-            return cls.generate_extended_token(
-                starting_code,
-                secret_key,
-                value,
-                count,
-                token_type,
-                restricted_digit_set,
-            )
-        else:
-            return cls.generate_standard_token(
-                starting_code,
-                secret_key,
-                value,
-                count,
-                token_type,
-                restricted_digit_set,
-            )
+        return value
 
     @classmethod
     def generate_standard_token(
@@ -64,6 +259,7 @@ class OpenPAYGOTokenEncoder(object):
         count=None,
         mode=TokenType.ADD_TIME,
         restricted_digit_set=False,
+        chain_cache=None,
     ):
         # We get the first 3 digits with encoded value
         starting_code_base = OpenPAYGOTokenShared.get_token_base(starting_code)
@@ -72,15 +268,17 @@ class OpenPAYGOTokenEncoder(object):
             starting_code, token_base
         )
         new_count = cls._get_new_count(count, mode)
-        for xn in range(0, new_count):
-            current_token = OpenPAYGOTokenShared.generate_next_token(current_token, key)
-        final_token = OpenPAYGOTokenShared.put_base_in_token(current_token, token_base)
-        if restricted_digit_set:
-            final_token = OpenPAYGOTokenShared.convert_to_4_digit_token(final_token)
-            final_token = "{:015d}".format(final_token)
+        if chain_cache is not None:
+            # We resume the chain from the closest checkpoint instead of from zero
+            current_token = chain_cache.get_code(current_token, key, new_count)
         else:
-            final_token = "{:09d}".format(final_token)
-        return new_count, final_token
+            siphash_key = get_siphash_key(key)
+            for xn in range(0, new_count):
+                current_token = OpenPAYGOTokenShared.generate_next_token(
+                    current_token, siphash_key
+                )
+        final_token = OpenPAYGOTokenShared.put_base_in_token(current_token, token_base)
+        return new_count, cls._format_token(final_token, restricted_digit_set, False)
 
     @classmethod
     def _encode_base(cls, base, number):
@@ -98,6 +296,7 @@ class OpenPAYGOTokenEncoder(object):
         count,
         mode=TokenType.ADD_TIME,
         restricted_digit_set=False,
+        chain_cache=None,
     ):
         starting_code_base = OpenPAYGOTokenSharedExtended.get_token_base(starting_code)
         token_base = cls._encode_base_extended(starting_code_base, value)
@@ -105,21 +304,20 @@ class OpenPAYGOTokenEncoder(object):
             starting_code, token_base
         )
         new_count = cls._get_new_count(count, mode)
-        for xn in range(0, new_count):
-            current_token = OpenPAYGOTokenSharedExtended.generate_next_token(
-                current_token, key
+        if chain_cache is not None:
+            current_token = chain_cache.get_code(
+                current_token, key, new_count, extended_token=True
             )
+        else:
+            siphash_key = get_siphash_key(key)
+            for xn in range(0, new_count):
+                current_token = OpenPAYGOTokenSharedExtended.generate_next_token(
+                    current_token, siphash_key
+                )
         final_token = OpenPAYGOTokenSharedExtended.put_base_in_token(
             current_token, token_base
         )
-        if restricted_digit_set:
-            final_token = OpenPAYGOTokenSharedExtended.convert_to_4_digit_token(
-                final_token
-            )
-            final_token = "{:020d}".format(final_token)
-        else:
-            final_token = "{:012d}".format(final_token)
-        return new_count, final_token
+        return new_count, cls._format_token(final_token, restricted_digit_set, True)
 
     @classmethod
     def _encode_base_extended(cls, base, number):
@@ -128,6 +326,66 @@ class OpenPAYGOTokenEncoder(object):
         else:
             return number + base
 
+    @classmethod
+    def generate_token_book(
+        cls,
+        secret_key,
+        count,
+        values,
+        token_type=TokenType.ADD_TIME,
+        starting_code=None,
+        value_divider=1,
+        restricted_digit_set=False,
+        extended_token=False,
+    ):
+        # We yield (new_count, token) for each value in order, as if generate_token()
+        # was called for each of them with the count returned by the previous one.
+        # The counts only go up, so we keep the position reached in the chain of
+        # each token base and walk each chain only once.
+        key = OpenPAYGOTokenShared.load_secret_key_from_hex(secret_key)
+        if not starting_code:
+            starting_code = OpenPAYGOTokenShared.generate_starting_code(key)
+        if extended_token:
+            shared = OpenPAYGOTokenSharedExtended
+            encode_base = cls._encode_base_extended
+        else:
+            shared = OpenPAYGOTokenShared
+            encode_base = cls._encode_base
+        starting_code_base = shared.get_token_base(starting_code)
+        siphash_key = get_siphash_key(key)
+        chain_positions = {}
+        for value in values:
+            value = cls._get_token_value(
+                value, token_type, value_divider, extended_token
+            )
+            token_base = encode_base(starting_code_base, value)
+            count = cls._get_new_count(count, token_type)
+            chain_count, current_token = chain_positions.get(
+                token_base, (0, shared.put_base_in_token(starting_code, token_base))
+            )
+            for xn in range(chain_count, count):
+                current_token = shared.generate_next_token(current_token, siphash_key)
+            chain_positions[token_base] = (count, current_token)
+            final_token = shared.put_base_in_token(current_token, token_base)
+            yield (
+                count,
+                cls._format_token(final_token, restricted_digit_set, extended_token),
+            )
+
+    @classmethod
+    def _format_token(cls, final_token, restricted_digit_set, extended_token):
+        if extended_token:
+            if restricted_digit_set:
+                final_token = OpenPAYGOTokenSharedExtended.convert_to_4_digit_token(
+                    final_token
+                )
+                return "{:020d}".format(final_token)
+            return "{:012d}".format(final_token)
+        if restricted_digit_set:
+            final_token = OpenPAYGOTokenShared.convert_to_4_digit_token(final_token)
+            return "{:015d}".format(final_token)
+        return "{:09d}".format(final_token)
+
     @classmethod
     def _get_new_count(cls, count, mode):
         current_count_odd = count % 2
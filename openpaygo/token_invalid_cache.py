@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+
+class InvalidTokenCache(object):
+    # Remembers the most recently rejected tokens of each device, so that entering
+    # the same invalid token again does not walk the whole chain again. A token that
+    # is invalid for a count can become valid once the count is higher, so the count
+    # is part of the entry. It also counts the decodes that were short-circuited,
+    # either by the cache or because the token could never be valid. Like the
+    # TokenChainCache, the entries and counters are spread on stripes with their own
+    # lock.
+
+    DEFAULT_MAX_ENTRIES = 65536
+    DEFAULT_STRIPES = 16
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, stripes=DEFAULT_STRIPES):
+        if max_entries < 1:
+            raise ValueError("The cache must be able to hold at least 1 entry.")
+        self.max_entries = max_entries
+        stripes = max(1, min(stripes, max_entries))
+        self._stripes = [
+            _InvalidTokenStripe(max_entries // stripes + (i < max_entries % stripes))
+            for i in range(stripes)
+        ]
+
+    def __len__(self):
+        return sum(len(stripe.entries) for stripe in self._stripes)
+
+    @property
+    def cache_hits(self):
+        return sum(stripe.cache_hits for stripe in self._stripes)
+
+    @property
+    def prescreen_rejections(self):
+        return sum(stripe.prescreen_rejections for stripe in self._stripes)
+
+    @property
+    def short_circuited(self):
+        return self.cache_hits + self.prescreen_rejections
+
+    def clear(self):
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.entries.clear()
+
+    def contains(self, entry_key):
+        stripe = self._get_stripe(entry_key)
+        with stripe.lock:
+            if entry_key not in stripe.entries:
+                return False
+            stripe.entries.move_to_end(entry_key)
+            stripe.cache_hits += 1
+            return True
+
+    def add(self, entry_key):
+        stripe = self._get_stripe(entry_key)
+        with stripe.lock:
+            stripe.entries[entry_key] = True
+            stripe.entries.move_to_end(entry_key)
+            if len(stripe.entries) > stripe.max_entries:
+                stripe.entries.popitem(last=False)
+
+    def add_prescreen_rejection(self, entry_key):
+        stripe = self._get_stripe(entry_key)
+        with stripe.lock:
+            stripe.prescreen_rejections += 1
+
+    def get_stats(self):
+        return {
+            "entries": len(self),
+            "cache_hits": self.cache_hits,
+            "prescreen_rejections": self.prescreen_rejections,
+            "short_circuited": self.short_circuited,
+        }
+
+    def _get_stripe(self, entry_key):
+        # The entries are (key, starting_code, token, restricted_digit_set, count)
+        return self._stripes[entry_key[2] % len(self._stripes)]
+
+
+class _InvalidTokenStripe(object):
+    __slots__ = ("lock", "entries", "max_entries", "cache_hits", "prescreen_rejections")
+
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.cache_hits = 0
+        self.prescreen_rejections = 0
@@ -0,0 +1,417 @@
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from itertools import repeat
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from .token_decode import OpenPAYGOTokenDecoder
+from .token_encode import OpenPAYGOTokenEncoder
+from .token_shared import OpenPAYGOTokenShared
+from .token_shared_extended import OpenPAYGOTokenSharedExtended
+
+INDEX_MAGIC = b"OPGTIDX3"
+# The header holds the capacity, the number of tokens, the number of deleted slots and
+# the generation of the table (odd while the slots are being rehashed in place)
+INDEX_HEADER_STRUCT = struct.Struct("<8sQQQQ")
+INDEX_GENERATION_STRUCT = struct.Struct("<Q")
+INDEX_GENERATION_OFFSET = 32
+# Each slot holds the token key (0 if the slot is empty), the device ID and the count
+INDEX_SLOT_STRUCT = struct.Struct("<QQL")
+INDEX_SLOT_VALUES_STRUCT = struct.Struct("<QL")
+INDEX_SLOT_COUNT_STRUCT = struct.Struct("<L")
+# The key of the slots of the tokens removed, the lookups keep probing past them
+DELETED_KEY = 0xFFFFFFFFFFFFFFFF
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+_FIBONACCI_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class TokenLookupIndex(object):
+    # Maps the tokens issued to the devices back to the devices (given as integer
+    # IDs) in a single open addressing hash table with linear probing. The table is a
+    # flat buffer, in memory or memory mapped from a file so that several processes
+    # can share the same index. Different devices can have the same token, so a
+    # lookup returns all of them. The writes are serialized by a lock, and by an
+    # exclusive fcntl file lock for the memory mapped indexes, so that several
+    # processes can open the same index writable (without fcntl, on Windows, only
+    # one process must write to it). The lookups do not lock and only see a table
+    # once it is complete. A slot in use never becomes empty (the tokens removed are
+    # marked as deleted), so the lookups never stop probing before the slot of a
+    # token. Once the deleted slots fill the table, it is rebuilt without them: a
+    # new table in memory, or the same memory mapped table rehashed in place, the
+    # lookups trying again if its generation changed while they were probing.
+
+    MAX_LOAD_FACTOR = 0.5
+    DEFAULT_CAPACITY = 1024
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        capacity = self._get_table_size(capacity)
+        self._buffer = bytearray(INDEX_HEADER_STRUCT.size)
+        self._buffer += bytearray(capacity * INDEX_SLOT_STRUCT.size)
+        self._mmap = None
+        self._file = None
+        self._writable = True
+        self._lock = threading.Lock()
+        self._set_header(capacity, 0, 0)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @classmethod
+    def build(cls, issued_tokens, window=OpenPAYGOTokenDecoder.MAX_TOKEN_JUMP):
+        # We only index the tokens issued in the last window counts of each device,
+        # the older ones cannot be entered anymore
+        issued_tokens = list(issued_tokens)
+        highest_counts = {}
+        for device_id, _, count in issued_tokens:
+            if count > highest_counts.get(device_id, -1):
+                highest_counts[device_id] = count
+        index = cls(len(issued_tokens))
+        for device_id, token, count in issued_tokens:
+            if count > highest_counts[device_id] - window:
+                index.add(device_id, token, count)
+        return index
+
+    @classmethod
+    def build_from_devices(
+        cls,
+        devices,
+        window=OpenPAYGOTokenDecoder.MAX_TOKEN_JUMP,
+        outstanding=OpenPAYGOTokenDecoder.MAX_TOKEN_JUMP,
+    ):
+        # Each device is a dict with its device_id, its current count and the same
+        # arguments as generate_token() for the tokens it is issued (secret_key,
+        # value, token_type, starting_code, ...). We index the tokens of the last
+        # window counts, which can still be entered, and of the next outstanding
+        # counts, which will be issued next, walking the chain of each device once.
+        issued_tokens = []
+        for device in devices:
+            device = dict(device)
+            device_id = device.pop("device_id")
+            count = device.pop("count")
+            value = device.pop("value", None)
+            for new_count, token in OpenPAYGOTokenEncoder.generate_token_book(
+                count=max(count - window, 0), values=repeat(value), **device
+            ):
+                if new_count > count + outstanding:
+                    break
+                issued_tokens.append((device_id, token, new_count))
+        index = cls(len(issued_tokens))
+        for device_id, token, count in issued_tokens:
+            index.add(device_id, token, count)
+        return index
+
+    @classmethod
+    def open(cls, path, writable=False):
+        index = cls.__new__(cls)
+        index._file = open(path, "r+b" if writable else "rb")
+        index._mmap = mmap.mmap(
+            index._file.fileno(),
+            0,
+            access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+        )
+        index._buffer = index._mmap
+        index._writable = writable
+        index._lock = threading.Lock()
+        magic, capacity, _, _, _ = INDEX_HEADER_STRUCT.unpack_from(index._buffer, 0)
+        if magic != INDEX_MAGIC:
+            index.close()
+            raise ValueError("The file is not a token lookup index.")
+        index._capacity = capacity
+        return index
+
+    def save(self, path):
+        temporary_path = "{}.tmp".format(path)
+        with open(temporary_path, "wb") as index_file:
+            index_file.write(self._buffer)
+        os.replace(temporary_path, path)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+    def add(self, device_id, token, count):
+        if not self._writable:
+            raise ValueError("The index was opened read only.")
+        token_key = self._get_token_key(token)
+        with self._lock_writes():
+            slot_offset, stored_key = self._find_slot_offset(token_key, device_id)
+            if stored_key == token_key:
+                # The token is already stored for this device, we only update its count
+                INDEX_SLOT_COUNT_STRUCT.pack_into(self._buffer, slot_offset + 16, count)
+                return
+            deleted_count = self._deleted_count
+            if (
+                not stored_key
+                and self._size + deleted_count + 1
+                > self._capacity * self.MAX_LOAD_FACTOR
+            ):
+                self._rebuild()
+                deleted_count = 0
+                slot_offset, stored_key = self._find_slot_offset(token_key, device_id)
+            # The slot is empty or deleted, we write the key last so that a process
+            # reading the index at the same time never sees a key without its device
+            INDEX_SLOT_VALUES_STRUCT.pack_into(
+                self._buffer, slot_offset + 8, device_id, count
+            )
+            struct.pack_into("<Q", self._buffer, slot_offset, token_key)
+            if stored_key == DELETED_KEY:
+                deleted_count -= 1
+            self._set_header(self._capacity, self._size + 1, deleted_count)
+
+    def prune(self, window=OpenPAYGOTokenDecoder.MAX_TOKEN_JUMP):
+        # We remove the tokens issued before the last window counts of each device,
+        # which cannot be entered anymore, so that an index kept up to date for a long
+        # time does not grow without bound. Their slots are reused by the tokens added
+        # afterwards. Returns the number of tokens removed.
+        if not self._writable:
+            raise ValueError("The index was opened read only.")
+        with self._lock_writes():
+            with memoryview(self._buffer)[INDEX_HEADER_STRUCT.size :] as slots:
+                slot_values = list(INDEX_SLOT_STRUCT.iter_unpack(slots))
+            highest_counts = {}
+            for stored_key, device_id, count in slot_values:
+                if stored_key and stored_key != DELETED_KEY:
+                    if count > highest_counts.get(device_id, -1):
+                        highest_counts[device_id] = count
+            removed_count = 0
+            for slot, (stored_key, device_id, count) in enumerate(slot_values):
+                if (
+                    stored_key
+                    and stored_key != DELETED_KEY
+                    and count <= highest_counts[device_id] - window
+                ):
+                    struct.pack_into(
+                        "<Q", self._buffer, self._get_slot_offset(slot), DELETED_KEY
+                    )
+                    removed_count += 1
+            self._set_header(
+                self._capacity,
+                self._size - removed_count,
+                self._deleted_count + removed_count,
+            )
+        return removed_count
+
+    def lookup(self, token):
+        # Returns the list of (device_id, count) of the devices the token was issued
+        # to, with the count of the token
+        token_key = self._get_token_key(token)
+        # The table can be replaced by a larger one, we keep using the one we got
+        buffer = self._buffer
+        while True:
+            generation = INDEX_GENERATION_STRUCT.unpack_from(
+                buffer, INDEX_GENERATION_OFFSET
+            )[0]
+            if generation & 1:
+                # The table is being rehashed in place
+                continue
+            matches = self._probe(buffer, token_key)
+            if (
+                INDEX_GENERATION_STRUCT.unpack_from(buffer, INDEX_GENERATION_OFFSET)[0]
+                == generation
+            ):
+                return matches
+
+    def generate_token(self, device_id, **kwargs):
+        # Same as OpenPAYGOTokenEncoder.generate_token(), the token issued is added to
+        # the index
+        new_count, token = OpenPAYGOTokenEncoder.generate_token(**kwargs)
+        self.add(device_id, token, new_count)
+        return new_count, token
+
+    def generate_tokens_batch(self, device_ids, devices, **kwargs):
+        results = OpenPAYGOTokenEncoder.generate_tokens_batch(devices, **kwargs)
+        for device_id, (new_count, token) in zip(device_ids, results):
+            self.add(device_id, token, new_count)
+        return results
+
+    @classmethod
+    def _get_token_key(cls, token):
+        # We store the tokens as their code with the kind of token in the lowest 2
+        # bits, so that a standard and an extended token with the same digits are
+        # not mixed, and the restricted digit set tokens fit in 64 bits
+        token = str(token)
+        if len(token) <= 9:
+            code, kind = int(token), 0
+        elif len(token) <= 12:
+            code, kind = int(token), 1
+        elif len(token) <= 15:
+            code, kind = OpenPAYGOTokenShared.convert_from_4_digit_token(token), 2
+        elif len(token) <= 20:
+            code = OpenPAYGOTokenSharedExtended.convert_from_4_digit_token(token)
+            kind = 3
+        else:
+            raise ValueError("Token is too long")
+        return ((code << 2) | kind) + 1
+
+    @classmethod
+    def _get_table_size(cls, entries):
+        capacity = 8
+        while capacity * cls.MAX_LOAD_FACTOR < entries:
+            capacity *= 2
+        return capacity
+
+    @classmethod
+    def _get_first_slot(cls, token_key, capacity):
+        return ((token_key * _FIBONACCI_MULTIPLIER) & _MASK_64) >> (
+            64 - capacity.bit_length() + 1
+        )
+
+    @classmethod
+    def _get_slot_offset(cls, slot):
+        return INDEX_HEADER_STRUCT.size + slot * INDEX_SLOT_STRUCT.size
+
+    @classmethod
+    def _probe(cls, buffer, token_key):
+        capacity = INDEX_HEADER_STRUCT.unpack_from(buffer, 0)[1]
+        # The deleted slots never match, as their key is not a token key
+        mask = capacity - 1
+        slot = cls._get_first_slot(token_key, capacity)
+        matches = []
+        while True:
+            stored_key, device_id, count = INDEX_SLOT_STRUCT.unpack_from(
+                buffer, cls._get_slot_offset(slot)
+            )
+            if not stored_key:
+                return matches
+            if stored_key == token_key:
+                matches.append((device_id, count))
+            slot = (slot + 1) & mask
+
+    @classmethod
+    def _find_slot(cls, buffer, capacity, token_key, device_id):
+        # We return the slot of the token for this device, or the slot where it would
+        # go: the first deleted slot on the way or the empty slot ending the probing
+        # (there is always one, as the table is never more than half used)
+        mask = capacity - 1
+        slot = cls._get_first_slot(token_key, capacity)
+        deleted_slot = None
+        while True:
+            stored_key, stored_device_id, _ = INDEX_SLOT_STRUCT.unpack_from(
+                buffer, cls._get_slot_offset(slot)
+            )
+            if not stored_key:
+                return slot if deleted_slot is None else deleted_slot
+            if stored_key == DELETED_KEY:
+                if deleted_slot is None:
+                    deleted_slot = slot
+            elif stored_key == token_key and stored_device_id == device_id:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _find_slot_offset(self, token_key, device_id):
+        # Returns the offset of the slot of the token and the key stored in it
+        slot_offset = self._get_slot_offset(
+            self._find_slot(self._buffer, self._capacity, token_key, device_id)
+        )
+        return slot_offset, struct.unpack_from("<Q", self._buffer, slot_offset)[0]
+
+    @contextmanager
+    def _lock_writes(self):
+        # The header and the slots are read again once locked, as another process
+        # can have written to the memory mapped index in the meantime
+        with self._lock:
+            if self._file is None or fcntl is None:
+                yield
+                return
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _rebuild(self):
+        # We copy the tokens to a new table without the deleted slots, twice as large
+        # if the tokens alone would fill more than half of the maximum load
+        if self._mmap is not None:
+            if self._size + 1 > self._capacity * self.MAX_LOAD_FACTOR:
+                raise ValueError(
+                    "The memory mapped index is full, it must be pruned or rebuilt "
+                    "with a larger capacity."
+                )
+            self._rehash_in_place()
+            return
+        capacity = self._capacity
+        if self._size + 1 > capacity * self.MAX_LOAD_FACTOR / 2:
+            capacity *= 2
+        buffer = bytearray(INDEX_HEADER_STRUCT.size + capacity * INDEX_SLOT_STRUCT.size)
+        size = 0
+        for slot_values in INDEX_SLOT_STRUCT.iter_unpack(
+            memoryview(self._buffer)[INDEX_HEADER_STRUCT.size :]
+        ):
+            if slot_values[0] and slot_values[0] != DELETED_KEY:
+                slot_offset = self._get_slot_offset(
+                    self._find_slot(buffer, capacity, slot_values[0], slot_values[1])
+                )
+                INDEX_SLOT_STRUCT.pack_into(buffer, slot_offset, *slot_values)
+                size += 1
+        INDEX_HEADER_STRUCT.pack_into(buffer, 0, INDEX_MAGIC, capacity, size, 0, 0)
+        # The lookups only see the new table once it is complete
+        self._buffer = buffer
+        self._capacity = capacity
+
+    def _rehash_in_place(self):
+        # The memory mapped table cannot grow, so we empty it and put the tokens back
+        # without the deleted slots. The generation is odd in the meantime, so that
+        # the lookups of the other processes wait and try again.
+        with memoryview(self._buffer)[INDEX_HEADER_STRUCT.size :] as slots:
+            slot_values = [
+                values
+                for values in INDEX_SLOT_STRUCT.iter_unpack(slots)
+                if values[0] and values[0] != DELETED_KEY
+            ]
+        generation = self._generation
+        self._set_generation(generation + 1)
+        self._buffer[INDEX_HEADER_STRUCT.size :] = bytes(
+            self._capacity * INDEX_SLOT_STRUCT.size
+        )
+        for values in slot_values:
+            slot_offset = self._get_slot_offset(
+                self._find_slot(self._buffer, self._capacity, values[0], values[1])
+            )
+            INDEX_SLOT_STRUCT.pack_into(self._buffer, slot_offset, *values)
+        self._set_header(self._capacity, len(slot_values), 0)
+        self._set_generation(generation + 2)
+
+    def _set_header(self, capacity, size, deleted_count):
+        self._capacity = capacity
+        INDEX_HEADER_STRUCT.pack_into(
+            self._buffer,
+            0,
+            INDEX_MAGIC,
+            capacity,
+            size,
+            deleted_count,
+            self._generation,
+        )
+
+    def _set_generation(self, generation):
+        INDEX_GENERATION_STRUCT.pack_into(
+            self._buffer, INDEX_GENERATION_OFFSET, generation
+        )
+
+    @property
+    def _generation(self):
+        return INDEX_GENERATION_STRUCT.unpack_from(
+            self._buffer, INDEX_GENERATION_OFFSET
+        )[0]
+
+    @property
+    def _size(self):
+        return INDEX_HEADER_STRUCT.unpack_from(self._buffer, 0)[2]
+
+    @property
+    def _deleted_count(self):
+        return INDEX_HEADER_STRUCT.unpack_from(self._buffer, 0)[3]
@@ -0,0 +1,353 @@
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from .token_encode import OpenPAYGOTokenEncoder
+from .token_shared import OpenPAYGOTokenShared, TokenType
+from .token_shared_extended import OpenPAYGOTokenSharedExtended
+
+if np is not None:
+    _V0 = np.uint64(0x736F6D6570736575)
+    _V1 = np.uint64(0x646F72616E646F6D)
+    _V2 = np.uint64(0x6C7967656E657261)
+    _V3 = np.uint64(0x7465646279746573)
+    _FINAL_XOR = np.uint64(0xFF)
+    _LOW_32_BITS = np.uint64(0xFFFFFFFF)
+    _SHIFTS = {bits: np.uint64(bits) for bits in (2, 13, 16, 17, 21, 24, 32, 56)}
+    _ROTATIONS = {
+        bits: (np.uint64(bits), np.uint64(64 - bits)) for bits in (13, 16, 17, 21, 32)
+    }
+    # The 5 restricted digits of each 10 bits value, as a number
+    _RESTRICTED_DIGITS_TABLE = np.array(
+        [
+            int("".join(str((value >> shift & 3) + 1) for shift in (8, 6, 4, 2, 0)))
+            for value in range(1 << 10)
+        ],
+        dtype=np.uint64,
+    )
+    _LOW_10_BITS = np.uint64(0x3FF)
+    _DIGITS_SHIFTS = [np.uint64(bits) for bits in (30, 20, 10, 0)]
+    _FIVE_DIGITS = np.uint64(10**5)
+    _TEN_DIGITS = np.uint64(10**10)
+    _TEN_BITS = np.uint64(10)
+    # The 10 bits value of each 5 restricted digits, read back as base 4 digits with
+    # the same wrap around as BASE_4_FROM_RESTRICTED_DIGITS
+    _BASE_4_FROM_FIVE_DIGITS = np.zeros(10**5, dtype=np.uint64)
+    for _divisor in (10**4, 10**3, 10**2, 10, 1):
+        _BASE_4_FROM_FIVE_DIGITS = _BASE_4_FROM_FIVE_DIGITS * np.uint64(4) + (
+            np.arange(10**5, dtype=np.uint64) // np.uint64(_divisor) % np.uint64(10)
+            + np.uint64(3)
+        ) % np.uint64(4)
+    _POWERS_OF_TEN = np.array([10**exponent for exponent in range(1, 20)], np.uint64)
+
+
+class NumpyTokenEngine(object):
+    # We advance the token chains of many devices in lockstep, running SipHash-2-4
+    # on arrays of uint64 instead of one message at a time. The scalar
+    # generate_next_token() methods of OpenPAYGOTokenShared and
+    # OpenPAYGOTokenSharedExtended remain the reference implementation.
+
+    @classmethod
+    def is_available(cls):
+        return np is not None
+
+    @classmethod
+    def load_keys(cls, keys):
+        cls._check_available()
+        key_bytes = []
+        for key in keys:
+            if isinstance(key, str):
+                key = OpenPAYGOTokenShared.load_secret_key_from_hex(key)
+            if len(key) != 16:
+                raise ValueError("The secret keys must be 16 bytes long.")
+            key_bytes.append(key)
+        key_array = np.frombuffer(b"".join(key_bytes), dtype="<u8").reshape(-1, 2)
+        return (
+            key_array[:, 0].astype(np.uint64),
+            key_array[:, 1].astype(np.uint64),
+        )
+
+    @classmethod
+    def generate_starting_codes(cls, k0, k1):
+        # The starting code is the hash of the key with itself
+        starting_hash = cls._siphash_2_4(k0, k1, [k0, k1], 16)
+        return cls._convert_hash_to_token(starting_hash)
+
+    @classmethod
+    def generate_next_tokens(cls, codes, k0, k1):
+        # The message is the 32 bits code in big endian, duplicated
+        half_message = codes.astype(np.uint32).byteswap().astype(np.uint64)
+        message = half_message | (half_message << _SHIFTS[32])
+        token_hash = cls._siphash_2_4(k0, k1, [message], 8)
+        return cls._convert_hash_to_token(token_hash)
+
+    @classmethod
+    def generate_next_extended_tokens(cls, codes, k0, k1):
+        # The message is the 64 bits code in big endian
+        message = codes.astype(np.uint64).byteswap()
+        token_hash = cls._siphash_2_4(k0, k1, [message], 8)
+        return cls._convert_hash_to_extended_token(token_hash)
+
+    @classmethod
+    def walk_chains(cls, start_codes, k0, k1, counts, extended_token=False):
+        cls._check_available()
+        if extended_token:
+            generate_next_tokens = cls.generate_next_extended_tokens
+        else:
+            generate_next_tokens = cls.generate_next_tokens
+        codes = np.array(start_codes, dtype=np.uint64)
+        counts = np.asarray(counts, dtype=np.int64)
+        if not len(codes):
+            return codes
+        # We sort the chains by decreasing count, so that the chains still walking
+        # at a given step are always the first ones
+        order = np.argsort(-counts, kind="stable")
+        sorted_codes = codes[order]
+        sorted_k0 = k0[order]
+        sorted_k1 = k1[order]
+        ascending_counts = counts[order][::-1]
+        for step in range(int(ascending_counts[-1])):
+            active = len(codes) - int(
+                np.searchsorted(ascending_counts, step, side="right")
+            )
+            sorted_codes[:active] = generate_next_tokens(
+                sorted_codes[:active], sorted_k0[:active], sorted_k1[:active]
+            )
+        codes[order] = sorted_codes
+        return codes
+
+    @classmethod
+    def generate_tokens(
+        cls,
+        secret_keys,
+        counts,
+        values=None,
+        token_types=TokenType.ADD_TIME,
+        starting_codes=None,
+        value_divider=1,
+        restricted_digit_set=False,
+        extended_token=False,
+    ):
+        # Same as OpenPAYGOTokenEncoder.generate_token() for many devices, returns the
+        # list of (new_count, token) in the same order as the secret keys
+        secret_keys = list(secret_keys)
+        counts = list(counts)
+        number_of_devices = len(secret_keys)
+        if values is None:
+            values = [None] * number_of_devices
+        if not isinstance(token_types, (list, tuple)):
+            token_types = [token_types] * number_of_devices
+        k0, k1 = cls.load_keys(secret_keys)
+        if starting_codes is None:
+            starting_codes = cls.generate_starting_codes(k0, k1)
+        else:
+            starting_codes = np.asarray(starting_codes, dtype=np.uint64)
+        if extended_token:
+            offset = OpenPAYGOTokenSharedExtended.TOKEN_VALUE_OFFSET_EXTENDED
+        else:
+            offset = OpenPAYGOTokenShared.TOKEN_VALUE_OFFSET
+        offset = np.uint64(offset)
+        token_values = np.array(
+            [
+                OpenPAYGOTokenEncoder._get_token_value(
+                    value, token_type, value_divider, extended_token
+                )
+                for value, token_type in zip(values, token_types)
+            ],
+            dtype=np.uint64,
+        )
+        new_counts = [
+            OpenPAYGOTokenEncoder._get_new_count(count, token_type)
+            for count, token_type in zip(counts, token_types)
+        ]
+        starting_code_bases = starting_codes % offset
+        token_bases = (starting_code_bases + token_values) % offset
+        codes = cls.walk_chains(
+            starting_codes - starting_code_bases + token_bases,
+            k0,
+            k1,
+            new_counts,
+            extended_token,
+        )
+        final_tokens = codes - codes % offset + token_bases
+        if restricted_digit_set:
+            final_tokens = cls.convert_to_4_digit_tokens(final_tokens, extended_token)
+        else:
+            final_tokens = final_tokens.tolist()
+        if extended_token:
+            token_format = "{:020d}" if restricted_digit_set else "{:012d}"
+        else:
+            token_format = "{:015d}" if restricted_digit_set else "{:09d}"
+        return [
+            (new_count, token_format.format(token))
+            for new_count, token in zip(new_counts, final_tokens)
+        ]
+
+    @classmethod
+    def convert_to_4_digit_tokens(cls, codes, extended_token=False):
+        # Same as convert_to_4_digit_token() for many codes, each 10 bits of the
+        # codes are converted to 5 restricted digits with a table. The restricted
+        # extended tokens have 20 digits and do not fit in 64 bits, so we compute
+        # their 10 digits halves and return the tokens as Python integers.
+        cls._check_available()
+        codes = np.asarray(codes, dtype=np.uint64)
+        high, middle_high, middle_low, low = [
+            _RESTRICTED_DIGITS_TABLE[(codes >> shift) & _LOW_10_BITS]
+            for shift in _DIGITS_SHIFTS
+        ]
+        low_digits = middle_low * _FIVE_DIGITS + low
+        if not extended_token:
+            return (middle_high * _TEN_DIGITS + low_digits).tolist()
+        high_digits = high * _FIVE_DIGITS + middle_high
+        return [
+            high_half * 10**10 + low_half
+            for high_half, low_half in zip(high_digits.tolist(), low_digits.tolist())
+        ]
+
+    @classmethod
+    def convert_from_4_digit_tokens(cls, tokens, extended_token=False):
+        # Same as convert_from_4_digit_token() for many tokens, returned as an array
+        # of uint64. Each 5 digits of the tokens are converted to 10 bits with a
+        # table. The restricted extended tokens have 20 digits and do not fit in 64
+        # bits, so they are given as Python integers and split in 10 digits halves.
+        cls._check_available()
+        if extended_token:
+            halves = [divmod(int(token), 10**10) for token in tokens]
+            high = np.array([high_half for high_half, _ in halves], dtype=np.uint64)
+            low = np.array([low_half for _, low_half in halves], dtype=np.uint64)
+            groups = [
+                high // _FIVE_DIGITS,
+                high % _FIVE_DIGITS,
+                low // _FIVE_DIGITS,
+                low % _FIVE_DIGITS,
+            ]
+            digit_counts = np.where(
+                high > 0, cls._count_digits(high) + 10, cls._count_digits(low)
+            )
+        else:
+            tokens = np.asarray(tokens, dtype=np.uint64)
+            groups = [
+                tokens // _TEN_DIGITS,
+                tokens // _FIVE_DIGITS % _FIVE_DIGITS,
+                tokens % _FIVE_DIGITS,
+            ]
+            digit_counts = cls._count_digits(tokens)
+        codes = np.zeros(len(groups[0]), dtype=np.uint64)
+        for group in groups:
+            codes = (codes << _TEN_BITS) | _BASE_4_FROM_FIVE_DIGITS[group]
+        # The table reads the leading zeros of the groups as 3s, while they are not
+        # part of the token, so we remove the 3s above its digits
+        all_digits = np.uint64(1) << np.uint64(10 * len(groups))
+        token_digits = np.uint64(1) << (digit_counts.astype(np.uint64) * np.uint64(2))
+        return codes - (all_digits - token_digits)
+
+    @classmethod
+    def hash_messages(cls, k0, k1, messages):
+        # SipHash-2-4 of byte strings of any length, one per key, the same as
+        # SipHashKey.hash(). The messages are split in blocks of 8 bytes, the last
+        # one holding the remaining bytes and the length in its high byte.
+        cls._check_available()
+        block_counts = np.array(
+            [len(message) // 8 + 1 for message in messages], dtype=np.int64
+        )
+        if not len(block_counts):
+            return np.zeros(0, dtype=np.uint64)
+        max_blocks = int(block_counts.max())
+        message_buffer = bytearray(len(messages) * max_blocks * 8)
+        for lane, message in enumerate(messages):
+            offset = lane * max_blocks * 8
+            message_buffer[offset : offset + len(message)] = message
+            message_buffer[offset + len(message) // 8 * 8 + 7] = len(message) & 0xFF
+        blocks = np.frombuffer(message_buffer, dtype="<u8").reshape(-1, max_blocks)
+        # We sort the messages by decreasing length, so that the messages still being
+        # hashed at a given block are always the first ones
+        order = np.argsort(-block_counts, kind="stable")
+        blocks = blocks[order].astype(np.uint64)
+        ascending_block_counts = block_counts[order][::-1]
+        v0 = k0[order] ^ _V0
+        v1 = k1[order] ^ _V1
+        v2 = k0[order] ^ _V2
+        v3 = k1[order] ^ _V3
+        for block_index in range(max_blocks):
+            active = len(messages) - int(
+                np.searchsorted(ascending_block_counts, block_index, side="right")
+            )
+            block = blocks[:active, block_index]
+            a, b, c, d = v0[:active], v1[:active], v2[:active], v3[:active] ^ block
+            a, b, c, d = cls._sip_round(a, b, c, d)
+            a, b, c, d = cls._sip_round(a, b, c, d)
+            v0[:active], v1[:active], v2[:active], v3[:active] = a ^ block, b, c, d
+        v2 = v2 ^ _FINAL_XOR
+        for i in range(4):
+            v0, v1, v2, v3 = cls._sip_round(v0, v1, v2, v3)
+        hashes = np.empty(len(messages), dtype=np.uint64)
+        hashes[order] = v0 ^ v1 ^ v2 ^ v3
+        return hashes
+
+    @classmethod
+    def _count_digits(cls, values):
+        return np.searchsorted(_POWERS_OF_TEN, values, side="right") + 1
+
+    @classmethod
+    def _convert_hash_to_token(cls, token_hash):
+        # Same as OpenPAYGOTokenShared.convert_hash_to_token()
+        result_hash = (token_hash >> _SHIFTS[32]) ^ (token_hash & _LOW_32_BITS)
+        tokens = result_hash >> _SHIFTS[2]
+        return np.where(
+            tokens > np.uint64(999999999), tokens - np.uint64(73741825), tokens
+        )
+
+    @classmethod
+    def _convert_hash_to_extended_token(cls, token_hash):
+        # Same as OpenPAYGOTokenSharedExtended.convert_hash_to_token()
+        tokens = token_hash >> _SHIFTS[24]
+        return np.where(
+            tokens > np.uint64(999999999999),
+            tokens - np.uint64(99511627777),
+            tokens,
+        )
+
+    @classmethod
+    def _siphash_2_4(cls, k0, k1, blocks, length):
+        v0 = k0 ^ _V0
+        v1 = k1 ^ _V1
+        v2 = k0 ^ _V2
+        v3 = k1 ^ _V3
+        # The last block only contains the length, as we only hash whole blocks
+        for block in list(blocks) + [np.uint64(length) << _SHIFTS[56]]:
+            v3 = v3 ^ block
+            v0, v1, v2, v3 = cls._sip_round(v0, v1, v2, v3)
+            v0, v1, v2, v3 = cls._sip_round(v0, v1, v2, v3)
+            v0 = v0 ^ block
+        v2 = v2 ^ _FINAL_XOR
+        for i in range(4):
+            v0, v1, v2, v3 = cls._sip_round(v0, v1, v2, v3)
+        return v0 ^ v1 ^ v2 ^ v3
+
+    @classmethod
+    def _sip_round(cls, v0, v1, v2, v3):
+        v0 = v0 + v1
+        v1 = cls._rotate_left(v1, 13) ^ v0
+        v0 = cls._rotate_left(v0, 32)
+        v2 = v2 + v3
+        v3 = cls._rotate_left(v3, 16) ^ v2
+        v0 = v0 + v3
+        v3 = cls._rotate_left(v3, 21) ^ v0
+        v2 = v2 + v1
+        v1 = cls._rotate_left(v1, 17) ^ v2
+        v2 = cls._rotate_left(v2, 32)
+        return v0, v1, v2, v3
+
+    @classmethod
+    def _rotate_left(cls, value, bits):
+        left, right = _ROTATIONS[bits]
+        return (value << left) | (value >> right)
+
+    @classmethod
+    def _check_available(cls):
+        if np is None:
+            raise ImportError(
+                "NumPy is required for the NumpyTokenEngine, you can install it with "
+                "`pip install openpaygo[numpy]`."
+            )
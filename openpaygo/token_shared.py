@@ -1,7 +1,18 @@
 import codecs
-import struct
 
-import siphash
+from .siphash_key import get_siphash_key, load_siphash_key
+
+# Each hexadecimal digit holds 2 pairs of bits, each pair of bits is written as a digit
+# from 1 to 4
+RESTRICTED_DIGITS_FROM_HEX = str.maketrans(
+    {
+        hex_digit: "{}{}".format(i // 4 + 1, i % 4 + 1)
+        for i, hex_digit in enumerate("0123456789abcdef")
+    }
+)
+# Each restricted digit is read back as a base 4 digit. The digits outside of 1 to 4
+# wrap around, as they always did
+BASE_4_FROM_RESTRICTED_DIGITS = str.maketrans("0123456789", "3012301230")
 
 
 class TokenType(object):
@@ -32,22 +43,23 @@ class OpenPAYGOTokenShared(object):
 
     @classmethod
     def generate_next_token(cls, last_code, key):
-        conformed_token = struct.pack(">L", last_code)  # We convert the token to bytes
-        conformed_token += conformed_token  # We duplicate it to fit the minimum length
-        token_hash = cls.generate_hash(key, conformed_token)  # We hash it
-        new_token = cls.convert_hash_to_token(
-            token_hash
-        )  # We convert to token and return
-        return new_token
+        # We duplicate the 4 bytes of the token to fit the minimum length, and pass
+        # the message as the little endian integer that SipHash works on
+        token_hash = load_siphash_key(key).hash_u64(
+            int.from_bytes(last_code.to_bytes(4, "big") * 2, "little")
+        )  # We hash it
+        # We XOR the two 32bits halves together and convert the value to an INT no
+        # greater than 9 digits, as convert_hash_to_token() does
+        token = ((token_hash >> 32) ^ token_hash) >> 2 & 0x3FFFFFFF
+        if token > 999999999:
+            token = token - 73741825
+        return token
 
     @classmethod
     def convert_hash_to_token(cls, this_hash):
-        hash_int = struct.pack(">Q", this_hash)  # We convert the hash to bytes
-        hi_hash = struct.unpack(">L", hash_int[0:4])[0]  # We split it in two 32bits INT
-        lo_hash = struct.unpack(">L", hash_int[4:8])[0]
-        result_hash = (
-            hi_hash ^ lo_hash
-        )  # We XOR the two together to get a single 32bits INT
+        result_hash = (this_hash >> 32) ^ (
+            this_hash & 0xFFFFFFFF
+        )  # We XOR the two 32bits halves together to get a single 32bits INT
         token = cls._convert_to_29_5_bits(
             result_hash
         )  # We convert the 32bits value to an INT no greater than 9 digits
@@ -79,36 +91,16 @@ class OpenPAYGOTokenShared(object):
 
     @classmethod
     def convert_to_4_digit_token(cls, source):
-        restricted_digit_token = ""
-        bit_array = cls._bit_array_from_int(source, 30)
-        for i in range(15):
-            this_array = bit_array[i * 2 : (i * 2) + 2]
-            restricted_digit_token += str(cls._bit_array_to_int(this_array) + 1)
-        return int(restricted_digit_token)
+        # We write the 30 bits as 32 bits in hexadecimal and drop the first digit
+        digits = "{:08x}".format(source & 0x3FFFFFFF).translate(
+            RESTRICTED_DIGITS_FROM_HEX
+        )
+        return int(digits[1:])
 
     @classmethod
     def convert_from_4_digit_token(cls, source):
-        bit_array = []
-        for digit in str(source):
-            digit = int(digit) - 1
-            this_array = cls._bit_array_from_int(digit, 2)
-            bit_array += this_array
-        return cls._bit_array_to_int(bit_array)
+        return int(str(source).translate(BASE_4_FROM_RESTRICTED_DIGITS), 4)
 
     @classmethod
     def generate_hash(cls, key, value):
-        return siphash.SipHash_2_4(key, value).hash()
-
-    @classmethod
-    def _bit_array_to_int(cls, bit_array):
-        integer = 0
-        for bit in bit_array:
-            integer = (integer << 1) | bit
-        return integer
-
-    @classmethod
-    def _bit_array_from_int(cls, source, bits):
-        bit_array = []
-        for i in range(bits):
-            bit_array += [bool(source & (1 << (bits - 1 - i)))]
-        return bit_array
+        return get_siphash_key(key).hash(value)
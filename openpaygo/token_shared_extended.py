@@ -1,6 +1,5 @@
-import struct
-
-import siphash
+from .siphash_key import load_siphash_key
+from .token_shared import BASE_4_FROM_RESTRICTED_DIGITS, RESTRICTED_DIGITS_FROM_HEX
 
 
 class OpenPAYGOTokenSharedExtended(object):
@@ -20,12 +19,16 @@ class OpenPAYGOTokenSharedExtended(object):
 
     @classmethod
     def generate_next_token(cls, last_code, key):
-        conformed_token = struct.pack(">Q", last_code)  # We convert the token to bytes
-        token_hash = siphash.SipHash_2_4(key, conformed_token).hash()  # We hash it
-        new_token = cls.convert_hash_to_token(
-            token_hash
-        )  # We convert to token and return
-        return new_token
+        conformed_token = int.from_bytes(
+            last_code.to_bytes(8, "big"), "little"
+        )  # We convert the token to the little endian integer that SipHash works on
+        token_hash = load_siphash_key(key).hash_u64(conformed_token)  # We hash it
+        # We convert the 64bits value to an INT no greater than 12 digits, as
+        # convert_hash_to_token() does
+        token = token_hash >> 24
+        if token > 999999999999:
+            token = token - 99511627777
+        return token
 
     @classmethod
     def convert_hash_to_token(cls, this_hash):
@@ -44,32 +47,12 @@ class OpenPAYGOTokenSharedExtended(object):
 
     @classmethod
     def convert_to_4_digit_token(cls, source):
-        restricted_digit_token = ""
-        bit_array = cls._bit_array_from_int(source, 40)
-        for i in range(20):
-            this_array = bit_array[i * 2 : (i * 2) + 2]
-            restricted_digit_token += str(cls._bit_array_to_int(this_array) + 1)
-        return int(restricted_digit_token)
+        return int(
+            "{:010x}".format(source & 0xFFFFFFFFFF).translate(
+                RESTRICTED_DIGITS_FROM_HEX
+            )
+        )
 
     @classmethod
     def convert_from_4_digit_token(cls, source):
-        bit_array = []
-        for digit in str(source):
-            digit = int(digit) - 1
-            this_array = cls._bit_array_from_int(digit, 2)
-            bit_array += this_array
-        return cls._bit_array_to_int(bit_array)
-
-    @classmethod
-    def _bit_array_to_int(cls, bit_array):
-        integer = 0
-        for bit in bit_array:
-            integer = (integer << 1) | bit
-        return integer
-
-    @classmethod
-    def _bit_array_from_int(cls, source, bits):
-        bit_array = []
-        for i in range(bits):
-            bit_array += [bool(source & (1 << (bits - 1 - i)))]
-        return bit_array
+        return int(str(source).translate(BASE_4_FROM_RESTRICTED_DIGITS), 4)
@@ -0,0 +1,237 @@
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import zlib
+from contextlib import nullcontext
+from multiprocessing import resource_tracker, shared_memory
+
+from .token_chain_cache import TokenChainCache
+from .token_checkpoint_store import get_chain_id
+
+SHARED_CACHE_MAGIC = b"OPGSHMC1"
+SHARED_CACHE_HEADER_STRUCT = struct.Struct("<8sQLQ")
+# Each slot holds a sequence number (odd while it is being written), a CRC of the
+# record, the chain ID, the checkpoint index, the code and the write stamp used to
+# choose which slot to evict
+SHARED_CACHE_SLOT_STRUCT = struct.Struct("<LL16sLQQ4x")
+SHARED_CACHE_RECORD_STRUCT = struct.Struct("<16sLQ")
+_SEQUENCE_STRUCT = struct.Struct("<L")
+_STAMP_OFFSET = 20
+_EMPTY_CHAIN_ID = bytes(16)
+_FIBONACCI_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class SharedMemoryChainCache(TokenChainCache):
+    # A TokenChainCache storing the checkpoints in a fixed size open addressing table
+    # in shared memory, so that all the worker processes of a host share the same
+    # cache. Each checkpoint lives in one of MAX_PROBES slots after its hash, when
+    # they are all taken the oldest one is replaced. Reads never lock: a record
+    # being written is detected with its sequence number, and a torn record with
+    # its CRC, and both are treated as a miss. Writes are serialized with a lock
+    # shared by the processes: a multiprocessing.Lock is created with the cache, and
+    # must be given to the processes attaching to it (inherited when forking, or
+    # through the initializer of a pool). Without a lock (lock=False), two writers
+    # can claim the same slot at once and lose updates, so it is only safe when a
+    # single process writes to the cache.
+
+    DEFAULT_SLOTS = 1 << 16
+    MAX_PROBES = 8
+    # We look for a checkpoint at most this many intervals before the count
+    MAX_CHECKPOINT_LOOKBACK = 4
+
+    def __init__(
+        self,
+        name=None,
+        slots=DEFAULT_SLOTS,
+        checkpoint_interval=TokenChainCache.DEFAULT_CHECKPOINT_INTERVAL,
+        create=True,
+        lock=None,
+    ):
+        if lock is None:
+            if not create:
+                raise ValueError(
+                    "The lock of the cache must be given when attaching to it, or "
+                    "lock=False if this is the only process writing to it."
+                )
+            lock = multiprocessing.Lock()
+        if create:
+            if slots < self.MAX_PROBES or slots & (slots - 1):
+                raise ValueError(
+                    "The number of slots must be a power of 2 of at least {}.".format(
+                        self.MAX_PROBES
+                    )
+                )
+            self._shared_memory = shared_memory.SharedMemory(
+                name=name,
+                create=True,
+                size=SHARED_CACHE_HEADER_STRUCT.size
+                + slots * SHARED_CACHE_SLOT_STRUCT.size,
+            )
+            SHARED_CACHE_HEADER_STRUCT.pack_into(
+                self._shared_memory.buf,
+                0,
+                SHARED_CACHE_MAGIC,
+                slots,
+                checkpoint_interval,
+                0,
+            )
+        else:
+            self._shared_memory = self._attach_shared_memory(name)
+            magic, slots, checkpoint_interval, _ = (
+                SHARED_CACHE_HEADER_STRUCT.unpack_from(self._shared_memory.buf, 0)
+            )
+            if magic != SHARED_CACHE_MAGIC:
+                self._shared_memory.close()
+                raise ValueError("The shared memory is not a token chain cache.")
+        super().__init__(checkpoint_interval=checkpoint_interval)
+        self.name = self._shared_memory.name
+        self.slots = slots
+        self.lock = None if lock is False else lock
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._buffer = self._shared_memory.buf
+
+    def __len__(self):
+        return sum(
+            1
+            for slot in range(self.slots)
+            if SHARED_CACHE_SLOT_STRUCT.unpack_from(
+                self._buffer, self._get_slot_offset(slot)
+            )[2]
+            != _EMPTY_CHAIN_ID
+        )
+
+    def clear(self):
+        with self._get_write_lock():
+            start = SHARED_CACHE_HEADER_STRUCT.size
+            self._buffer[start:] = bytes(len(self._buffer) - start)
+
+    def close(self):
+        self._buffer = None
+        self._shared_memory.close()
+
+    def unlink(self):
+        self._shared_memory.unlink()
+
+    def get_stats(self):
+        # The hits and misses are the ones of this process, the occupancy is the one
+        # of the shared table
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        occupied = len(self)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "slots": self.slots,
+            "occupied": occupied,
+            "occupancy": occupied / self.slots,
+        }
+
+    def _get_checkpoint(self, chain_key, count):
+        chain_id = get_chain_id(chain_key)
+        index = count // self.checkpoint_interval
+        for index in range(index, max(index - self.MAX_CHECKPOINT_LOOKBACK, 0), -1):
+            code = self._read_record(chain_id, index)
+            if code is not None:
+                with self._stats_lock:
+                    self.hits += 1
+                return index * self.checkpoint_interval, code
+        with self._stats_lock:
+            self.misses += 1
+        return None
+
+    def _add_checkpoint(self, chain_key, count, code):
+        chain_id = get_chain_id(chain_key)
+        index = count // self.checkpoint_interval
+        record = SHARED_CACHE_RECORD_STRUCT.pack(chain_id, index, code)
+        with self._get_write_lock():
+            slot_offset = self._get_slot_offset(self._find_write_slot(chain_id, index))
+            stamp = SHARED_CACHE_HEADER_STRUCT.unpack_from(self._buffer, 0)[3] + 1
+            struct.pack_into("<Q", self._buffer, _STAMP_OFFSET, stamp)
+            sequence = _SEQUENCE_STRUCT.unpack_from(self._buffer, slot_offset)[0]
+            _SEQUENCE_STRUCT.pack_into(
+                self._buffer, slot_offset, (sequence + 1) & 0xFFFFFFFF
+            )
+            SHARED_CACHE_SLOT_STRUCT.pack_into(
+                self._buffer,
+                slot_offset,
+                (sequence + 1) & 0xFFFFFFFF,
+                zlib.crc32(record),
+                chain_id,
+                index,
+                code,
+                stamp,
+            )
+            _SEQUENCE_STRUCT.pack_into(
+                self._buffer, slot_offset, (sequence + 2) & 0xFFFFFFFF
+            )
+
+    def _read_record(self, chain_id, index):
+        for slot in self._get_probe_slots(chain_id, index):
+            slot_offset = self._get_slot_offset(slot)
+            sequence, crc, slot_chain_id, slot_index, code, _ = (
+                SHARED_CACHE_SLOT_STRUCT.unpack_from(self._buffer, slot_offset)
+            )
+            if slot_chain_id == _EMPTY_CHAIN_ID:
+                return None
+            if slot_chain_id != chain_id or slot_index != index or sequence & 1:
+                continue
+            if crc != zlib.crc32(
+                SHARED_CACHE_RECORD_STRUCT.pack(chain_id, index, code)
+            ):
+                continue
+            if _SEQUENCE_STRUCT.unpack_from(self._buffer, slot_offset)[0] == sequence:
+                return code
+        return None
+
+    def _find_write_slot(self, chain_id, index):
+        # We use the slot already holding this checkpoint or the first empty one,
+        # otherwise we replace the one written the longest ago
+        oldest_slot = None
+        oldest_stamp = None
+        for slot in self._get_probe_slots(chain_id, index):
+            _, _, slot_chain_id, slot_index, _, stamp = (
+                SHARED_CACHE_SLOT_STRUCT.unpack_from(
+                    self._buffer, self._get_slot_offset(slot)
+                )
+            )
+            if slot_chain_id == _EMPTY_CHAIN_ID or (
+                slot_chain_id == chain_id and slot_index == index
+            ):
+                return slot
+            if oldest_stamp is None or stamp < oldest_stamp:
+                oldest_slot, oldest_stamp = slot, stamp
+        return oldest_slot
+
+    def _get_probe_slots(self, chain_id, index):
+        first_slot = (
+            int.from_bytes(chain_id[:8], "little") + index * _FIBONACCI_MULTIPLIER
+        ) & (self.slots - 1)
+        return [
+            (first_slot + probe) & (self.slots - 1) for probe in range(self.MAX_PROBES)
+        ]
+
+    def _get_slot_offset(self, slot):
+        return SHARED_CACHE_HEADER_STRUCT.size + slot * SHARED_CACHE_SLOT_STRUCT.size
+
+    @classmethod
+    def _attach_shared_memory(cls, name):
+        # Only the process that created the cache should remove it on exit, so the
+        # processes attaching to it must not register it with the resource tracker
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        attached_shared_memory = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            # Before Python 3.13 it is always registered, and only on POSIX
+            resource_tracker.unregister(attached_shared_memory._name, "shared_memory")
+        return attached_shared_memory
+
+    def _get_write_lock(self):
+        if self.lock is None:
+            return nullcontext()
+        return self.lock
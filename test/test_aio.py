@@ -0,0 +1,166 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from openpaygo import (
+    AuthMethod,
+    MetricsRequestHandler,
+    MetricsResponseHandler,
+    OpenPAYGOTokenDecoder,
+    OpenPAYGOTokenEncoder,
+    aio,
+)
+
+SECRET_KEY = "bc41ec9530f6dac86b1a29ab82edc5fb"
+STARTING_CODE = 516959010
+
+
+def get_metrics_payload():
+    metrics_request = MetricsRequestHandler(
+        serial_number="aaa111222",
+        secret_key=SECRET_KEY,
+        auth_method=AuthMethod.SIMPLE_AUTH,
+    )
+    metrics_request.set_request_count(3)
+    metrics_request.set_data({"token_count": 3, "tampered": False})
+    return metrics_request.get_simple_request_payload()
+
+
+def test_async_token_functions():
+    token_kwargs = dict(
+        secret_key=SECRET_KEY, count=200, value=7, starting_code=STARTING_CODE
+    )
+    count, token = asyncio.run(aio.agenerate_token(**token_kwargs))
+    assert (count, token) == OpenPAYGOTokenEncoder.generate_token(**token_kwargs)
+    decode_kwargs = dict(
+        token=str(token).zfill(9),
+        secret_key=SECRET_KEY,
+        count=1,
+        used_counts=[],
+        starting_code=STARTING_CODE,
+    )
+    assert asyncio.run(
+        aio.adecode_token(**decode_kwargs)
+    ) == OpenPAYGOTokenDecoder.decode_token(**decode_kwargs)
+
+
+def test_async_metrics_functions():
+    async def handle(payload):
+        handler = await aio.ametrics_response_handler(payload, secret_key=SECRET_KEY)
+        return handler, await aio.ais_auth_valid(handler)
+
+    payload = get_metrics_payload()
+    handler, auth_valid = asyncio.run(handle(payload))
+    expected_handler = MetricsResponseHandler(payload, secret_key=SECRET_KEY)
+    assert auth_valid == expected_handler.is_auth_valid() is True
+    assert (
+        asyncio.run(aio.aget_simple_metrics(handler))
+        == expected_handler.get_simple_metrics()
+    )
+    assert asyncio.run(aio.aget_answer_payload(handler)) == (
+        expected_handler.get_answer_payload()
+    )
+
+
+def test_async_runner_coalesces_identical_requests():
+    calls = []
+    release = threading.Event()
+
+    def slow_add(a, b):
+        calls.append((a, b))
+        release.wait(5)
+        return a + b
+
+    async def run_all(runner):
+        tasks = [
+            asyncio.ensure_future(
+                runner.run(slow_add, 1, b, coalesce_key=("add", 1, b))
+            )
+            for b in (2, 2, 2, 3)
+        ]
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(run_all(aio.AsyncRunner())) == [3, 3, 3, 4]
+    assert sorted(calls) == [(1, 2), (1, 3)]
+
+
+def test_async_runner_coalesced_results_are_copied():
+    release = threading.Event()
+
+    def slow_decode():
+        release.wait(5)
+        return 7, 1, 12, [10, 12]
+
+    async def run_all(runner):
+        tasks = [
+            asyncio.ensure_future(runner.run(slow_decode, coalesce_key="decode"))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(run_all(aio.AsyncRunner()))
+    results[0][3].append(13)
+    assert results[0][3] == [10, 12, 13]
+    assert results[1] == results[2] == (7, 1, 12, [10, 12])
+    assert results[1][3] is not results[2][3]
+
+
+def test_async_runner_coalesce_key():
+    get_key = aio.AsyncRunner._get_coalesce_key
+    used_counts_mask = {"highest_count": 150, "mask": 5}
+    assert get_key("decode_token", {"used_counts": [149, 150]}) == get_key(
+        "decode_token", {"used_counts": [149, 150]}
+    )
+    assert get_key("decode_token", {"used_counts": used_counts_mask}) == get_key(
+        "decode_token", {"used_counts": dict(used_counts_mask)}
+    )
+    assert get_key("decode_token", {"used_counts": used_counts_mask}) != get_key(
+        "decode_token", {"used_counts": [150, 5]}
+    )
+    assert get_key("decode_token", {"used_counts": [[149], 150]}) is None
+
+
+def test_async_runner_bounds_concurrency():
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running.append(1)
+            max_running.append(len(running))
+        threading.Event().wait(0.01)
+        with lock:
+            running.pop()
+
+    async def run_all(runner):
+        await asyncio.gather(*[runner.run(work) for _ in range(10)])
+
+    asyncio.run(run_all(aio.AsyncRunner(max_concurrency=2)))
+    assert max(max_running) == 2
+    with pytest.raises(ValueError):
+        aio.AsyncRunner(max_concurrency=0)
+
+
+def test_async_runner_with_process_pool():
+    _, token = OpenPAYGOTokenEncoder.generate_token(
+        secret_key=SECRET_KEY, count=10, value=7, starting_code=STARTING_CODE
+    )
+    decode_kwargs = dict(
+        token=str(token).zfill(9),
+        secret_key=SECRET_KEY,
+        count=9,
+        used_counts=[8, 9],
+        starting_code=STARTING_CODE,
+    )
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        runner = aio.AsyncRunner(executor=executor)
+        result = asyncio.run(runner.decode_token(**decode_kwargs))
+    assert result == OpenPAYGOTokenDecoder.decode_token(**decode_kwargs)
+    assert result[0] == 7
@@ -0,0 +1,205 @@
+import csv
+import json
+
+import pytest
+
+from openpaygo import OpenPAYGOTokenDecoder, OpenPAYGOTokenEncoder
+from openpaygo.cli import main
+
+with open("test/test_tokens.jsonl") as f:
+    sample_data = [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_generate_jsonl(tmp_path, workers, capsys):
+    input_path = tmp_path / "devices.jsonl"
+    output_path = tmp_path / "tokens.jsonl"
+    with open(input_path, "w") as f:
+        for data in sample_data:
+            f.write(json.dumps(dict(data, value=data["value_raw"])) + "\n")
+
+    main(
+        [
+            "generate",
+            str(input_path),
+            "-o",
+            str(output_path),
+            "--workers",
+            workers,
+            "--chunk-size",
+            "5",
+        ]
+    )
+
+    with open(output_path) as f:
+        results = [json.loads(line) for line in f]
+    assert [(result["new_count"], result["token"]) for result in results] == [
+        (data["new_count"], data["token"]) for data in sample_data
+    ]
+    assert "rows/sec" in capsys.readouterr().err
+
+
+def test_decode_csv(tmp_path):
+    input_path = tmp_path / "tokens.csv"
+    output_path = tmp_path / "decoded.csv"
+    rows = [
+        data
+        for data in sample_data
+        if data["token_type"] == "ADD_TIME" and not data["extended_token"]
+    ]
+    with open(input_path, "w", newline="") as f:
+        writer = csv.DictWriter(
+            f,
+            fieldnames=[
+                "serial_number",
+                "secret_key",
+                "starting_code",
+                "restricted_digit_set",
+                "count",
+                "used_counts",
+                "token",
+            ],
+        )
+        writer.writeheader()
+        for data in rows:
+            writer.writerow(
+                {
+                    "serial_number": data["serial_number"],
+                    "secret_key": data["key"],
+                    "starting_code": data["starting_code"],
+                    "restricted_digit_set": data["restricted_digit_set"],
+                    "count": data["count"],
+                    "used_counts": json.dumps([data["count"]]),
+                    "token": data["token"],
+                }
+            )
+        writer.writerow({"serial_number": "BROKEN", "secret_key": "not hex"})
+
+    main(["decode", str(input_path), "-o", str(output_path), "--report-every", "0"])
+
+    with open(output_path, newline="") as f:
+        results = list(csv.DictReader(f))
+    for data, result in zip(rows, results):
+        assert result["serial_number"] == data["serial_number"]
+        assert result["token_type"] == "ADD_TIME"
+        assert int(result["new_count"]) == data["new_count"]
+        assert float(result["value"]) == data["value_raw"]
+    assert results[-1]["serial_number"] == "BROKEN"
+    assert results[-1]["error"].startswith("ValueError")
+
+
+def test_decode_csv_used_counts_mask_round_trip(tmp_path):
+    secret_key = "a29ab82edc5fbbc41ec9530f6dac86b1"
+    tokens = [
+        OpenPAYGOTokenEncoder.generate_token(
+            secret_key=secret_key, count=count, value=value, starting_code=123456789
+        )
+        for count, value in [(10, 3), (12, 4)]
+    ]
+    used_counts = json.dumps(OpenPAYGOTokenDecoder.used_counts_to_mask([10]))
+    for step, (new_count, token) in enumerate(tokens):
+        input_path = tmp_path / "tokens_{}.csv".format(step)
+        output_path = tmp_path / "decoded_{}.csv".format(step)
+        with open(input_path, "w", newline="") as f:
+            writer = csv.DictWriter(
+                f,
+                fieldnames=[
+                    "secret_key",
+                    "starting_code",
+                    "count",
+                    "used_counts",
+                    "token",
+                ],
+            )
+            writer.writeheader()
+            writer.writerow(
+                {
+                    "secret_key": secret_key,
+                    "starting_code": 123456789,
+                    "count": new_count - 2,
+                    "used_counts": used_counts,
+                    "token": token,
+                }
+            )
+
+        main(["decode", str(input_path), "-o", str(output_path)])
+
+        with open(output_path, newline="") as f:
+            (result,) = list(csv.DictReader(f))
+        assert result["error"] == ""
+        assert result["token_type"] == "ADD_TIME"
+        assert int(result["new_count"]) == new_count
+        used_counts = result["used_counts"]
+        assert json.loads(used_counts)["highest_count"] == new_count
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_generate_jsonl_invalid_lines(tmp_path, workers):
+    input_path = tmp_path / "devices.jsonl"
+    output_path = tmp_path / "tokens.jsonl"
+    with open(input_path, "w") as f:
+        f.write(json.dumps(dict(sample_data[0], value=sample_data[0]["value_raw"])))
+        f.write('\n{"secret_key": \n[1, 2]\n')
+        f.write(json.dumps(dict(sample_data[1], value=sample_data[1]["value_raw"])))
+
+    main(["generate", str(input_path), "-o", str(output_path), "-w", workers])
+
+    with open(output_path) as f:
+        results = [json.loads(line) for line in f]
+    assert len(results) == 4
+    assert results[0]["token"] == sample_data[0]["token"]
+    assert results[1]["error"].startswith("ValueError: Invalid JSON on line 2")
+    assert results[2]["error"] == "ValueError: The line 3 is not a JSON object."
+    assert results[3]["token"] == sample_data[1]["token"]
+
+
+def test_generate_csv_first_row_invalid(tmp_path):
+    input_path = tmp_path / "devices.jsonl"
+    output_path = tmp_path / "tokens.csv"
+    with open(input_path, "w") as f:
+        f.write('{"secret_key": \n')
+        for data in sample_data[:2]:
+            f.write(json.dumps(dict(data, value=data["value_raw"])) + "\n")
+
+    main(["generate", str(input_path), "-o", str(output_path)])
+
+    with open(output_path, newline="") as f:
+        results = list(csv.DictReader(f))
+    assert results[0]["error"].startswith("ValueError: Invalid JSON on line 1")
+    for data, result in zip(sample_data[:2], results[1:]):
+        assert result["serial_number"] == data["serial_number"]
+        assert result["key"] == data["key"]
+        assert result["token"] == data["token"]
+
+
+def test_output_kept_if_input_unreadable(tmp_path):
+    input_path = tmp_path / "devices.jsonl"
+    output_path = tmp_path / "tokens.jsonl"
+    input_path.write_bytes(b"\xff\xfe not utf-8\n")
+    output_path.write_text("previous results\n")
+
+    with pytest.raises(UnicodeDecodeError):
+        main(["generate", str(input_path), "-o", str(output_path)])
+
+    assert output_path.read_text() == "previous results\n"
+
+
+def test_help_lists_every_command(capsys):
+    with pytest.raises(SystemExit):
+        main(["--help"])
+    assert "{generate,decode,provision}" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "argv, error",
+    [
+        (["provision", "devices.bin"], "openpaygo provision: error:"),
+        (["generate", "--workers", "x"], "openpaygo generate: error:"),
+        (["unknown"], "openpaygo: error: argument command:"),
+    ],
+)
+def test_argument_errors(argv, error, capsys):
+    with pytest.raises(SystemExit) as exc_info:
+        main(argv)
+    assert exc_info.value.code == 2
+    assert error in capsys.readouterr().err
@@ -0,0 +1,399 @@
+import json
+import random
+
+import pytest
+
+from openpaygo import (
+    DeviceTokenContext,
+    InvalidTokenCache,
+    OpenPAYGOTokenDecoder,
+    OpenPAYGOTokenEncoder,
+    TokenChainCache,
+    TokenType,
+)
+from openpaygo.token_shared import OpenPAYGOTokenShared
+
+SECRET_KEY = "bc41ec9530f6dac86b1a29ab82edc5fb"
+STARTING_CODE = 516959010
+
+
+def generate(count, value=None, token_type=TokenType.ADD_TIME, **kwargs):
+    return OpenPAYGOTokenEncoder.generate_token(
+        secret_key=SECRET_KEY,
+        count=count,
+        value=value,
+        token_type=token_type,
+        starting_code=STARTING_CODE,
+        **kwargs,
+    )
+
+
+def decode(token, count, used_counts=None, **kwargs):
+    return OpenPAYGOTokenDecoder.decode_token(
+        token=token,
+        secret_key=SECRET_KEY,
+        count=count,
+        used_counts=used_counts,
+        starting_code=STARTING_CODE,
+        **kwargs,
+    )
+
+
+@pytest.fixture(scope="module")
+def chain_cache():
+    return TokenChainCache(checkpoint_interval=8)
+
+
+@pytest.mark.parametrize("restricted_digit_set", [False, True])
+@pytest.mark.parametrize(
+    "token_count,last_count,used_counts",
+    [
+        (150, 149, [149]),  # Next token
+        (210, 149, [149]),  # Token jump forward
+        (140, 149, [147, 148, 149]),  # Unused older token
+        (146, 149, [146, 147, 148, 149]),  # Already used older token
+        (20, 149, [149]),  # Token older than the unused tokens window
+        (250, 149, [149]),  # Token too far in the future
+    ],
+)
+def test_decode_with_chain_cache_matches_full_walk(
+    chain_cache, restricted_digit_set, token_count, last_count, used_counts
+):
+    new_count, token = generate(
+        token_count - 2, 5, restricted_digit_set=restricted_digit_set
+    )
+    assert new_count == token_count
+    expected = decode(
+        token, last_count, used_counts, restricted_digit_set=restricted_digit_set
+    )
+    assert (
+        decode(
+            token,
+            last_count,
+            used_counts,
+            restricted_digit_set=restricted_digit_set,
+            chain_cache=chain_cache,
+        )
+        == expected
+    )
+
+
+def test_decode_with_chain_cache_semantics(chain_cache):
+    _, old_token = generate(20, 5)
+    _, valid_token = generate(148, 5)
+    assert decode(old_token, 149, [149], chain_cache=chain_cache)[1] == (
+        TokenType.ALREADY_USED
+    )
+    assert decode(valid_token, 149, [149], chain_cache=chain_cache) == (
+        5,
+        TokenType.ADD_TIME,
+        150,
+        [149, 150],
+    )
+    assert decode("123456789", 149, [149], chain_cache=chain_cache)[1] == (
+        TokenType.INVALID
+    )
+
+
+def test_decode_counter_sync_with_chain_cache(chain_cache):
+    _, token = generate(99, token_type=TokenType.COUNTER_SYNC)
+    expected = decode(token, 140, [140])
+    assert expected[1] == TokenType.COUNTER_SYNC
+    assert decode(token, 140, [140], chain_cache=chain_cache) == expected
+
+
+def test_decode_extended_with_chain_cache(chain_cache):
+    _, token = generate(300, 123456, extended_token=True)
+    expected = decode(token, 301, [301])
+    assert expected[:3] == (123456, TokenType.ADD_TIME, 302)
+    assert decode(token, 301, [301], chain_cache=chain_cache) == expected
+    assert decode(token, 330, [330], chain_cache=chain_cache)[1] == (
+        TokenType.ALREADY_USED
+    )
+    assert decode("123456789012", 301, [301])[1] == TokenType.INVALID
+
+
+def test_decode_chain_cache_paths(monkeypatch):
+    hashes = []
+    generate_next_token = OpenPAYGOTokenShared.generate_next_token
+
+    def counting_generate_next_token(last_code, key):
+        hashes.append(last_code)
+        return generate_next_token(last_code, key)
+
+    _, valid_token = generate(998, 5)
+    chain_cache = TokenChainCache()
+    decode(valid_token, 999, [999], chain_cache=chain_cache)
+    monkeypatch.setattr(
+        OpenPAYGOTokenShared, "generate_next_token", counting_generate_next_token
+    )
+    # The counts that can still be accepted resume from the closest checkpoint
+    assert decode(valid_token, 999, [999], chain_cache=chain_cache)[2] == 1000
+    assert len(hashes) < 64 + OpenPAYGOTokenDecoder.MAX_TOKEN_JUMP
+    # Telling an already used token from an invalid one needs all the older codes,
+    # so the rejection path still walks the chain from zero
+    del hashes[:]
+    assert decode("123456789", 999, [999], chain_cache=chain_cache)[1] == (
+        TokenType.INVALID
+    )
+    assert len(hashes) > 999
+    # Entering the same invalid token again is skipped with an InvalidTokenCache
+    invalid_token_cache = InvalidTokenCache()
+    for _ in range(2):
+        del hashes[:]
+        decode(
+            "123456789",
+            999,
+            [999],
+            chain_cache=chain_cache,
+            invalid_token_cache=invalid_token_cache,
+        )
+    assert hashes == []
+
+
+def test_device_token_context_round_trip():
+    context = DeviceTokenContext(SECRET_KEY, starting_code=STARTING_CODE)
+    count, used_counts = 1, [1]
+    for value in [3, 4, 5]:
+        new_count, token = context.generate(count, value)
+        assert context.decode(token, count, used_counts) == decode(
+            token, count, used_counts
+        )
+        _, _, count, used_counts = context.decode(token, count, used_counts)
+        assert count == new_count
+    assert context.decode(token, count, used_counts)[1] == TokenType.ALREADY_USED
+
+
+def test_used_counts_mask_round_trip():
+    used_counts = [134, 140, 141, 147, 149, 150]
+    used_counts_mask = OpenPAYGOTokenDecoder.used_counts_to_mask(used_counts)
+    assert used_counts_mask == {"highest_count": 150, "mask": 0b1000001100000101}
+    used_counts_from_mask = OpenPAYGOTokenDecoder.used_counts_from_mask(
+        used_counts_mask
+    )
+    assert used_counts_from_mask == used_counts
+    packed = OpenPAYGOTokenDecoder.pack_used_counts_mask(used_counts_mask)
+    assert len(packed) == 6
+    assert OpenPAYGOTokenDecoder.unpack_used_counts_mask(packed) == used_counts_mask
+    # The compact form is not mistaken for a list of counts once stored as JSON
+    assert json.loads(json.dumps(used_counts_mask)) == used_counts_mask
+
+
+def test_decode_with_used_counts_mask_matches_list():
+    rng = random.Random(42)
+    tokens = []
+    count = 1
+    for _ in range(40):
+        token_type = rng.choice([TokenType.ADD_TIME] * 4 + [TokenType.SET_TIME])
+        count, token = generate(count, rng.randrange(1, 10), token_type)
+        tokens.append(token)
+    last_count, used_counts = 1, [1]
+    used_counts_mask = OpenPAYGOTokenDecoder.used_counts_to_mask(used_counts)
+    for _ in range(80):
+        token = rng.choice(tokens)
+        result = decode(token, last_count, used_counts)
+        mask_result = decode(token, last_count, used_counts_mask)
+        assert result[:3] == mask_result[:3]
+        if result[3] is not None:
+            expected_mask = OpenPAYGOTokenDecoder.used_counts_to_mask(result[3])
+            assert mask_result[3] == expected_mask
+            expected_counts = OpenPAYGOTokenDecoder.used_counts_from_mask(
+                mask_result[3]
+            )
+            assert result[3] == expected_counts
+            last_count = max(last_count, result[2])
+            # The compact form is kept as JSON between the decodings
+            used_counts = result[3]
+            used_counts_mask = json.loads(json.dumps(mask_result[3]))
+
+
+def test_decode_prescreen_rejects_impossible_values():
+    invalid_token_cache = InvalidTokenCache()
+    for value in [996, 997]:
+        token_base = (STARTING_CODE + value) % 1000
+        token = "{:09d}".format(123456000 + token_base)
+        assert decode(token, 10, [10])[1] == TokenType.INVALID
+        assert (
+            decode(token, 10, [10], invalid_token_cache=invalid_token_cache)[1]
+            == TokenType.INVALID
+        )
+    assert invalid_token_cache.prescreen_rejections == 2
+    assert len(invalid_token_cache) == 0
+
+
+def test_decode_with_invalid_token_cache():
+    invalid_token_cache = InvalidTokenCache(max_entries=2, stripes=1)
+    new_count, token = generate(200, 5)
+    for _ in range(3):
+        assert (
+            decode(token, 10, [10], invalid_token_cache=invalid_token_cache)[1]
+            == TokenType.INVALID
+        )
+    assert invalid_token_cache.cache_hits == 2
+    assert invalid_token_cache.short_circuited == 2
+    # The same token becomes valid once the count is close enough
+    assert decode(
+        token, new_count - 2, [new_count - 2], invalid_token_cache=invalid_token_cache
+    )[1:3] == (TokenType.ADD_TIME, new_count)
+    for count in [20, 30, 40]:
+        decode(token, count, [count], invalid_token_cache=invalid_token_cache)
+    assert len(invalid_token_cache) == 2
+
+
+@pytest.mark.parametrize("restricted_digit_set", [False, True])
+def test_suggest_token_corrections_matches_decoding_each_candidate(
+    restricted_digit_set,
+):
+    count, used_counts = 30, [27, 28, 30]
+    tokens = [
+        generate(36, 5, restricted_digit_set=restricted_digit_set)[1],
+        generate(27, 5, restricted_digit_set=restricted_digit_set)[1],
+    ]
+    for token in tokens:
+        typo = token[:4] + ("2" if token[4] == "1" else "1") + token[5:]
+        corrections = OpenPAYGOTokenDecoder.suggest_token_corrections(
+            typo,
+            SECRET_KEY,
+            count,
+            used_counts,
+            starting_code=STARTING_CODE,
+            restricted_digit_set=restricted_digit_set,
+        )
+        suggested = {correction[0]: correction for correction in corrections}
+        for candidate in OpenPAYGOTokenDecoder._get_token_corrections(
+            typo, restricted_digit_set
+        ):
+            value, token_type, new_count, _ = decode(
+                candidate,
+                count,
+                used_counts,
+                restricted_digit_set=restricted_digit_set,
+            )
+            if token_type == TokenType.INVALID:
+                assert candidate not in suggested
+            else:
+                assert suggested[candidate] == (candidate, value, token_type, new_count)
+        assert token in suggested
+
+
+def test_suggest_token_corrections_ranking():
+    new_count, token = generate(30, 7)
+    typo = token[:7] + token[8] + token[7]
+    if typo == token:
+        typo = token[:2] + token[3] + token[2] + token[3:]
+    corrections = OpenPAYGOTokenDecoder.suggest_token_corrections(
+        typo, SECRET_KEY, 30, [30], starting_code=STARTING_CODE
+    )
+    assert corrections[0] == (token, 7, TokenType.ADD_TIME, new_count)
+    with pytest.raises(ValueError):
+        OpenPAYGOTokenDecoder.suggest_token_corrections(
+            "1234", SECRET_KEY, 30, starting_code=STARTING_CODE
+        )
+
+
+@pytest.mark.parametrize("restricted_digit_set", [False, True])
+def test_decode_tokens_matches_sequential_decoding(restricted_digit_set):
+    used_counts = [1]
+    rng = random.Random(7)
+    tokens = []
+    count = 1
+    for _ in range(30):
+        token_type = rng.choice([TokenType.ADD_TIME] * 3 + [TokenType.SET_TIME])
+        count, token = generate(
+            count,
+            rng.randrange(1, 10),
+            token_type,
+            restricted_digit_set=restricted_digit_set,
+        )
+        tokens.append(token)
+    tokens.append(generate(count, token_type=TokenType.COUNTER_SYNC)[1])
+    tokens.append(generate(400, 3, restricted_digit_set=restricted_digit_set)[1])
+    tokens = rng.sample(tokens, len(tokens)) + tokens[:5]
+    results, last_count, last_used_counts = OpenPAYGOTokenDecoder.decode_tokens(
+        tokens,
+        SECRET_KEY,
+        1,
+        used_counts,
+        starting_code=STARTING_CODE,
+        restricted_digit_set=restricted_digit_set,
+    )
+    count = 1
+    for token, result in zip(tokens, results):
+        expected = decode(
+            token, count, used_counts, restricted_digit_set=restricted_digit_set
+        )
+        assert result == expected
+        value, token_type, token_count, updated_counts = expected
+        if token_type not in [TokenType.ALREADY_USED, TokenType.INVALID]:
+            if token_count > count or value == 999:
+                count = token_count
+            used_counts = updated_counts
+    assert (last_count, last_used_counts) == (count, used_counts)
+
+
+def test_decode_tokens_extended():
+    count, used_counts = 1, [1]
+    tokens = []
+    for value in [5, 600000, 7]:
+        count, token = generate(count, value, extended_token=True)
+        tokens.append(token)
+    results, last_count, _ = OpenPAYGOTokenDecoder.decode_tokens(
+        tokens + tokens[:1], SECRET_KEY, 1, used_counts, starting_code=STARTING_CODE
+    )
+    assert [result[:3] for result in results] == [
+        (5, TokenType.ADD_TIME, 2),
+        (600000, TokenType.ADD_TIME, 4),
+        (7, TokenType.ADD_TIME, 6),
+        (None, TokenType.ALREADY_USED, None),
+    ]
+    assert last_count == 6
+
+
+@pytest.mark.parametrize(
+    "use_numpy,processes",
+    [(False, None), (True, None), (False, 2)],
+)
+def test_find_token_counts(monkeypatch, use_numpy, processes):
+    if use_numpy:
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(OpenPAYGOTokenDecoder, "NUMPY_MIN_TOKEN_BASES", 1)
+        monkeypatch.setattr(OpenPAYGOTokenDecoder, "NUMPY_BLOCK_SIZE", 64)
+    observed = [
+        (generate(1200, 5), TokenType.ADD_TIME, 5),
+        (generate(1500, 30, TokenType.SET_TIME), TokenType.SET_TIME, 30),
+        (generate(700, token_type=TokenType.DISABLE_PAYG), TokenType.DISABLE_PAYG, 998),
+        (generate(900, 5, extended_token=True), TokenType.ADD_TIME, 5),
+        (generate(901, 600000, extended_token=True), TokenType.ADD_TIME, 600000),
+    ]
+    tokens = [token for (_, token), _, _ in observed]
+    results = OpenPAYGOTokenDecoder.find_token_counts(
+        tokens + ["000000001"],
+        SECRET_KEY,
+        max_count=1510,
+        starting_code=STARTING_CODE,
+        processes=processes,
+        use_numpy=use_numpy,
+    )
+    for ((new_count, _), token_type, value), result in zip(observed, results):
+        assert (new_count, token_type, value) in result
+    assert [count for count, _, _ in results[0]] == [1202]
+    assert results[-1] == []
+    # Tokens beyond the horizon are not found
+    assert OpenPAYGOTokenDecoder.find_token_counts(
+        tokens[:1], SECRET_KEY, max_count=1000, starting_code=STARTING_CODE
+    ) == [[]]
+    new_count, token = generate(10, 7, restricted_digit_set=True)
+    extended_count, extended_token = generate(
+        20, 9, restricted_digit_set=True, extended_token=True
+    )
+    assert OpenPAYGOTokenDecoder.find_token_counts(
+        [token, extended_token],
+        SECRET_KEY,
+        max_count=100,
+        starting_code=STARTING_CODE,
+        restricted_digit_set=True,
+        use_numpy=use_numpy,
+    ) == [
+        [(new_count, TokenType.ADD_TIME, 7)],
+        [(extended_count, TokenType.ADD_TIME, 9)],
+    ]
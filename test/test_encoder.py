@@ -1,8 +1,15 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
-from openpaygo import OpenPAYGOTokenEncoder, TokenType
+from openpaygo import (
+    DeviceTokenContext,
+    OpenPAYGOTokenEncoder,
+    TokenChainCache,
+    TokenType,
+    generate_tokens_batch,
+)
 
 with open("test/test_tokens.jsonl") as f:
     sample_data = [json.loads(line) for line in f]
@@ -37,3 +44,196 @@ def test_generate_token(encoder, token_type_lookup, data):
 
     assert new_count == data["new_count"]
     assert final_token == data["token"]
+
+
+@pytest.fixture(scope="module")
+def shared_chain_cache():
+    return TokenChainCache(checkpoint_interval=4)
+
+
+@pytest.mark.parametrize("data", sample_data)
+def test_generate_token_with_chain_cache(
+    encoder, token_type_lookup, shared_chain_cache, data
+):
+    new_count, final_token = encoder.generate_token(
+        secret_key=data["key"],
+        count=data["count"],
+        value=data["value_raw"],
+        token_type=token_type_lookup[data["token_type"]],
+        starting_code=data["starting_code"],
+        restricted_digit_set=data["restricted_digit_set"],
+        extended_token=data["extended_token"],
+        chain_cache=shared_chain_cache,
+    )
+
+    assert new_count == data["new_count"]
+    assert final_token == data["token"]
+
+
+@pytest.mark.parametrize("extended_token", [False, True])
+def test_chain_cache_matches_full_walk(encoder, extended_token):
+    chain_cache = TokenChainCache(checkpoint_interval=16, max_chains=2)
+    for count in [300, 17, 0, 64, 65, 301, 150]:
+        for value in [1, 7, 42]:
+            assert encoder.generate_token(
+                secret_key=sample_data[0]["key"],
+                count=count,
+                value=value,
+                extended_token=extended_token,
+                chain_cache=chain_cache,
+            ) == encoder.generate_token(
+                secret_key=sample_data[0]["key"],
+                count=count,
+                value=value,
+                extended_token=extended_token,
+            )
+    assert len(chain_cache) == 2
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_generate_tokens_batch(token_type_lookup, processes):
+    devices = [
+        {
+            "secret_key": data["key"],
+            "count": data["count"],
+            "value": data["value_raw"],
+            "token_type": token_type_lookup[data["token_type"]],
+            "starting_code": data["starting_code"],
+            "restricted_digit_set": data["restricted_digit_set"],
+            "extended_token": data["extended_token"],
+        }
+        for data in sample_data
+    ]
+    results = generate_tokens_batch(devices, processes=processes, chunk_size=7)
+    assert results == [(data["new_count"], data["token"]) for data in sample_data]
+
+
+def test_generate_tokens_batch_chain_cache():
+    devices = [
+        {"secret_key": sample_data[0]["key"], "count": count, "value": 3}
+        for count in range(1, 200, 7)
+    ]
+    chain_cache = TokenChainCache()
+    assert generate_tokens_batch(devices, chain_cache=chain_cache) == (
+        generate_tokens_batch(devices)
+    )
+    assert len(chain_cache)
+    with pytest.raises(ValueError):
+        generate_tokens_batch(devices, processes=2, chain_cache=chain_cache)
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_generate_tokens_batch_distinct_devices(encoder, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    devices = []
+    for index in range(60):
+        device = {
+            "secret_key": "{:032x}".format((index + 1) * 0x9E3779B97F4A7C15 % 2**128),
+            "count": index * 3 + 1,
+            "value": index % 10 + 0.5,
+            "value_divider": 1 + index % 2,
+            "restricted_digit_set": index % 3 == 0,
+            "extended_token": index % 4 == 0,
+        }
+        if index % 5:
+            device["starting_code"] = 123456789 + index
+        if index % 7 == 0:
+            device["token_type"] = TokenType.DISABLE_PAYG
+            del device["value"]
+        devices.append(device)
+    # A device with several tokens, which share their chain walks
+    devices += [dict(devices[1], count=count) for count in [40, 50]]
+    assert generate_tokens_batch(devices, use_numpy=use_numpy) == [
+        encoder.generate_token(**device) for device in devices
+    ]
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_generate_tokens_batch_generator(encoder, processes):
+    devices = [
+        {"secret_key": sample_data[0]["key"], "count": count, "value": 3}
+        for count in range(1, 10)
+    ]
+    assert generate_tokens_batch(
+        (device for device in devices), processes=processes
+    ) == [encoder.generate_token(**device) for device in devices]
+
+
+def test_generate_tokens_batch_without_starting_code(encoder):
+    devices = [
+        {"secret_key": sample_data[0]["key"], "count": count, "value": 3}
+        for count in range(1, 10)
+    ]
+    assert generate_tokens_batch(devices) == [
+        encoder.generate_token(secret_key=device["secret_key"], count=count, value=3)
+        for count, device in zip(range(1, 10), devices)
+    ]
+
+
+@pytest.mark.parametrize("data", sample_data)
+def test_device_token_context_generate(token_type_lookup, data):
+    context = DeviceTokenContext(
+        secret_key=data["key"],
+        starting_code=data["starting_code"],
+        restricted_digit_set=data["restricted_digit_set"],
+        extended_token=data["extended_token"],
+    )
+    assert context.generate(
+        count=data["count"],
+        value=data["value_raw"],
+        token_type=token_type_lookup[data["token_type"]],
+    ) == (data["new_count"], data["token"])
+
+
+@pytest.mark.parametrize("restricted_digit_set", [False, True])
+@pytest.mark.parametrize("extended_token", [False, True])
+@pytest.mark.parametrize("token_type", [TokenType.ADD_TIME, TokenType.SET_TIME])
+def test_generate_token_book(encoder, restricted_digit_set, extended_token, token_type):
+    data = sample_data[-1]
+    values = [1, 2, 2, 30, 1, 1, 7, 2]
+    book = encoder.generate_token_book(
+        secret_key=data["key"],
+        count=data["count"],
+        values=iter(values),
+        token_type=token_type,
+        starting_code=data["starting_code"],
+        restricted_digit_set=restricted_digit_set,
+        extended_token=extended_token,
+    )
+    count = data["count"]
+    for value, (book_count, book_token) in zip(values, book):
+        count, token = encoder.generate_token(
+            secret_key=data["key"],
+            count=count,
+            value=value,
+            token_type=token_type,
+            starting_code=data["starting_code"],
+            restricted_digit_set=restricted_digit_set,
+            extended_token=extended_token,
+        )
+        assert (book_count, book_token) == (count, token)
+
+
+def test_chain_cache_shared_between_threads(encoder):
+    chain_cache = TokenChainCache(checkpoint_interval=8, max_chains=16, stripes=4)
+
+    def generate_all(value):
+        return [
+            encoder.generate_token(
+                secret_key=sample_data[0]["key"],
+                count=count,
+                value=value,
+                chain_cache=chain_cache,
+            )
+            for count in range(0, 200, 7)
+        ]
+
+    values = list(range(1, 25))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(generate_all, values))
+    for value, value_results in zip(values, results):
+        assert value_results[-1] == encoder.generate_token(
+            secret_key=sample_data[0]["key"], count=196, value=value
+        )
+    assert len(chain_cache) <= 16
@@ -0,0 +1,89 @@
+import pytest
+
+from openpaygo import (
+    AuthMethod,
+    MetricsAuthVerifier,
+    MetricsRequestHandler,
+    MetricsResponseHandler,
+)
+
+SECRET_KEY = "dac86b1a29ab82edc5fbbc41ec9530f6"
+OTHER_SECRET_KEY = "bc41ec9530f6dac86b1a29ab82edc5fb"
+DATA_FORMAT = {
+    "id": 4,
+    "data_order": ["token_count", "tampered"],
+    "historical_data_order": ["panel_voltage", "battery_voltage"],
+    "historical_data_interval": 60,
+}
+AUTH_METHODS = [
+    AuthMethod.SIMPLE_AUTH,
+    AuthMethod.TIMESTAMP_AUTH,
+    AuthMethod.COUNTER_AUTH,
+    AuthMethod.DATA_AUTH,
+    AuthMethod.RECURSIVE_DATA_AUTH,
+]
+
+
+def get_payload(serial_number, auth_method, request_count, steps):
+    metrics_request = MetricsRequestHandler(
+        serial_number=serial_number,
+        data_format=DATA_FORMAT,
+        secret_key=SECRET_KEY,
+        auth_method=auth_method,
+    )
+    metrics_request.set_request_count(request_count)
+    metrics_request.set_timestamp(1611583070 + request_count)
+    metrics_request.set_data({"token_count": request_count, "tampered": False})
+    metrics_request.set_historical_data(
+        [
+            {"panel_voltage": 12.3 + step / 10, "battery_voltage": 12.1}
+            for step in range(steps)
+        ]
+    )
+    return metrics_request.get_condensed_request_payload()
+
+
+def get_requests():
+    requests = []
+    for i in range(60):
+        payload = get_payload(
+            "device{}".format(i), AUTH_METHODS[i % len(AUTH_METHODS)], i + 1, i % 7
+        )
+        if i % 6 == 1:
+            requests.append((payload, OTHER_SECRET_KEY, None, None))
+        elif i % 6 == 2:
+            # The request was already received
+            requests.append((payload, SECRET_KEY, i + 1, None))
+        elif i % 6 == 3:
+            requests.append((payload, SECRET_KEY, i, 1611583070))
+        else:
+            requests.append((payload, SECRET_KEY))
+    requests.append(("{not json", SECRET_KEY, None, None))
+    requests.append((get_payload("device", AuthMethod.DATA_AUTH, 1, 2), "xyz"))
+    requests.append((get_payload("device", None, 1, 2), SECRET_KEY))
+    return requests
+
+
+def is_auth_valid(request):
+    payload, secret_key, *last_values = request
+    try:
+        return MetricsResponseHandler(
+            payload,
+            secret_key=secret_key,
+            **dict(zip(["last_request_count", "last_request_timestamp"], last_values)),
+        ).is_auth_valid()
+    except ValueError:
+        return False
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("processes", [1, 2])
+def test_metrics_auth_verifier(use_numpy, processes):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    requests = get_requests()
+    results = MetricsAuthVerifier(
+        processes=processes, chunk_size=25, use_numpy=use_numpy
+    ).verify(requests)
+    assert results == [is_auth_valid(request) for request in requests]
+    assert results.count(True) == 40
@@ -0,0 +1,152 @@
+import pytest
+
+from openpaygo import (
+    CompiledDataFormat,
+    DataFormatRegistry,
+    MetricsRequestHandler,
+    MetricsResponseHandler,
+)
+
+DATA_FORMAT = {
+    "id": 4,
+    "data_order": ["tc", "tampered", "firmware_version"],
+    "historical_data_order": ["panel_voltage", "battery_voltage", "relative_time"],
+    "historical_data_interval": 60,
+}
+
+
+def test_compiled_data_format_expand():
+    data_format = CompiledDataFormat(DATA_FORMAT)
+    assert data_format.expand_data([3, False]) == {
+        "token_count": 3,
+        "tampered": False,
+        "firmware_version": None,
+    }
+    assert data_format.expand_historical_time_step([12.3, 12.1]) == {
+        "panel_voltage": 12.3,
+        "battery_voltage": 12.1,
+    }
+    # The sparse time steps use the index of the variables or their name
+    assert data_format.expand_historical_time_step(
+        {"1": 12.1, "02": 60, "timestamp": 1611583070, "5": 1}
+    ) == {"battery_voltage": 12.1, "relative_time": 60, "timestamp": 1611583070, "5": 1}
+    with pytest.raises(ValueError):
+        data_format.expand_historical_time_step(12.3)
+    with pytest.raises(ValueError):
+        CompiledDataFormat({"id": 5}).expand_data([1])
+
+
+def test_compiled_data_format_condense():
+    data_format = CompiledDataFormat(DATA_FORMAT)
+    assert data_format.condense_data({"tc": 3, "tampered": True}) == [3, True]
+    assert data_format.condense_historical_time_step({"battery_voltage": 12.1}) == [
+        None,
+        12.1,
+    ]
+    with pytest.raises(ValueError):
+        data_format.condense_data({"tc": 3, "unknown": 1})
+    with pytest.raises(ValueError):
+        data_format.condense_historical_time_step({"unknown": 1})
+    assert CompiledDataFormat.compile(data_format) is data_format
+    assert data_format.get("historical_data_interval") == 60
+
+
+def test_data_format_registry():
+    loaded = []
+
+    def loader(data_format_id):
+        loaded.append(data_format_id)
+        if data_format_id == 404:
+            return None
+        return dict(DATA_FORMAT, id=data_format_id)
+
+    # With a single stripe, the least recently used format of the whole registry is
+    # dropped
+    registry = DataFormatRegistry(loader=loader, max_formats=2, stripes=1)
+    first_format = registry.get(1)
+    assert registry.get(1) is first_format
+    registry.get(2)
+    registry.get(1)
+    registry.get(3)
+    # The format 2 was the least recently used
+    assert 2 not in registry and 1 in registry and 3 in registry
+    assert registry.get(404) is None
+    assert loaded == [1, 2, 3, 404]
+    assert registry.get_stats()["hits"] == 2
+    registry.add(dict(DATA_FORMAT, id=7))
+    assert 7 in registry and len(registry) == 2
+    with pytest.raises(ValueError):
+        registry.add({"data_order": ["tc"]})
+
+
+def test_handlers_with_registry():
+    registry = DataFormatRegistry()
+    registry.add(DATA_FORMAT)
+    metrics_request = MetricsRequestHandler(
+        serial_number="aaa111222", data_format=registry.get(4)
+    )
+    metrics_request.set_request_count(2)
+    metrics_request.set_data({"tc": 3, "tampered": False})
+    metrics_request.set_historical_data(
+        [{"panel_voltage": 12.31}, {"battery_voltage": 12.3}]
+    )
+    payload = metrics_request.get_condensed_request_payload()
+    assert '"df":4' in payload
+    handler = MetricsResponseHandler(payload, data_format_registry=registry)
+    # The data format stays the dictionary of the format
+    assert handler.data_format is registry.get(4).data_format
+    assert handler.data_format["historical_data_interval"] == 60
+    simple_metrics = handler.get_simple_metrics()
+    assert simple_metrics["data"]["token_count"] == 3
+    assert [
+        time_step.get("battery_voltage")
+        for time_step in simple_metrics["historical_data"]
+    ] == [None, 12.3]
+
+
+def test_data_format_registry_stripes():
+    registry = DataFormatRegistry(
+        loader=lambda data_format_id: dict(DATA_FORMAT, id=data_format_id),
+        max_formats=64,
+    )
+    for data_format_id in list(range(32)) * 2:
+        assert registry.get(data_format_id).id == data_format_id
+    assert len(registry) == 32
+    assert registry.get_stats() == {
+        "formats": 32,
+        "hits": 32,
+        "misses": 32,
+        "hit_rate": 0.5,
+    }
+    assert registry.hits == registry.misses == 32
+    registry.clear()
+    assert len(registry) == 0
+
+
+def test_handlers_keep_data_format_dict():
+    metrics_request = MetricsRequestHandler(
+        serial_number="aaa111222", data_format=DATA_FORMAT
+    )
+    assert metrics_request.data_format is DATA_FORMAT
+    assert metrics_request.data_format["data_order"][0] == "tc"
+    metrics_request.set_data({"tc": 3})
+    handler = MetricsResponseHandler(
+        metrics_request.get_condensed_request_payload(), data_format=DATA_FORMAT
+    )
+    assert handler.data_format == DATA_FORMAT
+    assert handler.data_format["data_order"] == ["tc", "tampered", "firmware_version"]
+    assert handler.get_simple_metrics()["data"]["token_count"] == 3
+    # A compiled data format is given back as its dictionary
+    handler.set_device_parameters(data_format=CompiledDataFormat(DATA_FORMAT))
+    assert handler.data_format is DATA_FORMAT
+
+
+def test_request_handler_empty_data_format():
+    metrics_request = MetricsRequestHandler(serial_number="aaa111222", data_format={})
+    assert metrics_request.data_format == {}
+    # Without historical_data_interval, the time steps need a timestamp
+    with pytest.raises(ValueError):
+        metrics_request.set_historical_data([{"panel_voltage": 12.31}])
+    metrics_request.set_historical_data(
+        [{"panel_voltage": 12.31, "timestamp": 1611583070}]
+    )
@@ -0,0 +1,200 @@
+import json
+import random
+from datetime import datetime
+
+import pytest
+
+from openpaygo import (
+    AuthMethod,
+    MetricsRequestHandler,
+    MetricsResponseHandler,
+    metrics_json,
+)
+from openpaygo.metrics_json import OrjsonJSONBackend, StdlibJSONBackend
+
+pytest.importorskip("orjson")
+
+SECRET_KEY = "dac86b1a29ab82edc5fbbc41ec9530f6"
+DATA_FORMAT = {
+    "id": 4,
+    "data_order": ["token_count", "tampered", "firmware_version"],
+    "historical_data_order": ["panel_voltage", "battery_voltage"],
+    "historical_data_interval": 60,
+}
+AUTH_METHODS = [
+    AuthMethod.SIMPLE_AUTH,
+    AuthMethod.TIMESTAMP_AUTH,
+    AuthMethod.COUNTER_AUTH,
+    AuthMethod.DATA_AUTH,
+    AuthMethod.RECURSIVE_DATA_AUTH,
+]
+VALUES = [
+    None,
+    True,
+    False,
+    0,
+    -1,
+    2**63,
+    2**64,
+    -(2**64) - 1,
+    0.0,
+    -0.0,
+    0.1,
+    12.3,
+    1e-5,
+    0.0001,
+    0.00012345,
+    1e15,
+    1e16,
+    1.5e300,
+    float("nan"),
+    float("inf"),
+    float("-inf"),
+    "",
+    "abc",
+    "café",
+    "€50",
+    "\U0001f600",
+    '\x00\x1f\x7f"\\/',
+    "\ud800",
+    "null",
+    "1e5",
+    [1, [2.5, None], {}],
+    (1, 2),
+    {"a": 1, "b": [0.1, "x"]},
+    {1: "a"},
+    {"\xe9": 1},
+    datetime(2021, 1, 25, 14, 57, 50),
+]
+
+
+@pytest.fixture
+def json_backend():
+    yield
+    metrics_json.set_json_backend()
+
+
+def dumps_or_error(backend, value):
+    try:
+        return backend.dumps(value)
+    except Exception as e:
+        return type(e)
+
+
+def loads_or_error(backend, value):
+    try:
+        return backend.loads(value)
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_dumps_same_as_json(value):
+    assert dumps_or_error(OrjsonJSONBackend, value) == dumps_or_error(
+        StdlibJSONBackend, value
+    )
+    assert dumps_or_error(OrjsonJSONBackend, [value]) == dumps_or_error(
+        StdlibJSONBackend, [value]
+    )
+
+
+def test_dumps_floats_same_as_json():
+    rng = random.Random(42)
+    values = [rng.uniform(-1000, 1000) for _ in range(2000)]
+    values += [rng.random() * 10 ** rng.randint(-30, 30) for _ in range(2000)]
+    values += [round(value, rng.randint(0, 6)) for value in values]
+    for value in values:
+        assert OrjsonJSONBackend.dumps([value]) == StdlibJSONBackend.dumps([value])
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        '{"a":1,"b":[0.1,null,true]}',
+        '{"a":1,"a":2}',
+        '{"a":"caf\\u00e9","b":"€"}',
+        '{"a":NaN,"b":-Infinity}',
+        '{"a":1e400}',
+        '{"a":123456789012345678901234567890}',
+        '{"a":-9223372036854775809}',
+        '{"a":"\\ud800"}',
+        '{"a":1.7976931348623157e308,"b":5e-324}',
+        "[1,",
+        "",
+        "\ufeff{}",
+    ],
+)
+def test_loads_same_as_json(payload):
+    expected = loads_or_error(StdlibJSONBackend, payload)
+    assert repr(loads_or_error(OrjsonJSONBackend, payload)) == repr(expected)
+    for encoding in ["utf-8", "utf-16"]:
+        try:
+            payload_bytes = payload.encode(encoding)
+        except UnicodeEncodeError:
+            continue
+        assert repr(loads_or_error(OrjsonJSONBackend, payload_bytes)) == repr(
+            loads_or_error(StdlibJSONBackend, payload_bytes)
+        )
+
+
+def test_loads_floats_same_as_json():
+    rng = random.Random(42)
+    payload = json.dumps(
+        [rng.random() * 10 ** rng.randint(-30, 30) for _ in range(2000)]
+    )
+    assert OrjsonJSONBackend.loads(payload) == StdlibJSONBackend.loads(payload)
+
+
+def test_set_json_backend(json_backend):
+    assert metrics_json.get_json_backend() is OrjsonJSONBackend
+    assert metrics_json.set_json_backend("json") is StdlibJSONBackend
+    assert metrics_json.get_json_backend() is StdlibJSONBackend
+    assert metrics_json.set_json_backend() is OrjsonJSONBackend
+    with pytest.raises(ValueError):
+        metrics_json.set_json_backend("simplejson")
+
+
+def get_request_payload(auth_method):
+    metrics_request = MetricsRequestHandler(
+        serial_number="caf\xe9-001",
+        data_format=DATA_FORMAT,
+        secret_key=SECRET_KEY,
+        auth_method=auth_method,
+    )
+    metrics_request.set_request_count(12)
+    metrics_request.set_timestamp(1611583070)
+    metrics_request.set_data(
+        {"token_count": 3, "tampered": False, "firmware_version": "v1€"}
+    )
+    metrics_request.set_historical_data(
+        [
+            {"panel_voltage": 12.3 + step / 10, "battery_voltage": 1e-5 * step}
+            for step in range(4)
+        ]
+    )
+    return metrics_request.get_condensed_request_payload()
+
+
+def get_answer_payload(payload):
+    metrics_response = MetricsResponseHandler(
+        payload, data_format=DATA_FORMAT, secret_key=SECRET_KEY
+    )
+    assert metrics_response.is_auth_valid()
+    metrics_response.add_tokens_to_answer(["123456789", "987654321"])
+    metrics_response.add_settings_to_answer({"name": "caf\xe9", "limit": 1e16})
+    metrics_response.add_extra_data_to_answer({"ratio": 0.00001})
+    return metrics_response.get_answer_payload()
+
+
+@pytest.mark.parametrize("auth_method", AUTH_METHODS)
+def test_signatures_same_with_every_backend(json_backend, auth_method):
+    payloads = {}
+    for backend in ["json", "orjson"]:
+        metrics_json.set_json_backend(backend)
+        request_payload = get_request_payload(auth_method)
+        payloads[backend] = (
+            request_payload,
+            get_answer_payload(request_payload),
+            get_answer_payload(request_payload.encode("utf-8")),
+        )
+    assert payloads["orjson"] == payloads["json"]
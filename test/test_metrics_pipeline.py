@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from openpaygo import AuthMethod, MetricsPipeline, MetricsRequestHandler
+
+SECRET_KEY = "dac86b1a29ab82edc5fbbc41ec9530f6"
+DATA_FORMAT = {
+    "id": 4,
+    "data_order": ["token_count", "tampered"],
+    "historical_data_order": ["panel_voltage", "battery_voltage"],
+    "historical_data_interval": 60,
+}
+
+
+def resolve_device(serial_number, data_format_id):
+    if serial_number == "unknown":
+        return None
+    return {"secret_key": SECRET_KEY, "data_format": DATA_FORMAT}
+
+
+def get_payload(serial_number, request_count, secret_key=SECRET_KEY):
+    metrics_request = MetricsRequestHandler(
+        serial_number=serial_number,
+        data_format=DATA_FORMAT,
+        secret_key=secret_key,
+        auth_method=AuthMethod.RECURSIVE_DATA_AUTH,
+    )
+    metrics_request.set_request_count(request_count)
+    metrics_request.set_timestamp(1611583070)
+    metrics_request.set_data({"token_count": request_count, "tampered": False})
+    metrics_request.set_historical_data(
+        [{"panel_voltage": 12.3, "battery_voltage": 12.1}] * 3
+    )
+    return metrics_request.get_condensed_request_payload()
+
+
+def get_payloads():
+    payloads = [get_payload("device{}".format(i), i + 1) for i in range(20)]
+    payloads[3] = get_payload("device3", 4, secret_key="00" * 16)
+    payloads[7] = get_payload("unknown", 8)
+    payloads[11] = "{not json"
+    return payloads
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+@pytest.mark.parametrize("ordered", [True, False])
+def test_metrics_pipeline(tmp_path, processes, ordered):
+    path = tmp_path / "payloads.ndjson"
+    with open(path, "w") as f:
+        for payload in get_payloads():
+            f.write(payload + "\n\n")
+    pipeline = MetricsPipeline(
+        resolve_device, processes=processes, chunk_size=3, ordered=ordered
+    )
+    results = list(pipeline.process(str(path)))
+    if ordered:
+        assert [result["index"] for result in results] == list(range(20))
+    results.sort(key=lambda result: result["index"])
+    assert results[0]["auth_valid"] is True
+    assert results[0]["metrics"]["data"] == {"token_count": 1, "tampered": False}
+    assert [step["timestamp"] for step in results[0]["metrics"]["historical_data"]] == [
+        1611583070,
+        1611583130,
+        1611583190,
+    ]
+    assert results[3]["auth_valid"] is False and results[3]["metrics"] is None
+    assert results[7]["serial_number"] == "unknown"
+    assert results[7]["error"] == "ValueError: Unknown device."
+    assert results[11]["error"].startswith("JSONDecodeError")
+    stats = pipeline.get_stats()
+    assert (stats["payloads"], stats["valid"], stats["invalid"], stats["errors"]) == (
+        20,
+        17,
+        1,
+        2,
+    )
+    assert stats["stages"]["verify"]["seconds"] > 0
+
+
+def test_metrics_pipeline_without_auth():
+    payloads = [
+        json.dumps({"sn": "device1", "rc": 1, "d": {"token_count": 1}}).encode(),
+        b"",
+        # The data cannot be expanded without the data format
+        get_payload("device2", 2).encode(),
+    ]
+    pipeline = MetricsPipeline(verify_auth=False)
+    results = list(pipeline.process(iter(payloads)))
+    assert len(results) == 2
+    assert results[0]["auth_valid"] is None
+    assert results[0]["metrics"]["data"] == {"token_count": 1}
+    assert results[1]["error"] is not None
+    assert pipeline.get_stats()["errors"] == 1
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from openpaygo import AuthMethod, MetricsRequestHandler, MetricsResponseHandler
+
+SECRET_KEY = "dac86b1a29ab82edc5fbbc41ec9530f6"
+DATA_FORMAT = {
+    "id": 4,
+    "data_order": ["token_count", "tampered", "firmware_version"],
+    "historical_data_order": ["panel_voltage", "battery_voltage"],
+    "historical_data_interval": 60,
+}
+
+
+def get_payload():
+    metrics_request = MetricsRequestHandler(
+        serial_number="aaa111222",
+        data_format=DATA_FORMAT,
+        secret_key=SECRET_KEY,
+        auth_method=AuthMethod.RECURSIVE_DATA_AUTH,
+    )
+    metrics_request.set_timestamp(1611583070)
+    metrics_request.set_data(
+        {"token_count": 3, "tampered": False, "firmware_version": "1.2.3"}
+    )
+    metrics_request.set_historical_data(
+        [
+            {"panel_voltage": 12.31, "battery_voltage": 12.32},
+            {"panel_voltage": 12.30, "battery_voltage": 12.31},
+        ]
+    )
+    return metrics_request.get_condensed_request_payload()
+
+
+def test_get_simple_metrics():
+    handler = MetricsResponseHandler(get_payload(), data_format=DATA_FORMAT)
+    simple_metrics = handler.get_simple_metrics()
+    assert simple_metrics["data"] == {
+        "token_count": 3,
+        "tampered": False,
+        "firmware_version": "1.2.3",
+    }
+    assert simple_metrics["historical_data"] == [
+        {"panel_voltage": 12.31, "battery_voltage": 12.32, "timestamp": 1611583070},
+        {"panel_voltage": 12.30, "battery_voltage": 12.31, "timestamp": 1611583130},
+    ]
+    assert "auth" not in simple_metrics
+    assert handler.get_token_count() == 3
+    assert handler.expects_token_answer()
+    assert not handler.expects_time_answer()
+
+
+def test_simple_metrics_are_expanded_once():
+    payload = get_payload()
+    handler = MetricsResponseHandler(payload, data_format=DATA_FORMAT)
+    first_metrics = handler.get_simple_metrics()
+    # The copies returned can be modified without changing the handler
+    first_metrics["data"]["token_count"] = 10
+    first_metrics["historical_data"][0].pop("timestamp")
+    second_metrics = handler.get_simple_metrics()
+    assert second_metrics["data"]["token_count"] == 3
+    assert second_metrics["historical_data"][0]["timestamp"] == 1611583070
+    assert handler.get_simple_metrics(read_only=True) is handler.get_simple_metrics(
+        read_only=True
+    )
+    # The request is not modified either
+    assert handler.request_dict == MetricsResponseHandler(payload).request_dict
+
+
+def test_simple_metrics_read_only_view():
+    handler = MetricsResponseHandler(get_payload(), data_format=DATA_FORMAT)
+    view = handler.get_simple_metrics(read_only=True)
+    with pytest.raises(TypeError):
+        view["data"]["token_count"] = 10
+    assert isinstance(view["historical_data"], tuple)
+    # The copies are plain dicts and lists
+    assert json.loads(json.dumps(handler.get_simple_metrics())) == (
+        handler.get_simple_metrics()
+    )
+
+
+def test_set_device_parameters_expands_again():
+    handler = MetricsResponseHandler(get_payload())
+    with pytest.raises(AttributeError):
+        handler.get_token_count()
+    handler.set_device_parameters(secret_key=SECRET_KEY, data_format=DATA_FORMAT)
+    assert handler.get_token_count() == 3
+    assert handler.is_auth_valid()
+    handler.set_device_parameters(
+        data_format=dict(DATA_FORMAT, data_order=["a", "b", "c"])
+    )
+    assert handler.get_token_count() is None
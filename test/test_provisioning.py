@@ -0,0 +1,67 @@
+import os
+import random
+
+import pytest
+
+from openpaygo import DeviceProvisioner
+from openpaygo.cli import main
+from openpaygo.provisioning import PROVISIONING_RECORD_STRUCT
+from openpaygo.token_shared import OpenPAYGOTokenShared
+
+
+def check_records(records, device_count):
+    assert [index for index, _, _ in records] == list(range(device_count))
+    for _, secret_key, starting_code in records:
+        assert starting_code == OpenPAYGOTokenShared.generate_starting_code(
+            bytes.fromhex(secret_key)
+        )
+
+
+@pytest.mark.parametrize("file_name", ["devices.bin", "devices.csv"])
+@pytest.mark.parametrize("processes", [1, 2])
+def test_provision(tmp_path, file_name, processes):
+    path = str(tmp_path / file_name)
+    progress = []
+    stats = DeviceProvisioner(
+        path, seed=7, processes=processes, chunk_size=30
+    ).provision(100, progress=progress.append)
+    records = list(DeviceProvisioner.read_records(path))
+    check_records(records, 100)
+    assert [step["written"] for step in progress] == [30, 60, 90, 100]
+    assert stats["written"] == 100
+    assert stats["resumed_from"] == 0
+    # The same seed gives the same keys
+    assert records[0][1] == random.Random(7).randbytes(16).hex()
+
+
+@pytest.mark.parametrize("file_name", ["devices.bin", "devices.csv"])
+def test_provision_resume(tmp_path, file_name):
+    full_path = str(tmp_path / "full_{}".format(file_name))
+    DeviceProvisioner(full_path, seed=3, chunk_size=16).provision(50)
+    path = str(tmp_path / file_name)
+    DeviceProvisioner(path, seed=3, chunk_size=16).provision(20)
+    # We simulate a batch interrupted in the middle of a record
+    with open(path, "ab") as f:
+        f.write(b"12")
+    stats = DeviceProvisioner(path, seed=3, chunk_size=7).provision(50, resume=True)
+    assert stats["resumed_from"] == 20
+    assert stats["written"] == 30
+    assert list(DeviceProvisioner.read_records(path)) == list(
+        DeviceProvisioner.read_records(full_path)
+    )
+    check_records(list(DeviceProvisioner.read_records(path)), 50)
+
+
+def test_provision_binary_record_size(tmp_path):
+    path = str(tmp_path / "devices.bin")
+    DeviceProvisioner(path, rng=random.Random(1)).provision(10)
+    assert os.path.getsize(path) == 10 * PROVISIONING_RECORD_STRUCT.size
+    with pytest.raises(ValueError):
+        DeviceProvisioner(path, seed=1, rng=random.Random(1))
+
+
+def test_provision_cli(tmp_path, capsys):
+    path = str(tmp_path / "devices.csv")
+    main(["provision", path, "--count", "25", "--seed", "5", "--chunk-size", "10"])
+    check_records(list(DeviceProvisioner.read_records(path)), 25)
+    assert "devices/sec" in capsys.readouterr().err
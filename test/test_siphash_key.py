@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from openpaygo import OpenPAYGOTokenDecoder, OpenPAYGOTokenEncoder, TokenChainCache
+from openpaygo.siphash_key import SipHashKey, get_siphash_key, load_siphash_key
+
+siphash = pytest.importorskip("siphash")
+
+
+@pytest.fixture(scope="module")
+def rng():
+    return random.Random(20240501)
+
+
+def random_bytes(rng, length):
+    return bytes(rng.getrandbits(8) for _ in range(length))
+
+
+def test_hash_u64_matches_siphash(rng):
+    for _ in range(20000):
+        key = random_bytes(rng, 16)
+        message = random_bytes(rng, 8)
+        assert (
+            SipHashKey(key).hash_u64(int.from_bytes(message, "little"))
+            == siphash.SipHash_2_4(key, message).hash()
+        )
+
+
+def test_hash_matches_siphash(rng):
+    for _ in range(5000):
+        key = random_bytes(rng, 16)
+        message = random_bytes(rng, rng.randrange(300))
+        assert SipHashKey(key).hash(message) == siphash.SipHash_2_4(key, message).hash()
+
+
+def test_get_siphash_key_is_cached():
+    key = b"\xa2\x9a\xb8.\xdc_\xbb\xc4\x1e\xc9S\x0fm\xac\x86\xb1"
+    assert get_siphash_key(key) is get_siphash_key(key)
+
+
+def test_load_siphash_key():
+    key = b"\xa2\x9a\xb8.\xdc_\xbb\xc4\x1e\xc9S\x0fm\xac\x86\xb1"
+    siphash_key = load_siphash_key(key)
+    assert siphash_key is get_siphash_key(key)
+    assert load_siphash_key(siphash_key) is siphash_key
+
+
+@pytest.mark.parametrize("chain_cache", [None, TokenChainCache])
+def test_chain_walks_derive_key_once(chain_cache):
+    secret_key = "a29ab82edc5fbbc41ec9530f6dac86b1"
+    get_siphash_key.cache_clear()
+    for extended_token in [False, True]:
+        OpenPAYGOTokenEncoder.generate_token(
+            secret_key=secret_key,
+            count=300,
+            value=5,
+            starting_code=123456789,
+            extended_token=extended_token,
+            chain_cache=chain_cache and chain_cache(),
+        )
+    _, token = OpenPAYGOTokenEncoder.generate_token(
+        secret_key=secret_key, count=300, value=5, starting_code=123456789
+    )
+    value, _, count, _ = OpenPAYGOTokenDecoder.decode_token(
+        token=token,
+        secret_key=secret_key,
+        count=290,
+        starting_code=123456789,
+        chain_cache=chain_cache and chain_cache(),
+    )
+    assert (value, count) == (5, 302)
+    cache_info = get_siphash_key.cache_info()
+    # Each walk gets the key from the cache once, not once per step
+    assert cache_info.hits + cache_info.misses < 20
+
+
+def test_invalid_key_length():
+    with pytest.raises(ValueError):
+        SipHashKey(b"too short")
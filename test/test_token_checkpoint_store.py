@@ -0,0 +1,178 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from openpaygo import (
+    OpenPAYGOTokenDecoder,
+    OpenPAYGOTokenEncoder,
+    TokenChainCache,
+    TokenCheckpointStore,
+    TokenCheckpointStoreWriter,
+    TokenType,
+)
+from openpaygo.token_checkpoint_store import STORE_HEADER_STRUCT, STORE_RECORD_STRUCT
+from openpaygo.token_shared import OpenPAYGOTokenShared
+
+SECRET_KEY = "bc41ec9530f6dac86b1a29ab82edc5fb"
+STARTING_CODE = 516959010
+
+
+def generate(count, value, chain_cache=None):
+    return OpenPAYGOTokenEncoder.generate_token(
+        secret_key=SECRET_KEY,
+        count=count,
+        value=value,
+        starting_code=STARTING_CODE,
+        chain_cache=chain_cache,
+    )
+
+
+def count_hashes(monkeypatch):
+    hashes = []
+    generate_next_token = OpenPAYGOTokenShared.generate_next_token
+
+    def counting_generate_next_token(last_code, key):
+        hashes.append(last_code)
+        return generate_next_token(last_code, key)
+
+    monkeypatch.setattr(
+        OpenPAYGOTokenShared, "generate_next_token", counting_generate_next_token
+    )
+    return hashes
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_cold_cache_uses_stored_checkpoints(tmp_path, monkeypatch, compact):
+    path = str(tmp_path / "checkpoints.bin")
+    writer = TokenCheckpointStoreWriter(path)
+    warm_cache = TokenChainCache(checkpoint_writer=writer)
+    expected = [
+        generate(count, value, warm_cache) for count, value in [(999, 5), (500, 7)]
+    ]
+    if compact:
+        writer.compact()
+    writer.close()
+    store = TokenCheckpointStore(path)
+    assert len(store) == 1000 // 64 + 500 // 64
+    hashes = count_hashes(monkeypatch)
+    cold_cache = TokenChainCache(checkpoint_store=store)
+    for (count, value), result in zip([(999, 5), (500, 7)], expected):
+        assert generate(count, value, cold_cache) == result
+    assert len(hashes) < 2 * 64
+    new_count, token = expected[0]
+    assert OpenPAYGOTokenDecoder.decode_token(
+        token=token,
+        secret_key=SECRET_KEY,
+        count=new_count - 2,
+        used_counts=[new_count - 2],
+        starting_code=STARTING_CODE,
+        chain_cache=TokenChainCache(checkpoint_store=store),
+    )[1:3] == (TokenType.ADD_TIME, new_count)
+    store.close()
+
+
+def test_refresh_and_compaction(tmp_path):
+    path = str(tmp_path / "checkpoints.bin")
+    writer = TokenCheckpointStoreWriter(path, checkpoint_interval=16)
+    store = TokenCheckpointStore(path)
+    chain_key = (b"k" * 16, 123456789, False)
+    writer.add_checkpoint(chain_key, 32, 111)
+    writer.add_checkpoint(chain_key, 16, 222)
+    assert store.get_checkpoint(chain_key, 40) is None
+    store.refresh()
+    assert store.get_checkpoint(chain_key, 40) == (32, 111)
+    assert store.get_checkpoint(chain_key, 31) == (16, 222)
+    assert store.get_checkpoint(chain_key, 15) is None
+    assert store.get_checkpoint((b"k" * 16, 123456788, False), 40) is None
+    writer.add_checkpoint(chain_key, 32, 111)
+    writer.compact()
+    writer.add_checkpoint(chain_key, 48, 333)
+    store.refresh()
+    assert len(store) == 3
+    assert store.get_checkpoint(chain_key, 100) == (48, 333)
+    assert store.get_checkpoint(chain_key, 47) == (32, 111)
+    with pytest.raises(ValueError):
+        writer.add_checkpoint(chain_key, 20, 1)
+    writer.close()
+    store.close()
+    with pytest.raises(ValueError):
+        TokenCheckpointStoreWriter(path, checkpoint_interval=64)
+    writer = TokenCheckpointStoreWriter(path, checkpoint_interval=16)
+    with pytest.raises(ValueError):
+        TokenChainCache(checkpoint_writer=writer)
+    writer.close()
+
+
+def test_store_with_other_interval_rejected(tmp_path):
+    path = str(tmp_path / "checkpoints.bin")
+    writer = TokenCheckpointStoreWriter(path)
+    generate(70, 5, TokenChainCache(checkpoint_writer=writer))
+    writer.close()
+    store = TokenCheckpointStore(path)
+    with pytest.raises(ValueError):
+        TokenChainCache(checkpoint_interval=48, checkpoint_store=store)
+    assert generate(50, 5, TokenChainCache(checkpoint_store=store)) == generate(50, 5)
+    store.close()
+
+
+def test_walks_do_not_duplicate_stored_checkpoints(tmp_path):
+    path = str(tmp_path / "checkpoints.bin")
+    writer = TokenCheckpointStoreWriter(path)
+    store = TokenCheckpointStore(path)
+    generate(2950, 5, TokenChainCache(checkpoint_writer=writer))
+    writer.compact()
+    store.refresh()
+    assert len(store) == 2950 // 64
+
+    def get_record_count():
+        return (os.path.getsize(path) - STORE_HEADER_STRUCT.size) // (
+            STORE_RECORD_STRUCT.size
+        )
+
+    # A cache only stores the checkpoint of the count 3008 once, the next walks
+    # start from it
+    chain_cache = TokenChainCache(checkpoint_store=store, checkpoint_writer=writer)
+    for _ in range(20):
+        generate(3010, 5, chain_cache)
+    assert get_record_count() == 2950 // 64 + 1
+    # It is not stored again once the store sees it
+    store.refresh()
+    chain_cache = TokenChainCache(checkpoint_store=store, checkpoint_writer=writer)
+    for _ in range(20):
+        generate(3010, 5, chain_cache)
+    assert get_record_count() == 2950 // 64 + 1
+    writer.close()
+    store.close()
+
+
+def append_checkpoints(path, first_count, checkpoint_count):
+    writer = TokenCheckpointStoreWriter(path, checkpoint_interval=16)
+    for index in range(checkpoint_count):
+        writer.add_checkpoint((b"k" * 16, 1, False), first_count + index * 16, index)
+    writer.close()
+
+
+def test_appends_are_kept_during_compaction(tmp_path):
+    path = str(tmp_path / "checkpoints.bin")
+    writer = TokenCheckpointStoreWriter(path, checkpoint_interval=16)
+    other_writer = TokenCheckpointStoreWriter(path, checkpoint_interval=16)
+    chain_key = (b"k" * 16, 2, False)
+    writer.add_checkpoint(chain_key, 16, 1)
+    writer.compact()
+    # The other writer still had the file replaced by the compaction open
+    other_writer.add_checkpoint(chain_key, 32, 2)
+    store = TokenCheckpointStore(path)
+    assert store.get_checkpoint(chain_key, 40) == (32, 2)
+    store.close()
+    other_writer.close()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(append_checkpoints, path, 16, 2000)
+        while not future.done():
+            writer.compact()
+        future.result()
+    writer.compact()
+    writer.close()
+    store = TokenCheckpointStore(path)
+    assert len(store) == 2 + 2000
+    store.close()
@@ -0,0 +1,250 @@
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from openpaygo import OpenPAYGOTokenEncoder, TokenLookupIndex, TokenType
+
+DEVICES = [
+    (index, "{:032x}".format(0xBC41EC9530F6DAC86B1A29AB82EDC5FB + index * 7919))
+    for index in range(20)
+]
+
+
+def get_issued_tokens(count=12, **kwargs):
+    issued_tokens = []
+    index = TokenLookupIndex(capacity=8)
+    for device_id, secret_key in DEVICES:
+        last_count = 1
+        for value in range(1, count + 1):
+            last_count, token = index.generate_token(
+                device_id,
+                secret_key=secret_key,
+                count=last_count,
+                value=value,
+                **kwargs,
+            )
+            issued_tokens.append((device_id, token, last_count))
+    return index, issued_tokens
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"restricted_digit_set": True},
+        {"extended_token": True},
+        {"extended_token": True, "restricted_digit_set": True},
+    ],
+)
+def test_lookup_issued_tokens(kwargs):
+    index, issued_tokens = get_issued_tokens(**kwargs)
+    assert len(index) == len(issued_tokens)
+    assert index.capacity >= 2 * len(issued_tokens)
+    for device_id, token, count in issued_tokens:
+        assert (device_id, count) in index.lookup(token)
+    assert index.lookup("000000000") == []
+
+
+def test_build_keeps_recent_window():
+    _, issued_tokens = get_issued_tokens(count=12)
+    index = TokenLookupIndex.build(issued_tokens, window=10)
+    for device_id, token, count in issued_tokens:
+        if count > 24 - 10:
+            assert index.lookup(token) == [(device_id, count)]
+        else:
+            assert index.lookup(token) == []
+
+
+def test_build_from_devices():
+    devices = [
+        {
+            "device_id": device_id,
+            "secret_key": secret_key,
+            "count": 100 + device_id,
+            "value": 7,
+            "restricted_digit_set": device_id % 2 == 1,
+        }
+        for device_id, secret_key in DEVICES
+    ]
+    index = TokenLookupIndex.build_from_devices(devices, window=10, outstanding=6)
+    for device in devices:
+        kwargs = dict(device)
+        device_id = kwargs.pop("device_id")
+        count = kwargs.pop("count")
+        for token_count in range(count - 20, count + 20):
+            new_count, token = OpenPAYGOTokenEncoder.generate_token(
+                count=token_count, **kwargs
+            )
+            found = (device_id, new_count) in index.lookup(token)
+            assert found == (count - 10 < new_count <= count + 6)
+
+
+def test_add_same_token_updates_count():
+    index = TokenLookupIndex()
+    index.add(1, "123456789", 10)
+    index.add(2, "123456789", 12)
+    index.add(1, "123456789", 14)
+    assert len(index) == 2
+    assert sorted(index.lookup("123456789")) == [(1, 14), (2, 12)]
+    assert index.lookup("000123456789") == []
+
+
+def test_prune_removes_old_tokens():
+    index, issued_tokens = get_issued_tokens(count=12)
+    capacity = index.capacity
+    recent_tokens = [
+        (device_id, token, count)
+        for device_id, token, count in issued_tokens
+        if count > 24 - 10
+    ]
+    assert index.prune(window=10) == len(issued_tokens) - len(recent_tokens)
+    assert len(index) == len(recent_tokens)
+    for device_id, token, count in issued_tokens:
+        if count > 24 - 10:
+            assert (device_id, count) in index.lookup(token)
+        else:
+            assert (device_id, count) not in index.lookup(token)
+    # The slots of the tokens removed are reused
+    for device_id, token, count in issued_tokens * 3:
+        index.add(device_id, token, count)
+        index.prune(window=10)
+    assert index.capacity == capacity
+    assert len(index) == len(recent_tokens)
+
+
+def test_lookup_while_updating_counts():
+    index = TokenLookupIndex(capacity=8)
+    # The tokens have the same key, so they are in the same probe sequence
+    for device_id in range(4):
+        index.add(device_id, "123456789", 1)
+    missed = []
+    done = threading.Event()
+
+    def look_up():
+        while not done.is_set():
+            if len(index.lookup("123456789")) != 4:
+                missed.append(True)
+
+    # We switch between the threads as often as possible
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    reader = threading.Thread(target=look_up)
+    reader.start()
+    try:
+        for count in range(20000):
+            index.add(count % 3, "123456789", count)
+    finally:
+        done.set()
+        reader.join()
+        sys.setswitchinterval(switch_interval)
+    assert not missed
+
+
+def test_memory_mapped_index(tmp_path):
+    index, issued_tokens = get_issued_tokens()
+    path = str(tmp_path / "tokens.idx")
+    index.save(path)
+    reader = TokenLookupIndex.open(path)
+    writer = TokenLookupIndex.open(path, writable=True)
+    try:
+        for device_id, token, count in issued_tokens:
+            assert reader.lookup(token) == index.lookup(token)
+        with pytest.raises(ValueError):
+            reader.add(1, "123456789", 1)
+        writer.generate_token(
+            99,
+            secret_key=DEVICES[0][1],
+            count=1,
+            value=1,
+            token_type=TokenType.SET_TIME,
+        )
+        assert len(reader) == len(issued_tokens) + 1
+        assert writer.prune(window=10) > 0
+        assert len(reader) == len(writer)
+        for device_id, token, count in issued_tokens:
+            assert reader.lookup(token) == writer.lookup(token)
+        with pytest.raises(ValueError):
+            for token in range(writer.capacity):
+                writer.add(100, "{:09d}".format(token), 1)
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_memory_mapped_index_reuses_pruned_slots(tmp_path):
+    path = str(tmp_path / "tokens.idx")
+    TokenLookupIndex(capacity=32).save(path)
+    index = TokenLookupIndex.open(path, writable=True)
+    reader = TokenLookupIndex.open(path)
+    capacity = index.capacity
+    # The token of another device is never pruned, and is always found while the
+    # table is rehashed
+    index.add(2, "999999999", 5)
+    stop = threading.Event()
+    missed = []
+
+    def look_up():
+        while not stop.is_set():
+            if reader.lookup("999999999") != [(2, 5)]:
+                missed.append(True)
+
+    thread = threading.Thread(target=look_up)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    thread.start()
+    try:
+        # Many more tokens than the capacity go through the index, only the last
+        # ones are kept by pruning
+        for count in range(1, 1000):
+            index.add(1, "{:09d}".format(100000000 + count), count)
+            index.prune(window=8)
+            assert len(reader) == min(count, 8) + 1
+        stop.set()
+        thread.join()
+        assert not missed
+        for count in range(1, 1000):
+            expected = [(1, count)] if count > 991 else []
+            assert reader.lookup("{:09d}".format(100000000 + count)) == expected
+        assert index.capacity == capacity
+    finally:
+        stop.set()
+        thread.join()
+        sys.setswitchinterval(switch_interval)
+        index.close()
+        reader.close()
+
+
+def add_tokens_in_worker(path, device_id, tokens):
+    index = TokenLookupIndex.open(path, writable=True)
+    try:
+        for token in tokens:
+            index.add(device_id, "{:09d}".format(token), 1)
+    finally:
+        index.close()
+
+
+def test_memory_mapped_index_several_writers(tmp_path):
+    path = str(tmp_path / "tokens.idx")
+    TokenLookupIndex(capacity=4096).save(path)
+    # The workers add the same tokens, for different devices, to the same slots
+    tokens = range(100000000, 100000000 + 400)
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(add_tokens_in_worker, [path] * 4, range(4), [tokens] * 4))
+    index = TokenLookupIndex.open(path)
+    try:
+        assert len(index) == 4 * len(tokens)
+        for token in tokens:
+            assert sorted(index.lookup("{:09d}".format(token))) == [
+                (device_id, 1) for device_id in range(4)
+            ]
+    finally:
+        index.close()
+
+
+def test_open_rejects_other_files(tmp_path):
+    path = tmp_path / "other.idx"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        TokenLookupIndex.open(str(path))
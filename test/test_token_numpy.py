@@ -0,0 +1,137 @@
+import json
+import random
+
+import pytest
+
+from openpaygo import TokenType
+from openpaygo.siphash_key import get_siphash_key
+from openpaygo.token_numpy import NumpyTokenEngine
+from openpaygo.token_shared import OpenPAYGOTokenShared
+from openpaygo.token_shared_extended import OpenPAYGOTokenSharedExtended
+
+np = pytest.importorskip("numpy")
+
+with open("test/test_tokens.jsonl") as f:
+    sample_data = [json.loads(line) for line in f]
+
+
+@pytest.fixture(scope="module")
+def random_keys():
+    rng = random.Random(1234)
+    return [bytes(rng.getrandbits(8) for _ in range(16)) for _ in range(2000)]
+
+
+def test_generate_starting_codes(random_keys):
+    k0, k1 = NumpyTokenEngine.load_keys(random_keys)
+    assert NumpyTokenEngine.generate_starting_codes(k0, k1).tolist() == [
+        OpenPAYGOTokenShared.generate_starting_code(key) for key in random_keys
+    ]
+
+
+def test_generate_next_tokens(random_keys):
+    rng = random.Random(1)
+    codes = [rng.randrange(1000000000) for _ in random_keys]
+    k0, k1 = NumpyTokenEngine.load_keys(random_keys)
+    assert NumpyTokenEngine.generate_next_tokens(
+        np.array(codes, dtype=np.uint64), k0, k1
+    ).tolist() == [
+        OpenPAYGOTokenShared.generate_next_token(code, key)
+        for code, key in zip(codes, random_keys)
+    ]
+
+
+def test_generate_next_extended_tokens(random_keys):
+    rng = random.Random(2)
+    codes = [rng.randrange(1000000000000) for _ in random_keys]
+    k0, k1 = NumpyTokenEngine.load_keys(random_keys)
+    assert NumpyTokenEngine.generate_next_extended_tokens(
+        np.array(codes, dtype=np.uint64), k0, k1
+    ).tolist() == [
+        OpenPAYGOTokenSharedExtended.generate_next_token(code, key)
+        for code, key in zip(codes, random_keys)
+    ]
+
+
+@pytest.mark.parametrize("extended_token", [False, True])
+def test_walk_chains(random_keys, extended_token):
+    if extended_token:
+        generate_next_token = OpenPAYGOTokenSharedExtended.generate_next_token
+    else:
+        generate_next_token = OpenPAYGOTokenShared.generate_next_token
+    keys = random_keys[:50]
+    rng = random.Random(3)
+    start_codes = [rng.randrange(1000000000) for _ in keys]
+    counts = [rng.randrange(40) for _ in keys]
+    k0, k1 = NumpyTokenEngine.load_keys(keys)
+    expected = []
+    for code, key, count in zip(start_codes, keys, counts):
+        for _ in range(count):
+            code = generate_next_token(code, key)
+        expected.append(code)
+    assert (
+        NumpyTokenEngine.walk_chains(start_codes, k0, k1, counts, extended_token)
+    ).tolist() == expected
+
+
+@pytest.mark.parametrize("restricted_digit_set", [False, True])
+@pytest.mark.parametrize("extended_token", [False, True])
+def test_generate_tokens(restricted_digit_set, extended_token):
+    cases = [
+        data
+        for data in sample_data
+        if data["restricted_digit_set"] == restricted_digit_set
+        and data["extended_token"] == extended_token
+    ]
+    results = NumpyTokenEngine.generate_tokens(
+        secret_keys=[data["key"] for data in cases],
+        counts=[data["count"] for data in cases],
+        values=[data["value_raw"] for data in cases],
+        token_types=[getattr(TokenType, data["token_type"]) for data in cases],
+        starting_codes=[data["starting_code"] for data in cases],
+        restricted_digit_set=restricted_digit_set,
+        extended_token=extended_token,
+    )
+    assert results == [(data["new_count"], data["token"]) for data in cases]
+
+
+@pytest.mark.parametrize(
+    "shared,bits,extended_token",
+    [(OpenPAYGOTokenShared, 30, False), (OpenPAYGOTokenSharedExtended, 40, True)],
+)
+def test_convert_to_4_digit_tokens(shared, bits, extended_token):
+    rng = random.Random(bits)
+    codes = [0, 1, (1 << bits) - 1, 1 << bits, 999999999]
+    codes += [rng.getrandbits(bits) for _ in range(2000)]
+    assert NumpyTokenEngine.convert_to_4_digit_tokens(codes, extended_token) == [
+        shared.convert_to_4_digit_token(code) for code in codes
+    ]
+
+
+@pytest.mark.parametrize(
+    "shared,digits,extended_token",
+    [(OpenPAYGOTokenShared, 15, False), (OpenPAYGOTokenSharedExtended, 20, True)],
+)
+def test_convert_from_4_digit_tokens(shared, digits, extended_token):
+    rng = random.Random(digits)
+    # The tokens entered can have any digit, and be shorter than usual
+    tokens = [0, 1, 4, 10, 1111, int("4" * digits), int("9" * digits)]
+    tokens += [
+        int("".join(rng.choice("1234") for _ in range(digits))) for _ in range(2000)
+    ]
+    tokens += [
+        int("".join(rng.choice("0123456789") for _ in range(rng.randint(1, digits))))
+        for _ in range(2000)
+    ]
+    assert NumpyTokenEngine.convert_from_4_digit_tokens(
+        tokens, extended_token
+    ).tolist() == [shared.convert_from_4_digit_token(token) for token in tokens]
+
+
+def test_hash_messages(random_keys):
+    rng = random.Random(2)
+    keys = random_keys[:300]
+    messages = [rng.randbytes(rng.randrange(0, 100)) for _ in keys]
+    k0, k1 = NumpyTokenEngine.load_keys(keys)
+    assert NumpyTokenEngine.hash_messages(k0, k1, messages).tolist() == [
+        get_siphash_key(key).hash(message) for key, message in zip(keys, messages)
+    ]
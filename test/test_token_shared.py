@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from openpaygo.token_shared import OpenPAYGOTokenShared
+from openpaygo.token_shared_extended import OpenPAYGOTokenSharedExtended
+
+
+def reference_to_4_digit_token(source, bits):
+    restricted_digit_token = ""
+    for i in range(0, bits, 2):
+        pair = (source >> (bits - 2 - i)) & 3
+        restricted_digit_token += str(pair + 1)
+    return int(restricted_digit_token)
+
+
+def reference_from_4_digit_token(source):
+    integer = 0
+    for digit in str(source):
+        digit = int(digit) - 1
+        integer = (integer << 2) | (bool(digit & 2) << 1) | bool(digit & 1)
+    return integer
+
+
+def get_test_sources(bits):
+    rng = random.Random(bits)
+    sources = [0, 1, 2, 3, (1 << bits) - 1, (1 << bits) - 2, 999999999, 1 << bits]
+    sources += [rng.getrandbits(bits) for _ in range(2000)]
+    return sources
+
+
+@pytest.mark.parametrize(
+    "shared,bits",
+    [(OpenPAYGOTokenShared, 30), (OpenPAYGOTokenSharedExtended, 40)],
+)
+def test_restricted_digit_set_codec_matches_reference(shared, bits):
+    sources = get_test_sources(bits)
+    for source in sources:
+        token = shared.convert_to_4_digit_token(source)
+        assert token == reference_to_4_digit_token(source, bits)
+        assert len(str(token)) == bits // 2
+        assert shared.convert_from_4_digit_token(token) == source % (1 << bits)
+
+
+@pytest.mark.parametrize("shared", [OpenPAYGOTokenShared, OpenPAYGOTokenSharedExtended])
+def test_restricted_digit_set_decode_digits_outside_of_set(shared):
+    rng = random.Random(0)
+    for _ in range(500):
+        token = "".join(rng.choice("0123456789") for _ in range(15))
+        assert shared.convert_from_4_digit_token(token) == (
+            reference_from_4_digit_token(token)
+        )
@@ -0,0 +1,161 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from openpaygo import OpenPAYGOTokenEncoder, SharedMemoryChainCache, TokenChainCache
+from openpaygo.token_shared_memory_cache import SHARED_CACHE_SLOT_STRUCT
+
+SECRET_KEY = "bc41ec9530f6dac86b1a29ab82edc5fb"
+STARTING_CODE = 516959010
+
+
+def generate(count, value, chain_cache=None):
+    return OpenPAYGOTokenEncoder.generate_token(
+        secret_key=SECRET_KEY,
+        count=count,
+        value=value,
+        starting_code=STARTING_CODE,
+        chain_cache=chain_cache,
+    )
+
+
+# The lock of the cache is given to the workers when they start
+worker_lock = None
+
+
+def set_worker_lock(lock):
+    global worker_lock
+    worker_lock = lock
+
+
+def generate_in_worker(name, count, value):
+    chain_cache = SharedMemoryChainCache(name, create=False, lock=worker_lock)
+    try:
+        return generate(count, value, chain_cache)
+    finally:
+        chain_cache.close()
+
+
+def generate_values_in_worker(name, count, values):
+    chain_cache = SharedMemoryChainCache(name, create=False, lock=worker_lock)
+    try:
+        return [generate(count, value, chain_cache) for value in values]
+    finally:
+        chain_cache.close()
+
+
+def test_shared_memory_cache_shared_between_processes():
+    chain_cache = SharedMemoryChainCache(slots=1024, checkpoint_interval=16)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=1, initializer=set_worker_lock, initargs=(chain_cache.lock,)
+        ) as executor:
+            result = executor.submit(
+                generate_in_worker, chain_cache.name, 400, 5
+            ).result()
+        assert result == generate(400, 5)
+        assert len(chain_cache) == 402 // 16
+        assert generate(400, 5, chain_cache) == result
+        assert generate(420, 5, chain_cache) == generate(420, 5)
+        stats = chain_cache.get_stats()
+        assert stats["hits"] == 2
+        assert stats["hit_rate"] == 1.0
+        assert stats["occupied"] == 422 // 16
+        assert stats["occupancy"] == stats["occupied"] / 1024
+        chain_cache.clear()
+        assert len(chain_cache) == 0
+    finally:
+        chain_cache.close()
+        chain_cache.unlink()
+
+
+def test_shared_memory_cache_eviction():
+    chain_cache = SharedMemoryChainCache(slots=8, checkpoint_interval=4)
+    try:
+        for value in range(1, 20):
+            assert generate(100, value, chain_cache) == generate(100, value)
+        assert len(chain_cache) == 8
+        assert generate(100, 19, chain_cache) == generate(
+            100, 19, TokenChainCache(checkpoint_interval=4)
+        )
+    finally:
+        chain_cache.close()
+        chain_cache.unlink()
+
+
+def test_shared_memory_cache_stats_with_threads():
+    chain_cache = SharedMemoryChainCache(slots=1024, checkpoint_interval=16)
+    chain_key = (b"k" * 16, 123456789, False)
+    chain_cache._add_checkpoint(chain_key, 16, 111)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+
+        def look_up(thread_index):
+            for count in range(2048):
+                chain_cache._get_checkpoint(chain_key, count % 32)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(look_up, range(8)))
+    finally:
+        sys.setswitchinterval(switch_interval)
+    try:
+        stats = chain_cache.get_stats()
+        assert stats["hits"] == 8 * 1024
+        assert stats["misses"] == 8 * 1024
+    finally:
+        chain_cache.close()
+        chain_cache.unlink()
+
+
+def test_shared_memory_cache_several_writers():
+    # A small table, so that the writers keep claiming and replacing the same slots
+    chain_cache = SharedMemoryChainCache(slots=64, checkpoint_interval=4)
+    try:
+        values = list(range(1, 25))
+        with ProcessPoolExecutor(
+            max_workers=4, initializer=set_worker_lock, initargs=(chain_cache.lock,)
+        ) as executor:
+            results = list(
+                executor.map(
+                    generate_values_in_worker,
+                    [chain_cache.name] * 8,
+                    [200] * 8,
+                    [values] * 8,
+                )
+            )
+        expected = [generate(200, value) for value in values]
+        assert results == [expected] * 8
+        records = set()
+        for slot in range(chain_cache.slots):
+            sequence, _, chain_id, index, _, _ = SHARED_CACHE_SLOT_STRUCT.unpack_from(
+                chain_cache._buffer, chain_cache._get_slot_offset(slot)
+            )
+            # No write was left half done, and no checkpoint is stored twice
+            assert sequence % 2 == 0
+            if chain_id == bytes(16):
+                continue
+            assert (chain_id, index) not in records
+            records.add((chain_id, index))
+        assert [generate(200, value, chain_cache) for value in values] == expected
+    finally:
+        chain_cache.close()
+        chain_cache.unlink()
+
+
+def test_shared_memory_cache_attach_requires_lock():
+    chain_cache = SharedMemoryChainCache(slots=8)
+    try:
+        with pytest.raises(ValueError):
+            SharedMemoryChainCache(chain_cache.name, create=False)
+        # A single writer can work without a lock
+        attached_cache = SharedMemoryChainCache(
+            chain_cache.name, create=False, lock=False
+        )
+        assert attached_cache.lock is None
+        assert generate(40, 5, attached_cache) == generate(40, 5)
+        attached_cache.close()
+    finally:
+        chain_cache.close()
+        chain_cache.unlink()
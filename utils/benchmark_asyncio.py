@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from openpaygo import OpenPAYGOTokenEncoder
+from openpaygo.aio import AsyncRunner
+
+# Measures how late the event loop runs a callback scheduled every millisecond while
+# it generates tokens with a high count, with the blocking generate_token() called
+# from a coroutine and with the async version running in a thread or process pool.
+
+TICK_INTERVAL = 0.001
+
+
+def get_token_kwargs(request_index, count):
+    return dict(
+        secret_key="{:032x}".format(
+            (request_index + 1) * 0x9E3779B97F4A7C15 & ((1 << 128) - 1)
+        ),
+        count=count,
+        value=7,
+        starting_code=123456789,
+    )
+
+
+async def measure_loop_lag(stop_event, lags):
+    while not stop_event.is_set():
+        expected = time.perf_counter() + TICK_INTERVAL
+        await asyncio.sleep(TICK_INTERVAL)
+        lags.append(max(time.perf_counter() - expected, 0))
+
+
+async def generate_blocking(request_index, count):
+    return OpenPAYGOTokenEncoder.generate_token(
+        **get_token_kwargs(request_index, count)
+    )
+
+
+async def run(mode, requests, count, executor):
+    runner = AsyncRunner(executor=executor)
+
+    async def generate(request_index):
+        if mode == "blocking":
+            return await generate_blocking(request_index, count)
+        return await runner.generate_token(**get_token_kwargs(request_index, count))
+
+    stop_event = asyncio.Event()
+    lags = []
+    lag_task = asyncio.ensure_future(measure_loop_lag(stop_event, lags))
+    await asyncio.sleep(TICK_INTERVAL)
+    start_time = time.perf_counter()
+    await asyncio.gather(*[generate(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start_time
+    stop_event.set()
+    await lag_task
+    lags.sort()
+    return (
+        requests / elapsed,
+        lags[len(lags) // 2] if lags else 0,
+        lags[-1] if lags else 0,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+    print("{} requests with a count of {}".format(args.requests, args.count))
+    with ProcessPoolExecutor(max_workers=args.processes) as process_executor:
+        for mode, executor in (
+            ("blocking", None),
+            ("threads", None),
+            ("processes", process_executor),
+        ):
+            rate, median_lag, max_lag = asyncio.run(
+                run(mode, args.requests, args.count, executor)
+            )
+            print(
+                "{:>9}: {:7.1f} tokens/sec, loop lag median {:7.2f} ms, "
+                "max {:8.2f} ms".format(mode, rate, median_lag * 1000, max_lag * 1000)
+            )
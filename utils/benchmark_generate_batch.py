@@ -0,0 +1,52 @@
+import argparse
+import random
+import time
+
+from openpaygo import NumpyTokenEngine, OpenPAYGOTokenEncoder, generate_tokens_batch
+
+# Compares generating one token for each of many devices with generate_token() in a
+# loop and with generate_tokens_batch(), with and without NumPy.
+
+
+def get_devices(device_count, max_count, seed=42):
+    rng = random.Random(seed)
+    return [
+        {
+            "secret_key": "{:032x}".format(rng.getrandbits(128)),
+            "count": rng.randrange(1, max_count),
+            "value": rng.randrange(1, 100),
+            "starting_code": rng.randrange(100000000, 999999999),
+        }
+        for _ in range(device_count)
+    ]
+
+
+def measure(function):
+    start_time = time.perf_counter()
+    results = function()
+    return results, time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=3000)
+    parser.add_argument("--max-count", type=int, default=300)
+    args = parser.parse_args()
+    devices = get_devices(args.devices, args.max_count)
+    expected, loop_time = measure(
+        lambda: [OpenPAYGOTokenEncoder.generate_token(**device) for device in devices]
+    )
+    print("generate_token() loop: {:.3f}s".format(loop_time))
+    use_numpy_options = [False]
+    if NumpyTokenEngine.is_available():
+        use_numpy_options.append(True)
+    for use_numpy in use_numpy_options:
+        results, batch_time = measure(
+            lambda: generate_tokens_batch(devices, use_numpy=use_numpy)
+        )
+        assert results == expected
+        print(
+            "generate_tokens_batch(use_numpy={}): {:.3f}s ({:.1f}x)".format(
+                use_numpy, batch_time, loop_time / batch_time
+            )
+        )
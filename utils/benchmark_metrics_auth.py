@@ -0,0 +1,106 @@
+import argparse
+import os
+import time
+
+from openpaygo import (
+    AuthMethod,
+    MetricsAuthVerifier,
+    MetricsRequestHandler,
+    MetricsResponseHandler,
+)
+
+# Compares verifying the auth of requests with hundreds of historical steps one by
+# one with MetricsResponseHandler.is_auth_valid() and in bulk with the
+# MetricsAuthVerifier, with and without NumPy and on several processes.
+
+DATA_FORMAT = {
+    "id": 1,
+    "data_order": ["token_count", "tampered", "firmware_version"],
+    "historical_data_order": [
+        "panel_voltage",
+        "battery_voltage",
+        "panel_current",
+        "battery_current",
+    ],
+    "historical_data_interval": 60,
+}
+
+
+def get_requests(request_count, steps, auth_method):
+    requests = []
+    for index in range(request_count):
+        secret_key = "{:032x}".format(
+            (index + 1) * 0x9E3779B97F4A7C15 & ((1 << 128) - 1)
+        )
+        metrics_request = MetricsRequestHandler(
+            serial_number="device{}".format(index),
+            data_format=DATA_FORMAT,
+            secret_key=secret_key,
+            auth_method=auth_method,
+        )
+        metrics_request.set_request_count(index + 1)
+        metrics_request.set_data(
+            {"token_count": 3, "tampered": False, "firmware_version": "1.2.3"}
+        )
+        metrics_request.set_historical_data(
+            [
+                {
+                    "panel_voltage": round(12 + step % 50 / 100, 2),
+                    "battery_voltage": 12.3,
+                    "panel_current": round(1 + step % 30 / 100, 2),
+                    "battery_current": -1.2,
+                }
+                for step in range(steps)
+            ]
+        )
+        requests.append(
+            (metrics_request.get_condensed_request_payload(), secret_key, None, None)
+        )
+    return requests
+
+
+def verify_one_by_one(requests):
+    return [
+        MetricsResponseHandler(payload, secret_key=secret_key).is_auth_valid()
+        for payload, secret_key, _, _ in requests
+    ]
+
+
+def measure(name, verify, requests):
+    start_time = time.perf_counter()
+    results = verify(requests)
+    elapsed = time.perf_counter() - start_time
+    assert all(results)
+    print(
+        "  {:<28} {:8.1f} requests/sec ({:.2f} ms/request)".format(
+            name, len(requests) / elapsed, elapsed * 1000 / len(requests)
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    for auth_method in (AuthMethod.RECURSIVE_DATA_AUTH, AuthMethod.DATA_AUTH):
+        requests = get_requests(args.requests, args.steps, auth_method)
+        print(
+            "{} requests of {} steps with {}".format(
+                args.requests, args.steps, auth_method
+            )
+        )
+        measure("is_auth_valid()", verify_one_by_one, requests)
+        measure(
+            "verifier without NumPy",
+            MetricsAuthVerifier(use_numpy=False).verify,
+            requests,
+        )
+        measure("verifier", MetricsAuthVerifier().verify, requests)
+        if args.processes > 1:
+            measure(
+                "verifier, {} processes".format(args.processes),
+                MetricsAuthVerifier(processes=args.processes, chunk_size=64).verify,
+                requests,
+            )
@@ -0,0 +1,59 @@
+import argparse
+import timeit
+
+from openpaygo.siphash_key import get_siphash_key
+from openpaygo.token_shared import OpenPAYGOTokenShared
+from openpaygo.token_shared_extended import OpenPAYGOTokenSharedExtended
+
+try:
+    import siphash
+except ImportError:
+    siphash = None
+
+# Measures the time of one step of the token chains: the SipHash-2-4 of an 8 bytes
+# message with SipHashKey.hash_u64(), compared to the siphash package when it is
+# installed, and the full generate_next_token() of the standard and extended tokens.
+# Expect hash_u64() to be less than 2x faster than the siphash package, see
+# utils/benchmark_generate_batch.py for the NumpyTokenEngine used for bulk work.
+
+KEY = bytes.fromhex("a29ab82edc5fbbc41ec9530f6dac86b1")
+MESSAGE = 0x0123456789ABCDEF
+
+
+def measure(function, number, repeat):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    siphash_key = get_siphash_key(KEY)
+    message_bytes = MESSAGE.to_bytes(8, "little")
+    functions = [
+        ("SipHashKey.hash_u64()", lambda: siphash_key.hash_u64(MESSAGE)),
+        (
+            "generate_next_token()",
+            lambda: OpenPAYGOTokenShared.generate_next_token(123456789, siphash_key),
+        ),
+        (
+            "generate_next_token() extended",
+            lambda: OpenPAYGOTokenSharedExtended.generate_next_token(
+                123456789012, siphash_key
+            ),
+        ),
+    ]
+    if siphash is not None:
+        functions.append(
+            (
+                "siphash.SipHash_2_4().hash()",
+                lambda: siphash.SipHash_2_4(KEY, message_bytes).hash(),
+            )
+        )
+    for name, function in functions:
+        print(
+            "{:32s} {:6.2f} us".format(
+                name, measure(function, args.number, args.repeat) * 1e6
+            )
+        )
@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from openpaygo import OpenPAYGOTokenEncoder, TokenChainCache
+
+# Measures the generate_token() throughput with an increasing number of threads
+# sharing the same TokenChainCache. With the GIL the throughput stays flat, on a free
+# threaded build (3.13t or later) it should grow with the number of threads, up to
+# the number of cores. With --without-chain-cache every token walks its chain from
+# the start, which measures the hash steps themselves.
+
+
+def generate_tokens(thread_index, devices_per_thread, tokens_per_device, chain_cache):
+    for device_index in range(devices_per_thread):
+        secret_key = "{:032x}".format(
+            (thread_index * devices_per_thread + device_index + 1) * 0x9E3779B97F4A7C15
+            & ((1 << 128) - 1)
+        )
+        count = 1
+        for _ in range(tokens_per_device):
+            count, _ = OpenPAYGOTokenEncoder.generate_token(
+                secret_key=secret_key,
+                count=count,
+                value=7,
+                starting_code=123456789,
+                chain_cache=chain_cache,
+            )
+
+
+def run(threads, devices_per_thread, tokens_per_device, use_chain_cache=True):
+    chain_cache = TokenChainCache() if use_chain_cache else None
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [
+            executor.submit(
+                generate_tokens,
+                thread_index,
+                devices_per_thread,
+                tokens_per_device,
+                chain_cache,
+            )
+            for thread_index in range(threads)
+        ]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start_time
+    return threads * devices_per_thread * tokens_per_device / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--devices-per-thread", type=int, default=20)
+    parser.add_argument("--tokens-per-device", type=int, default=50)
+    parser.add_argument("--without-chain-cache", action="store_true")
+    args = parser.parse_args()
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("Python {} (GIL {})".format(sys.version.split()[0], is_gil_enabled))
+    thread_counts = sorted(
+        {1, args.max_threads}
+        | {
+            2**i
+            for i in range(args.max_threads.bit_length())
+            if 2**i <= args.max_threads
+        }
+    )
+    base_rate = None
+    for threads in thread_counts:
+        rate = run(
+            threads,
+            args.devices_per_thread,
+            args.tokens_per_device,
+            not args.without_chain_cache,
+        )
+        base_rate = base_rate or rate
+        print(
+            "{:3d} threads: {:9.0f} tokens/sec ({:.2f}x)".format(
+                threads, rate, rate / base_rate
+            )
+        )